@@ -15,6 +15,7 @@ def includeme(config):
     config.include("mozsvc.user")
     # Add in the stuff we define ourselves.
     config.include("syncstorage.tweens")
+    config.include("syncstorage.profiler")
     config.include("syncstorage.storage")
     config.include("syncstorage.views")
 
@@ -0,0 +1,19 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Micro-benchmarks for performance-sensitive parts of SyncStorage.
+
+Each benchmark module in this package can be run as a script, e.g.:
+
+    python -m syncstorage.benchmarks.query_cache
+
+The "sessions" benchmark simulates complete sync sessions and reports the
+latency of each type of operation.  The "mcserver" module provides an
+in-process memcached stand-in for benchmarking the cached code paths.
+The "bso_rows" benchmark measures the conversion of database rows into BSOs.
+The "contention" benchmark runs many concurrent writers per user, with and
+without optimistic write locking.
+
+"""
@@ -0,0 +1,79 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmark for committing large batch uploads in the SQL storage backend.
+
+This script measures the time taken by SQLStorage.apply_batch() to commit
+a batch of items into a collection, where half of the items already exist
+and half of the updates are partial.  By default it uses the queries tuned
+for the database in use; pass --generic to compare against the portable
+fallback queries.
+
+"""
+
+import time
+import optparse
+
+import syncstorage.scripts
+from syncstorage.storage.sql import SQLStorage, queries_generic
+
+
+def time_apply_batch(storage, batch_size, number):
+    """Get the average time taken to commit a batch of the given size."""
+    total = 0
+    for userid in xrange(number):
+        storage.set_items(userid, "bench", [
+            {"id": str(i), "payload": "x" * 200, "sortindex": 1}
+            for i in xrange(0, batch_size, 2)
+        ])
+        batch = storage.create_batch(userid, "bench")
+        storage.append_items_to_batch(userid, "bench", batch, [
+            {"id": str(i), "payload": "y" * 200} if i % 4 else
+            {"id": str(i), "sortindex": 2}
+            for i in xrange(batch_size)
+        ])
+        start = time.time()
+        storage.apply_batch(userid, "bench", batch)
+        total += time.time() - start
+        storage.delete_storage(userid)
+    return total / number
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and prints the average
+    time taken to commit a batch.
+    """
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--sqluri", default="sqlite:///:memory:",
+                      help="The database in which to write items")
+    parser.add_option("-s", "--batch-size", type="int", default=10000,
+                      help="The number of items in each batch")
+    parser.add_option("-n", "--number", type="int", default=5,
+                      help="The number of batches to commit")
+    parser.add_option("", "--generic", action="store_true",
+                      help="Use the generic queries to commit the batch")
+
+    opts, args = parser.parse_args(args)
+    if args:
+        parser.print_usage()
+        return 1
+
+    storage = SQLStorage(opts.sqluri, create_tables=True)
+    if opts.generic:
+        dbconnector = storage.dbconnector
+        for name in ("APPLY_BATCH_UPDATE", "APPLY_BATCH_INSERT"):
+            query = getattr(queries_generic, name)
+            dbconnector._string_queries[name] = \
+                dbconnector._prerender_query(query)
+    elapsed = time_apply_batch(storage, opts.batch_size, opts.number)
+    print "%d items: %.1f ms per batch" % (opts.batch_size, elapsed * 1000)
+    return 0
+
+
+if __name__ == "__main__":
+    syncstorage.scripts.run_script(main)
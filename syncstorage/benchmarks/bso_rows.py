@@ -0,0 +1,100 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmark for turning rows from the bso table into BSO objects.
+
+This script reads a collection of items back out of the database once,
+then measures the time taken to convert all of the resulting rows into
+BSO objects.  It compares the trusted BSO.from_row() path used by the SQL
+storage backend against building each BSO via the validating constructor,
+and also reports the time taken by a full get_items() call.
+
+"""
+
+import timeit
+import optparse
+
+import syncstorage.scripts
+from syncstorage.bso import BSO
+from syncstorage.storage.sql import SQLStorage, bigint2ts
+
+
+def row_to_bso_validated(row, timestamp):
+    """Convert a row into a BSO via the validating constructor."""
+    item = dict(row)
+    for key in ("userid", "collection", "payload_size",):
+        item.pop(key, None)
+    ts = item.get("modified")
+    if ts is not None:
+        item["modified"] = bigint2ts(ts)
+    ttl = item.get("ttl")
+    if ttl is not None:
+        item["ttl"] = ttl - timestamp
+    return BSO(item)
+
+
+def fetch_rows(storage, userid, collection):
+    """Fetch the raw FIND_ITEMS rows for all items in a collection."""
+    with storage._get_or_create_session() as session:
+        params = {
+            "userid": userid,
+            "collectionid": storage._get_collection_id(session, collection),
+            "ttl": int(session.timestamp),
+        }
+        rows = list(session.query_fetchall("FIND_ITEMS", params))
+        return rows, int(session.timestamp)
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and prints the average
+    time taken to convert the given number of rows into BSOs.
+    """
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--sqluri", default="sqlite:///:memory:",
+                      help="The database in which to store items")
+    parser.add_option("-s", "--num-rows", type="int", default=10000,
+                      help="The number of rows to convert")
+    parser.add_option("-n", "--number", type="int", default=10,
+                      help="The number of times to convert the rows")
+
+    opts, args = parser.parse_args(args)
+    if args:
+        parser.print_usage()
+        return 1
+
+    storage = SQLStorage(opts.sqluri, create_tables=True)
+    storage.delete_storage(1)
+    for start in xrange(0, opts.num_rows, 100):
+        storage.set_items(1, "bench", [
+            {"id": str(i), "payload": "x" * 200, "sortindex": i % 7 or None}
+            for i in xrange(start, min(start + 100, opts.num_rows))
+        ])
+    rows, timestamp = fetch_rows(storage, 1, "bench")
+
+    def convert_validated():
+        for row in rows:
+            row_to_bso_validated(row, timestamp)
+
+    def convert_trusted():
+        for row in rows:
+            storage._row_to_bso(row, timestamp)
+
+    def get_items():
+        storage.get_items(1, "bench", full=True)
+
+    for name, func in (("validated", convert_validated),
+                       ("from_row", convert_trusted),
+                       ("get_items", get_items)):
+        elapsed = timeit.timeit(func, number=opts.number) / opts.number
+        print "%-10s %d rows: %.1f ms" % (name, len(rows), elapsed * 1000)
+    storage.delete_storage(1)
+    return 0
+
+
+if __name__ == "__main__":
+    syncstorage.scripts.run_script(main)
@@ -0,0 +1,149 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmark for concurrent writes to the same collections in the SQL backend.
+
+This script runs several writer threads per user, all writing into the same
+collection, as happens when a user has many devices syncing at once.  Each
+write takes the write lock, writes some items, and then holds the lock for
+a while to simulate the rest of the work done by the view.  It runs once
+with the default row locks, and once with optimistic_writes enabled, and
+reports the throughput, the number of conflicts and the write latencies.
+
+Note that SQLite locks the entire database for each write transaction, so
+the two modes only really differ when run against MySQL or PostgreSQL.
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import optparse
+import tempfile
+import threading
+
+import syncstorage.scripts
+from syncstorage.storage import ConflictError
+from syncstorage.storage.sql import SQLStorage
+from syncstorage.benchmarks.sessions import percentile
+
+
+# Give up on a write if it conflicts this many times in a row.
+MAX_ATTEMPTS = 10
+
+
+def run_writer(storage, userid, opts, latencies, counters, lock):
+    """Repeatedly write into the user's collection, retrying on conflict."""
+    for i in xrange(opts.writes):
+        bsos = [{"id": "item%d" % (random.randint(0, 99),), "payload": "x"}
+                for _ in xrange(opts.items)]
+        start = time.time()
+        for attempt in xrange(MAX_ATTEMPTS):
+            try:
+                with storage.lock_for_write(userid, "bench"):
+                    storage.set_items(userid, "bench", bsos)
+                    time.sleep(opts.hold_ms / 1000.0)
+            except ConflictError:
+                with lock:
+                    counters["conflicts"] += 1
+                time.sleep(random.random() * 0.01)
+            else:
+                with lock:
+                    latencies.append(time.time() - start)
+                break
+        else:
+            with lock:
+                counters["failures"] += 1
+
+
+def run_benchmark(storage, opts):
+    """Run all the writer threads against the storage, and summarize."""
+    latencies = []
+    counters = {"conflicts": 0, "failures": 0}
+    lock = threading.Lock()
+    threads = []
+    for userid in xrange(opts.users):
+        for _ in xrange(opts.writers):
+            args = (storage, userid, opts, latencies, counters, lock)
+            threads.append(threading.Thread(target=run_writer, args=args))
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    latencies.sort()
+    return {
+        "writes": len(latencies),
+        "conflicts": counters["conflicts"],
+        "failures": counters["failures"],
+        "elapsed_s": elapsed,
+        "writes_per_sec": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000 if latencies else None,
+        "p99_ms": percentile(latencies, 99) * 1000 if latencies else None,
+    }
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments, runs the writers in each
+    locking mode, and prints a JSON summary of the results.
+    """
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--sqluri", default=None,
+                      help="The database in which to write items. If not"
+                           " given, a temporary sqlite file is used.")
+    parser.add_option("-u", "--users", type="int", default=4,
+                      help="The number of distinct users to write for")
+    parser.add_option("-w", "--writers", type="int", default=4,
+                      help="The number of concurrent writers per user")
+    parser.add_option("-n", "--writes", type="int", default=25,
+                      help="The number of writes done by each writer")
+    parser.add_option("", "--items", type="int", default=5,
+                      help="The number of items in each write")
+    parser.add_option("", "--hold-ms", type="float", default=5.0,
+                      help="How long to hold the lock after each write")
+
+    opts, args = parser.parse_args(args)
+    if args:
+        parser.print_usage()
+        return 1
+
+    sqluri = opts.sqluri
+    tempdb = None
+    if sqluri is None:
+        fd, tempdb = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        sqluri = "sqlite:///" + tempdb
+    try:
+        results = {}
+        for mode in ("locking", "optimistic"):
+            storage = SQLStorage(sqluri, create_tables=True,
+                                 optimistic_writes=(mode == "optimistic"))
+            results[mode] = run_benchmark(storage, opts)
+            for userid in xrange(opts.users):
+                storage.delete_storage(userid)
+    finally:
+        if tempdb is not None:
+            os.unlink(tempdb)
+
+    json.dump({
+        "sqluri": sqluri,
+        "users": opts.users,
+        "writers": opts.writers,
+        "writes": opts.writes,
+        "hold_ms": opts.hold_ms,
+        "modes": results,
+    }, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    syncstorage.scripts.run_script(main)
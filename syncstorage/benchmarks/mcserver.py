@@ -0,0 +1,222 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+In-process stand-in for a memcached server.
+
+This module implements just enough of the memcached text protocol to
+support the MemcachedClient class used by the memcache storage backend:
+the get, gets, set, add, replace, cas and delete commands, along with
+flush_all and version.  It serves each connection from a separate thread
+and keeps all data in a dict, so it is nowhere near as fast as the real
+thing, but it lets the cached code paths be exercised without having to
+run any external services.
+
+Start it in a background thread like so:
+
+    server = MemcachedServer()
+    server.start()
+    storage = MemcachedStorage(..., cache_servers=server.address)
+    ...
+    server.stop()
+
+"""
+
+import time
+import socket
+import threading
+import SocketServer
+
+
+# Expiry times larger than this are absolute timestamps, not offsets.
+MAX_RELATIVE_EXPIRY = 60 * 60 * 24 * 30
+
+
+class MemcachedRequestHandler(SocketServer.StreamRequestHandler):
+    """Handler for a single client connection to the MemcachedServer."""
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.server.add_connection(self.connection)
+
+    def finish(self):
+        self.server.remove_connection(self.connection)
+        SocketServer.StreamRequestHandler.finish(self)
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = line.split()
+            if not args:
+                continue
+            command = args[0]
+            try:
+                handler = getattr(self, "do_" + command)
+            except AttributeError:
+                self.wfile.write("ERROR\r\n")
+            else:
+                try:
+                    handler(*args[1:])
+                except (TypeError, ValueError):
+                    self.wfile.write("CLIENT_ERROR bad command line\r\n")
+            self.wfile.flush()
+
+    def do_get(self, *keys):
+        self._write_values(keys, with_casid=False)
+
+    def do_gets(self, *keys):
+        self._write_values(keys, with_casid=True)
+
+    def _write_values(self, keys, with_casid):
+        output = []
+        for key in keys:
+            item = self.server.get_item(key)
+            if item is not None:
+                value, flags, casid = item
+                if with_casid:
+                    header = "VALUE %s %d %d %d\r\n"
+                    output.append(header % (key, flags, len(value), casid))
+                else:
+                    header = "VALUE %s %d %d\r\n"
+                    output.append(header % (key, flags, len(value)))
+                output.append(value)
+                output.append("\r\n")
+        output.append("END\r\n")
+        self.wfile.write("".join(output))
+
+    def do_set(self, key, flags, exptime, size, noreply=None):
+        self._store("set", key, flags, exptime, size, None, noreply)
+
+    def do_add(self, key, flags, exptime, size, noreply=None):
+        self._store("add", key, flags, exptime, size, None, noreply)
+
+    def do_replace(self, key, flags, exptime, size, noreply=None):
+        self._store("replace", key, flags, exptime, size, None, noreply)
+
+    def do_cas(self, key, flags, exptime, size, casid, noreply=None):
+        self._store("cas", key, flags, exptime, size, int(casid), noreply)
+
+    def _store(self, command, key, flags, exptime, size, casid, noreply):
+        value = self.rfile.read(int(size) + 2)[:-2]
+        result = self.server.store_item(command, key, value, int(flags),
+                                        int(exptime), casid)
+        if noreply is None:
+            self.wfile.write(result + "\r\n")
+
+    def do_delete(self, key, *args):
+        # Older clients may send an (always zero) expiry time before noreply.
+        if self.server.delete_item(key):
+            result = "DELETED"
+        else:
+            result = "NOT_FOUND"
+        if "noreply" not in args:
+            self.wfile.write(result + "\r\n")
+
+    def do_flush_all(self, *args):
+        self.server.flush()
+        self.wfile.write("OK\r\n")
+
+    def do_version(self):
+        self.wfile.write("VERSION 1.4.0-syncstorage\r\n")
+
+
+class MemcachedServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """In-process memcached server, storing data in a dict.
+
+    By default this listens on a randomly-chosen free port on localhost.
+    The "address" attribute gives the "host:port" string to use when
+    connecting to it.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0):
+        SocketServer.TCPServer.__init__(self, (host, port),
+                                        MemcachedRequestHandler)
+        self.address = "%s:%d" % self.server_address
+        self._data = {}
+        self._data_lock = threading.Lock()
+        self._next_casid = 1
+        self._connections = set()
+        self._thread = None
+
+    def start(self):
+        """Start serving requests in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop serving requests and close all open sockets."""
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+        self._thread = None
+        # Shut down any client connections, so their handlers will exit.
+        with self._data_lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def add_connection(self, connection):
+        with self._data_lock:
+            self._connections.add(connection)
+
+    def remove_connection(self, connection):
+        with self._data_lock:
+            self._connections.discard(connection)
+
+    def get_item(self, key):
+        """Get the (value, flags, casid) tuple for a key, or None."""
+        with self._data_lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, flags, casid, expires = item
+            if expires and expires <= time.time():
+                del self._data[key]
+                return None
+            return value, flags, casid
+
+    def store_item(self, command, key, value, flags, exptime, casid=None):
+        """Store a value under the given key, returning the response line."""
+        if exptime > MAX_RELATIVE_EXPIRY:
+            expires = exptime
+        elif exptime > 0:
+            expires = time.time() + exptime
+        else:
+            expires = 0
+        with self._data_lock:
+            existing = self._data.get(key)
+            if existing is not None and existing[3]:
+                if existing[3] <= time.time():
+                    existing = None
+            if command == "add" and existing is not None:
+                return "NOT_STORED"
+            if command == "replace" and existing is None:
+                return "NOT_STORED"
+            if command == "cas":
+                if existing is None:
+                    return "NOT_FOUND"
+                if existing[2] != casid:
+                    return "EXISTS"
+            self._data[key] = (value, flags, self._next_casid, expires)
+            self._next_casid += 1
+            return "STORED"
+
+    def delete_item(self, key):
+        """Delete the given key, returning True if it existed."""
+        with self._data_lock:
+            return self._data.pop(key, None) is not None
+
+    def flush(self):
+        """Delete all stored data."""
+        with self._data_lock:
+            self._data.clear()
@@ -0,0 +1,87 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmark for the cache of rendered FIND_ITEMS queries.
+
+This script measures the per-request cost of turning the FIND_ITEMS query
+into SQL, which is everything that happens before the query is actually
+sent to the database.  It runs once with the cache of rendered queries
+disabled, and once with it enabled.
+
+"""
+
+import timeit
+import optparse
+
+import syncstorage.scripts
+from syncstorage.storage.sql.dbconnect import DBConnector
+
+
+# Some typical shapes of params for a collection GET.
+PARAMS = [
+    # Fetch the full records, newest-first, with a limit.
+    {"sort": "newest", "limit": 101},
+    # Fetch just the ids of records changed since some timestamp.
+    {"fields": ["id", "modified", "sortindex"], "newer": 123456789},
+    # Fetch specific records by id.
+    {"ids": ["item%d" % (i,) for i in xrange(10)]},
+    # Fetch a subsequent page of records.
+    {"sort": "index", "limit": 101, "offset": 100},
+]
+
+
+def render_find_items(connector, connection, params):
+    """Render the FIND_ITEMS query for a copy of the given params."""
+    params = params.copy()
+    params["userid"] = 42
+    params["collectionid"] = 7
+    params["ttl"] = 123456789
+    query = connector.get_query("FIND_ITEMS", params)
+    return connection._render_query(query, params, {})
+
+
+def time_render_find_items(sqluri, number, **kwds):
+    """Get the average time taken to render each FIND_ITEMS query."""
+    connector = DBConnector(sqluri, **kwds)
+    connection = connector.connect()
+
+    def render_all():
+        for params in PARAMS:
+            render_find_items(connector, connection, params)
+
+    render_all()
+    total = timeit.timeit(render_all, number=number)
+    return total / (number * len(PARAMS))
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and prints the average
+    time taken to render a query, with and without the cache.
+    """
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--sqluri", default="sqlite:///:memory:",
+                      help="The database whose SQL dialect to render")
+    parser.add_option("-n", "--number", type="int", default=2000,
+                      help="The number of times to render each query")
+
+    opts, args = parser.parse_args(args)
+    if args:
+        parser.print_usage()
+        return 1
+
+    uncached = time_render_find_items(opts.sqluri, opts.number,
+                                      query_cache_size=0)
+    cached = time_render_find_items(opts.sqluri, opts.number)
+    print "uncached: %.1f us per query" % (uncached * 1000000,)
+    print "cached:   %.1f us per query" % (cached * 1000000,)
+    print "speedup:  %.1fx" % (uncached / cached,)
+    return 0
+
+
+if __name__ == "__main__":
+    syncstorage.scripts.run_script(main)
@@ -0,0 +1,461 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmark of simulated sync sessions against the storage backends.
+
+This script runs synthetic sync sessions for a pool of users, following
+the same mix of operations as the loadtest in loadtest/stress.py, but
+without needing a live tokenserver or any load-testing framework.  The
+sessions are run either directly against the storage backend, or through
+the full WSGI application using webtest.
+
+By default it uses an in-memory SQLite database.  If the memcached backend
+is selected and no cache servers are given, it starts an in-process stand-in
+for memcached so that the cached code paths can be measured as well.
+
+It prints the throughput and the 50th and 99th percentile latency of each
+type of operation as JSON, so that the results of different runs can be
+easily compared.
+
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import random
+import optparse
+import functools
+
+import syncstorage.scripts
+from syncstorage.storage import NotFoundError, ConflictError
+from syncstorage.storage.sql import SQLStorage
+from syncstorage.storage.memcached import MemcachedStorage
+from syncstorage.benchmarks.mcserver import MemcachedServer
+
+
+# The following settings mirror those in loadtest/stress.py.
+
+# Maximum number of items to upload in a single POST.
+BATCH_MAX_COUNT = 100
+
+# Each run reads clients collection 10% of the time.
+client_get_probability = 10 / 100.
+
+# Each run will update a client record 20% of the time.
+client_post_probability = 20 / 100.
+
+# The client ids to simulate.
+clients_distribution = [80, 15, 4, 1]
+
+# The collections to operate on.
+collections = ['bookmarks', 'forms', 'passwords', 'history', 'prefs']
+
+# The distribution of GET operations to meta/global per test run.
+metaglobal_count_distribution = [40, 60, 0, 0, 0]
+
+# The distribution of GET operations per test run.
+get_count_distribution = [71, 15, 7, 4, 3]
+
+# The distribution of POST operations per test run.
+post_count_distribution = [67, 18, 9, 4, 2]
+
+# The distribution of DELETE operations per test run.
+delete_count_distribution = [99, 1, 0, 0, 0]
+
+# The probability that we'll try to do a full DELETE of all data.
+deleteall_probability = 1 / 100.
+
+METAGLOBAL_PAYLOAD = "This is the metaglobal payload which contains"\
+                     " some client data that doesnt look much like this"
+
+
+def pick_weighted_count(weights):
+    """Pick a count at random, weighted by the given distribution."""
+    i = random.randint(1, sum(weights))
+    count = 0
+    base = 0
+    for weight in weights:
+        base += weight
+        if i <= base:
+            break
+        count += 1
+    return count
+
+
+def make_bsos(num_items):
+    """Make a list of random BSOs to upload, as done by stress.py."""
+    bsos = []
+    for i in xrange(num_items):
+        id = base64.urlsafe_b64encode(os.urandom(10)).rstrip("=")
+        id += str(int((time.time() % 100) * 100000))
+        # Random payload length.  They can be big, but skew small.
+        # This gives min=300, mean=450, max=7000
+        payload_length = min(int(random.paretovariate(3) * 300), 7000)
+        bsos.append({"id": id, "payload": "x" * payload_length})
+    return bsos
+
+
+def retry_on_conflict(func):
+    """Decorator to retry once after a ConflictError, as the views do."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwds):
+        try:
+            return func(*args, **kwds)
+        except ConflictError:
+            time.sleep(0.01)
+            return func(*args, **kwds)
+
+    return wrapper
+
+
+class StorageDriver(object):
+    """Driver performing sync operations directly on a storage backend.
+
+    This takes the same locks as the corresponding views would, and retries
+    on conflict in the same way, but skips all of the request parsing and
+    response rendering.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def get_info_collections(self, userid):
+        self.storage.get_collection_timestamps(userid)
+
+    @retry_on_conflict
+    def get_metaglobal(self, userid):
+        with self.storage.lock_for_read(userid, "meta"):
+            try:
+                self.storage.get_item(userid, "meta", "global")
+            except NotFoundError:
+                return False
+        return True
+
+    @retry_on_conflict
+    def put_metaglobal(self, userid):
+        with self.storage.lock_for_write(userid, "meta"):
+            data = {"payload": METAGLOBAL_PAYLOAD}
+            self.storage.set_item(userid, "meta", "global", data)
+
+    @retry_on_conflict
+    def get_collection(self, userid, collection, newer):
+        with self.storage.lock_for_read(userid, collection):
+            try:
+                self.storage.get_items(userid, collection, newer=newer)
+            except NotFoundError:
+                pass
+
+    @retry_on_conflict
+    def post_collection(self, userid, collection, bsos):
+        with self.storage.lock_for_write(userid, collection):
+            self.storage.set_items(userid, collection, bsos)
+
+    @retry_on_conflict
+    def post_batch(self, userid, collection, batch, bsos, commit=False):
+        with self.storage.lock_for_write(userid, collection):
+            if batch is None:
+                batch = self.storage.create_batch(userid, collection)
+            self.storage.append_items_to_batch(userid, collection,
+                                               batch, bsos)
+            if commit:
+                self.storage.apply_batch(userid, collection, batch)
+                self.storage.close_batch(userid, collection, batch)
+        return batch
+
+    @retry_on_conflict
+    def delete_collection(self, userid, collection):
+        with self.storage.lock_for_write(userid, collection):
+            try:
+                self.storage.delete_collection(userid, collection)
+            except NotFoundError:
+                pass
+
+    def delete_storage(self, userid):
+        self.storage.delete_storage(userid)
+
+
+class AppDriver(object):
+    """Driver performing sync operations through the WSGI application."""
+
+    def __init__(self, config):
+        # Import these lazily, since they're only needed in this mode.
+        from webtest import TestApp
+        from pyramid.request import Request
+        from pyramid.interfaces import IAuthenticationPolicy
+        import hawkauthlib
+        self.app = TestApp(config.make_wsgi_app())
+        self._auth_policy = config.registry.getUtility(IAuthenticationPolicy)
+        self._auth_credentials = {}
+        self._make_request = Request.blank
+        self._sign_request = hawkauthlib.sign_request
+
+    def _request(self, method, userid, path, params=None, status="*"):
+        credentials = self._auth_credentials.get(userid)
+        if credentials is None:
+            req = self._make_request("http://localhost/")
+            credentials = self._auth_policy.encode_hawk_id(req, userid)
+            self._auth_credentials[userid] = credentials
+        url = "/1.5/%d%s" % (userid, path)
+        req = self._make_request(url, method=method)
+        req.headers["X-Confirm-Delete"] = "1"
+        if params is not None:
+            req.content_type = "application/json"
+            req.body = json.dumps(params)
+        self._sign_request(req, *credentials)
+        return self.app.do_request(req, status=status)
+
+    def get_info_collections(self, userid):
+        self._request("GET", userid, "/info/collections")
+
+    def get_metaglobal(self, userid):
+        res = self._request("GET", userid, "/storage/meta/global")
+        return res.status_int != 404
+
+    def put_metaglobal(self, userid):
+        data = {"id": "global", "payload": METAGLOBAL_PAYLOAD}
+        self._request("PUT", userid, "/storage/meta/global", data, 200)
+
+    def get_collection(self, userid, collection, newer):
+        path = "/storage/%s?full=1&newer=%s" % (collection, newer)
+        self._request("GET", userid, path)
+
+    def post_collection(self, userid, collection, bsos):
+        path = "/storage/" + collection
+        self._request("POST", userid, path, bsos, 200)
+
+    def post_batch(self, userid, collection, batch, bsos, commit=False):
+        path = "/storage/%s?batch=%s" % (collection, batch or "true")
+        if commit:
+            path += "&commit=true"
+        res = self._request("POST", userid, path, bsos, (200, 202))
+        batch = res.json.get("batch")
+        if batch is not None:
+            batch = str(batch)
+        return batch
+
+    def delete_collection(self, userid, collection):
+        self._request("DELETE", userid, "/storage/" + collection)
+
+    def delete_storage(self, userid):
+        self._request("DELETE", userid, "/storage", status=200)
+
+
+class SessionRunner(object):
+    """Run simulated sync sessions, timing each operation performed."""
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.timings = {}
+
+    def timed(self, name, func, *args):
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            duration = time.time() - start
+            self.timings.setdefault(name, []).append(duration)
+
+    def run_session(self, userid):
+        """Run a single sync session for the given user.
+
+        This follows the same steps, with the same probabilities, as the
+        test_storage_session method in loadtest/stress.py.
+        """
+        driver = self.driver
+        self.timed("get_info_collections", driver.get_info_collections,
+                   userid)
+
+        # GET requests to meta/global.
+        num_requests = pick_weighted_count(metaglobal_count_distribution)
+        for x in xrange(num_requests):
+            if not self.timed("get_metaglobal", driver.get_metaglobal,
+                              userid):
+                self.timed("put_metaglobal", driver.put_metaglobal, userid)
+
+        # Occasional reads of client records.
+        if random.random() <= client_get_probability:
+            newer = int(time.time() - random.randint(3600, 360000))
+            self.timed("get_clients", driver.get_collection,
+                       userid, "clients", newer)
+
+        # Occasional updates to client records.
+        if random.random() <= client_post_probability:
+            clientid = str(pick_weighted_count(clients_distribution))
+            bsos = [{"id": "client" + clientid, "payload": clientid * 300}]
+            self.timed("post_clients", driver.post_collection,
+                       userid, "clients", bsos)
+
+        # GET requests to individual collections.
+        num_requests = pick_weighted_count(get_count_distribution)
+        for collection in random.sample(collections, num_requests):
+            newer = int(time.time() - random.randint(3600, 360000))
+            self.timed("get_collection", driver.get_collection,
+                       userid, collection, newer)
+
+        # POST requests with several BSOs batched together,
+        # in a single batch upload roughly 50% of the time.
+        num_requests = pick_weighted_count(post_count_distribution)
+        if random.randint(0, 1):
+            collection = random.choice(collections)
+            batch = None
+            for x in xrange(num_requests):
+                bsos = make_bsos(self.pick_batch_size())
+                commit = (x == num_requests - 1)
+                name = "post_batch_commit" if commit else "post_batch"
+                batch = self.timed(name, driver.post_batch, userid,
+                                   collection, batch, bsos, commit)
+        else:
+            for collection in random.sample(collections, num_requests):
+                bsos = make_bsos(self.pick_batch_size())
+                self.timed("post_collection", driver.post_collection,
+                           userid, collection, bsos)
+
+        # DELETE requests.
+        num_requests = pick_weighted_count(delete_count_distribution)
+        if num_requests:
+            for collection in random.sample(collections, num_requests):
+                self.timed("delete_collection", driver.delete_collection,
+                           userid, collection)
+        elif random.random() <= deleteall_probability:
+            self.timed("delete_storage", driver.delete_storage, userid)
+
+    def pick_batch_size(self):
+        # Random batch size, skewed slightly towards the upper limit.
+        return min(random.randint(20, BATCH_MAX_COUNT + 80), BATCH_MAX_COUNT)
+
+    def get_results(self):
+        """Get a summary of the timings of each type of operation."""
+        results = {}
+        for name, durations in self.timings.iteritems():
+            durations = sorted(durations)
+            total = sum(durations)
+            results[name] = {
+                "count": len(durations),
+                "ops_per_sec": len(durations) / total if total else None,
+                "p50_ms": percentile(durations, 50) * 1000,
+                "p99_ms": percentile(durations, 99) * 1000,
+            }
+        return results
+
+
+def percentile(sorted_values, percent):
+    """Get the given percentile from a sorted list of values."""
+    index = int(round((len(sorted_values) - 1) * percent / 100.0))
+    return sorted_values[index]
+
+
+def make_storage(opts, cache_servers):
+    """Create the storage backend to benchmark, from command-line options."""
+    storage = SQLStorage(opts.sqluri, create_tables=True,
+                         standard_collections=True)
+    if opts.backend == "memcached":
+        storage = MemcachedStorage(storage, cache_servers=cache_servers,
+                                   cached_collections="meta clients",
+                                   cache_only_collections="tabs")
+    return storage
+
+
+def make_config(opts, cache_servers):
+    """Create a configurator for the WSGI app, from command-line options."""
+    import syncstorage
+    settings = {
+        "storage.batch_upload_enabled": True,
+        "storage.quota_size": 5242880,
+        "hawkauth.secret": "benchmarks",
+    }
+    sql_settings = {
+        "backend": "syncstorage.storage.sql.SQLStorage",
+        "sqluri": opts.sqluri,
+        "create_tables": True,
+        "standard_collections": True,
+    }
+    # The memcached backend wraps an SQL backend from another section.
+    if opts.backend == "memcached":
+        settings.update({
+            "storage.backend": "syncstorage.storage.memcached."
+                               "MemcachedStorage",
+            "storage.wraps": "sqlstorage",
+            "storage.cache_servers": cache_servers,
+            "storage.cached_collections": "meta clients",
+            "storage.cache_only_collections": "tabs",
+        })
+        section = "sqlstorage"
+    else:
+        section = "storage"
+    for key, value in sql_settings.iteritems():
+        settings[section + "." + key] = value
+    return syncstorage.get_configurator({}, **settings)
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments, runs the requested number
+    of simulated sync sessions, and prints a JSON summary of the results.
+    """
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--sqluri", default="sqlite:///:memory:",
+                      help="The database in which to store data")
+    parser.add_option("", "--backend", default="sql",
+                      choices=["sql", "memcached"],
+                      help="The storage backend: 'sql' or 'memcached'")
+    parser.add_option("", "--cache-servers", default=None,
+                      help="The memcached servers for the memcached backend."
+                           " If not given, an in-process stand-in is used.")
+    parser.add_option("", "--wsgi", action="store_true",
+                      help="Drive the full WSGI app rather than the storage")
+    parser.add_option("-u", "--users", type="int", default=20,
+                      help="The number of distinct users to simulate")
+    parser.add_option("-n", "--sessions", type="int", default=200,
+                      help="The number of sync sessions to run")
+    parser.add_option("", "--seed", type="int", default=None,
+                      help="Seed for the random number generator")
+
+    opts, args = parser.parse_args(args)
+    if args:
+        parser.print_usage()
+        return 1
+
+    random.seed(opts.seed)
+    mcserver = None
+    cache_servers = opts.cache_servers
+    if opts.backend == "memcached" and cache_servers is None:
+        mcserver = MemcachedServer()
+        mcserver.start()
+        cache_servers = mcserver.address
+    try:
+        if opts.wsgi:
+            driver = AppDriver(make_config(opts, cache_servers))
+        else:
+            driver = StorageDriver(make_storage(opts, cache_servers))
+        runner = SessionRunner(driver)
+        start = time.time()
+        for _ in xrange(opts.sessions):
+            runner.run_session(random.randint(1, opts.users))
+        elapsed = time.time() - start
+    finally:
+        if mcserver is not None:
+            mcserver.stop()
+
+    json.dump({
+        "backend": opts.backend,
+        "sqluri": opts.sqluri,
+        "wsgi": bool(opts.wsgi),
+        "users": opts.users,
+        "sessions": opts.sessions,
+        "elapsed_s": elapsed,
+        "sessions_per_sec": opts.sessions / elapsed,
+        "operations": runner.get_results(),
+    }, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    syncstorage.scripts.run_script(main)
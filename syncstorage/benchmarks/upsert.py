@@ -0,0 +1,76 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmark for bulk "upsert" of items in the SQL storage backend.
+
+This script measures the time taken by SQLStorage.set_items() to write
+batches of 1, 10, 100 and 1000 items, half of which already exist.  It runs
+once with the generic one-item-at-a-time upsert, and once with the native
+upsert syntax supported by the database, if any.
+
+"""
+
+import time
+import optparse
+
+import syncstorage.scripts
+from syncstorage.storage.sql import SQLStorage
+
+
+BATCH_SIZES = [1, 10, 100, 1000]
+
+
+def time_set_items(storage, batch_size, number):
+    """Get the average time taken to write a batch of the given size."""
+    total = 0
+    for userid in xrange(number):
+        bsos = [{"id": "item%d" % (i,), "payload": "x" * 200}
+                for i in xrange(batch_size)]
+        storage.set_items(userid, "bench", bsos[::2])
+        start = time.time()
+        storage.set_items(userid, "bench", bsos)
+        total += time.time() - start
+        storage.delete_storage(userid)
+    return total / number
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and prints the average
+    time taken to write each size of batch, with each style of upsert.
+    """
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--sqluri", default="sqlite:///:memory:",
+                      help="The database in which to write items")
+    parser.add_option("-n", "--number", type="int", default=20,
+                      help="The number of times to write each batch")
+
+    opts, args = parser.parse_args(args)
+    if args:
+        parser.print_usage()
+        return 1
+
+    storage = SQLStorage(opts.sqluri, create_tables=True)
+    # Do an untimed write first, to create the collection and warm caches.
+    time_set_items(storage, 1, 1)
+    native_style = storage.dbconnector.upsert_style
+    styles = ["generic"]
+    if native_style != "generic":
+        styles.append(native_style)
+    print "%-10s" % ("items",) + "".join("%16s" % (s,) for s in styles)
+    for batch_size in BATCH_SIZES:
+        times = []
+        for style in styles:
+            storage.dbconnector.upsert_style = style
+            times.append(time_set_items(storage, batch_size, opts.number))
+        print "%-10d" % (batch_size,) +\
+              "".join("%13.2f ms" % (t * 1000,) for t in times)
+    return 0
+
+
+if __name__ == "__main__":
+    syncstorage.scripts.run_script(main)
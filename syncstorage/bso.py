@@ -53,6 +53,21 @@ class BSO(dict):
 
             self[name] = value
 
+    @classmethod
+    def from_row(cls, row, fields=FIELDS):
+        """Create a BSO from a trusted sequence of (name, value) pairs.
+
+        This is a fast path for building BSOs from data that we've read back
+        out of our own database.  It skips all the checks and conversions done
+        by the constructor, just dropping None values and any names that are
+        not in the given set of fields.
+        """
+        bso = dict.__new__(cls)
+        for name, value in row:
+            if value is not None and name in fields:
+                bso[name] = value
+        return bso
+
     def __str__(self):
         fields = dict((k, v) for (k, v) in self.iteritems() if k != 'payload')
         return "BSO(%s)" % (json.dumps(fields, sort_keys=True),)
@@ -0,0 +1,249 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Opt-in profiling of the storage calls made while handling each request.
+
+The metrics_timer decorator from mozsvc gives us a total time for a handful
+of methods, but it doesn't tell us which of the several queries made by a
+single request is the slow one.  When enabled via the "profiler.enabled"
+setting, this module records the count and duration of each call in the
+following categories:
+
+  db:         database queries, by queryName, plus transaction commits
+  memcache:   round-trips to memcached, by command
+  lock:       time spent waiting to acquire a collection lock
+  serialize:  time spent rendering the response body
+
+The timings for each request are reported in a "Server-Timing" response
+header, and are also aggregated into a set of in-process histograms that
+can be read as JSON from the "/__profile__" endpoint.
+
+Profiling is tracked per-thread, so it only covers work done by the thread
+handling the request.  Response bodies that are streamed out lazily are
+rendered after the response headers have been sent, and are not included.
+"""
+
+import timeit
+import threading
+import functools
+import contextlib
+from collections import OrderedDict
+
+from pyramid.settings import asbool
+
+
+# Upper bounds of the histogram buckets, in milliseconds.
+# Anything slower than the last bound goes into an overflow bucket.
+HISTOGRAM_BUCKETS = (
+    0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+)
+
+_tldata = threading.local()
+
+
+class RequestProfile(object):
+    """Timings of the calls made while handling a single request."""
+
+    def __init__(self):
+        self.start_time = timeit.default_timer()
+        self.duration = None
+        self.calls = OrderedDict()
+
+    def record(self, category, name, duration):
+        """Record a single call taking the given duration, in seconds."""
+        key = "%s.%s" % (category, name)
+        try:
+            self.calls[key].append(duration)
+        except KeyError:
+            self.calls[key] = [duration]
+
+    def finish(self):
+        """Mark the request as complete."""
+        self.duration = timeit.default_timer() - self.start_time
+
+    def get_server_timing(self):
+        """Get the recorded timings as a Server-Timing header value."""
+        entries = []
+        for key, durations in self.calls.iteritems():
+            entry = "%s;dur=%.2f;desc=\"%d\""
+            entries.append(entry % (key, sum(durations) * 1000,
+                                    len(durations)))
+        if self.duration is not None:
+            entries.append("total;dur=%.2f" % (self.duration * 1000,))
+        return ", ".join(entries)
+
+
+class ProfileStats(object):
+    """Histograms of the call timings from all profiled requests.
+
+    This aggregates the timings from each RequestProfile into a histogram
+    per type of call, with fixed bucket boundaries given in milliseconds.
+    It is safe to use from multiple threads.
+    """
+
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._num_requests = 0
+        self._histograms = {}
+
+    def add(self, profile):
+        """Add the timings from the given RequestProfile."""
+        with self._lock:
+            self._num_requests += 1
+            for key, durations in profile.calls.iteritems():
+                for duration in durations:
+                    self._add_timing(key, duration)
+            if profile.duration is not None:
+                self._add_timing("total", profile.duration)
+
+    def _add_timing(self, key, duration):
+        try:
+            histogram = self._histograms[key]
+        except KeyError:
+            histogram = self._histograms[key] = {
+                "count": 0,
+                "total_ms": 0,
+                "counts": [0] * (len(self.buckets) + 1),
+            }
+        duration_ms = duration * 1000
+        histogram["count"] += 1
+        histogram["total_ms"] += duration_ms
+        for i, bound in enumerate(self.buckets):
+            if duration_ms <= bound:
+                histogram["counts"][i] += 1
+                break
+        else:
+            histogram["counts"][-1] += 1
+
+    def snapshot(self):
+        """Get a JSON-able copy of the current state of the histograms."""
+        with self._lock:
+            histograms = {}
+            for key, histogram in self._histograms.iteritems():
+                histogram = histogram.copy()
+                histogram["counts"] = list(histogram["counts"])
+                histograms[key] = histogram
+            return {
+                "requests": self._num_requests,
+                "buckets_ms": list(self.buckets),
+                "timings": histograms,
+            }
+
+    def reset(self):
+        """Discard all the timings collected so far."""
+        with self._lock:
+            self._num_requests = 0
+            self._histograms.clear()
+
+
+def start_profile():
+    """Start profiling calls made by the current thread."""
+    profile = _tldata.profile = RequestProfile()
+    return profile
+
+
+def stop_profile():
+    """Stop profiling calls made by the current thread."""
+    profile = getattr(_tldata, "profile", None)
+    if profile is not None:
+        del _tldata.profile
+        profile.finish()
+    return profile
+
+
+def get_current_profile():
+    """Get the RequestProfile for the current thread, or None if not active."""
+    return getattr(_tldata, "profile", None)
+
+
+class profile_timer(object):
+    """Decorator/context-manager to record the time spent in chunks of code.
+
+    This works much like the metrics_timer class from mozsvc, but records
+    the timings into the RequestProfile for the current thread, under the
+    given category and name.  When no profile is active it does nothing.
+
+    When applied as a decorator with no name, the first argument after
+    "self" is used as the name, so that e.g. methods executing named
+    queries can be profiled by query name.
+    """
+
+    def __init__(self, category, name=None):
+        self.category = category
+        self.name = name
+
+    # When used as a context-manager, times the enclosed code.
+
+    def __enter__(self):
+        self.profile = getattr(_tldata, "profile", None)
+        if self.profile is not None:
+            self.start_time = timeit.default_timer()
+        return self
+
+    def __exit__(self, exc_typ=None, exc_val=None, exc_tb=None):
+        if self.profile is not None:
+            duration = timeit.default_timer() - self.start_time
+            self.profile.record(self.category, self.name, duration)
+            self.profile = None
+
+    # When called, applies itself as a function decorator.
+
+    def __call__(self, func):
+
+        @functools.wraps(func)
+        def profiled_func(*args, **kwds):
+            # We can't use "with self" here since that stores state on
+            # the object, and hence plays badly with threading or recursion.
+            profile = getattr(_tldata, "profile", None)
+            if profile is None:
+                return func(*args, **kwds)
+            start_time = timeit.default_timer()
+            try:
+                return func(*args, **kwds)
+            finally:
+                duration = timeit.default_timer() - start_time
+                name = self.name or args[1]
+                profile.record(self.category, name, duration)
+
+        return profiled_func
+
+
+@contextlib.contextmanager
+def profiled_enter(category, name, context):
+    """Enter the given context manager, recording how long that takes.
+
+    This is useful for recording time spent waiting on a lock, separately
+    from the time spent executing the code that is protected by the lock.
+    """
+    profile = getattr(_tldata, "profile", None)
+    start_time = timeit.default_timer()
+    with context as value:
+        if profile is not None:
+            duration = timeit.default_timer() - start_time
+            profile.record(category, name, duration)
+        yield value
+
+
+def get_profile_stats(request):
+    """View returning the aggregated profile histograms as JSON."""
+    return request.registry.profile_stats.snapshot()
+
+
+def is_profiler_enabled(settings):
+    """Check whether profiling is enabled in the given settings."""
+    return asbool(settings.get("profiler.enabled", False))
+
+
+def includeme(config):
+    """Include the profiler stats view into the given config.
+
+    The tween that collects the per-request profiles is installed along
+    with the other syncstorage tweens.
+    """
+    config.registry.profile_stats = ProfileStats()
+    if is_profiler_enabled(config.registry.settings):
+        config.add_route("profile_stats", "/__profile__")
+        config.add_view(get_profile_stats, route_name="profile_stats",
+                        request_method="GET", renderer="json")
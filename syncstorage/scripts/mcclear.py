@@ -33,7 +33,7 @@ def clear_memcache_data(config_file, input_file):
     config = syncstorage.get_configurator({"__file__": config_file})
 
     # Search all configured storages to find one that uses memcached.
-    # We assume that all storages share a single memcached server, and
+    # We assume that all storages share the same memcached servers, and
     # so we can use this single instance as a representative.  This is
     # how things are deployed at Mozilla, but is not guaranteed by the code.
     for _, backend in get_all_storages(config):
@@ -41,15 +41,15 @@ def clear_memcache_data(config_file, input_file):
             break
     else:
         raise RuntimeError("No memcached storage backends found.")
-    logger.debug("Using memcache server at %r", backend.cache.pool.server)
+    logger.debug("Using memcache servers at %r", backend.cache.servers)
 
     with maybe_open(input_file, "rt") as input_fileobj:
         for uid in input_fileobj:
             uid = uid.strip()
             if uid:
                 logger.info("Clearing data for %s", uid)
-                for key in backend.iter_cache_keys(uid):
-                    backend.cache.delete(key)
+                for server, key in backend.iter_cache_locations(uid):
+                    backend.cache.delete(key, server=server)
                 logger.debug("Cleared data for %s", uid)
 
     logger.info("Finished clearing memcache data")
@@ -32,7 +32,7 @@ def read_memcache_data(config_file, input_file, output_file):
     config = syncstorage.get_configurator({"__file__": config_file})
 
     # Search all configured storages to find one that uses memcached.
-    # We assume that all storages share a single memcached server, and
+    # We assume that all storages share the same memcached servers, and
     # so we can use this single instance as a representative.  This is
     # how things are deployed at Mozilla, but is not guaranteed by the code.
     for _, backend in get_all_storages(config):
@@ -40,7 +40,7 @@ def read_memcache_data(config_file, input_file, output_file):
             break
     else:
         raise RuntimeError("No memcached storage backends found.")
-    logger.debug("Using memcache server at %r", backend.cache.pool.server)
+    logger.debug("Using memcache servers at %r", backend.cache.servers)
 
     with maybe_open(input_file, "rt") as input_fileobj:
         with maybe_open(output_file, "wt") as output_fileobj:
@@ -49,10 +49,16 @@ def read_memcache_data(config_file, input_file, output_file):
                 uid = uid.strip()
                 if uid:
                     logger.info("Reading data for %s", uid)
-                    for key in backend.iter_cache_keys(uid):
-                        value = backend.cache.get(key)
-                        if value is not None:
+                    locations = backend.iter_cache_locations(uid)
+                    for server, key in locations:
+                        value = backend.cache.get(key, server=server)
+                        if value is None:
+                            continue
+                        if server == backend.cache.get_server(key):
                             output_fileobj.write("%s %s\n" % (key, value))
+                        else:
+                            logger.warning("Stale data for %s on %s",
+                                           key, server)
                     logger.debug("Read data for %s", uid)
 
     logger.info("Finished reading memcache data")
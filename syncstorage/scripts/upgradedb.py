@@ -0,0 +1,81 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Database upgrade script for SyncStorage.
+
+This script takes a syncstorage config file and loops through each SQL
+storage backend therein, adding any columns that are missing from its
+existing tables.  It should be run after upgrading to a version of the
+code that adds new columns, before the new version starts taking writes.
+It is safe to run more than once.
+
+"""
+
+import os
+import logging
+import optparse
+
+import syncstorage.scripts
+from syncstorage.storage import get_all_storages
+from syncstorage.storage.sql import SQLStorage
+
+
+logger = logging.getLogger(__name__)
+
+
+def upgrade_databases(config_file):
+    """Upgrade the tables of all SQL backends in the given config file."""
+    logger.info("Upgrading databases")
+    logger.debug("Using config file %r", config_file)
+    config = syncstorage.scripts.load_configurator(config_file)
+
+    upgraded = set()
+    for hostname, backend in get_all_storages(config):
+        # Look through any caching layer to the underlying SQL storage.
+        backend = getattr(backend, "storage", backend)
+        if not isinstance(backend, SQLStorage):
+            logger.debug("Skipping non-SQL backend for %s", hostname)
+            continue
+        # Several hostnames may share the same database.
+        if backend.sqluri in upgraded:
+            continue
+        upgraded.add(backend.sqluri)
+        logger.debug("Upgrading backend for %s", hostname)
+        added = backend.dbconnector.add_missing_columns()
+        if added:
+            logger.info("Added columns for %s: %s", hostname,
+                        ", ".join(added))
+        else:
+            logger.debug("Backend for %s is up to date", hostname)
+
+    logger.info("Finished upgrading databases")
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and passes them on
+    to the upgrade_databases() function.
+    """
+    usage = "usage: %prog [options] config_file"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      help="Control verbosity of log messages")
+
+    opts, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.print_usage()
+        return 1
+
+    syncstorage.scripts.configure_script_logging(opts)
+
+    config_file = os.path.abspath(args[0])
+
+    upgrade_databases(config_file)
+    return 0
+
+
+if __name__ == "__main__":
+    syncstorage.scripts.run_script(main)
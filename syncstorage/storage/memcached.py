@@ -11,8 +11,9 @@ of storing entire collections in memcache without hitting the backend.
 
 The following memcached keys are used:
 
-    * userid:metadata         metadata about the storage and collections
-    * userid:c:<collection>   cached data for a particular collection
+    * userid:metadata             metadata about the storage and collections
+    * userid:c:<collection>       index of the cached data for a collection
+    * userid:c:<collection>:<n>   bucket of cached items for a collection
 
 A key prefix can also be defined to avoid clobbering unrelated data in a
 shared memcached setup.  It defaults to the empty string.
@@ -30,29 +31,85 @@ It has the following structure:
       },
     }
 
-For each collection to be stored in memcache, the corresponding key contains
-a JSON mapping from item ids to BSO objects along with a record of the last-
-modified timestamp for that collection:
+For each collection to be stored in memcache, the items are divided between
+a number of buckets according to a hash of their id.  This means that writing
+an item only needs to read and write the bucket that holds it, rather than
+the entire collection.  The "c:<collection>" key holds an index recording the
+last-modified timestamp of the collection and of each non-empty bucket:
 
     {
       "modified":   <last-modified timestamp for the collection>,
+      "nbuckets":   <number of buckets the items are divided between>,
+      "buckets": {
+        <bucket number>:  <last-modified timestamp for the bucket>,
+      }
+    }
+
+And each "c:<collection>:<n>" key holds a JSON mapping from item ids to BSO
+objects along with the last-modified timestamp for that bucket:
+
+    {
+      "modified":   <last-modified timestamp for the bucket>,
       "items": {
         <item id>:  <BSO object for that item>,
       }
     }
 
+Buckets are written before the index, and a bucket is only used if its
+timestamp matches the one in the index, so readers never see a partially-
+applied write.  The buckets are read together in a single multi-key request.
+An index in the old single-key format, with the items stored directly in
+it, is still understood and is converted to use buckets when next written.
+
 To avoid the cached data getting out of sync with the underlying storage, we
 explicitly mark the cache as dirty before performing any write operations.
 In the unlikely event of a mid-operation crash, we'll notice the dirty cache
 and fall back to the underlying store instead of using potentially inconsistent
 data from memcache.
+
+Since all of the keys for a user begin with their userid, users can be spread
+over several memcached servers by consistent hashing of the userid.  This
+keeps all of a user's data on a single server, so it can still be fetched
+in a single round-trip, and adding a server moves only a few of the users.
+
+Values are encoded as JSON by default, or optionally with msgpack, which is
+several times cheaper to encode and decode.  The encoding is recorded in the
+memcache flags of each value, so either can be read whatever is configured.
+This allows the encoding to be switched over without invalidating the cache.
+
+Values larger than a configurable threshold are compressed before being sent
+to memcache, using zlib or (if installed) lz4.  The compression is recorded
+in the memcache flags of each value so that it can be decoded correctly.
+
+A single request will typically read the metadata several times, e.g. when
+checking preconditions, checking quota and marking the collection as dirty.
+To avoid a round-trip for each of these, reads from memcache are memoized for
+as long as a collection lock is held, and the metadata is fetched together
+with any cached data for the collection in a single multi-key request.
+
+Clients that poll for their quota usage read the metadata over and over
+again, so it can also be kept in a small in-process cache for a fraction of
+a second.  This is only used for reading the total size, which may then miss
+writes made by other processes until the cached copy expires.  Timestamps
+are always read from memcache, since a stale one could cause a client to
+miss changes.  Writes from the same process discard the cached copy, and it
+is not used when reading the metadata in order to update it.
 """
 
 import time
+import zlib
+import bisect
+import struct
+import decimal
+import hashlib
+import logging
 import threading
+import traceback
 import contextlib
+import collections
 
-from syncstorage.util import get_timestamp, json_loads, json_dumps
+from syncstorage.util import Timestamp, get_timestamp, json_loads, json_dumps
+from syncstorage.profiler import profile_timer
 from syncstorage.storage import (SyncStorage,
                                  StorageError,
                                  ConflictError,
@@ -64,8 +121,21 @@ from syncstorage.storage import (SyncStorage,
 
 from pyramid.settings import aslist
 
-from mozsvc.storage.mcclient import MemcachedClient
+from mozsvc.exceptions import BackendError
+from mozsvc.storage.mcclient import MemcachedClient, MCClientPool
 
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+logger = logging.getLogger("syncstorage.storage.memcached")
 
 # Recalculate quota at most once per hour.
 SIZE_RECALCULATION_PERIOD = 60 * 60
@@ -73,14 +143,47 @@ SIZE_RECALCULATION_PERIOD = 60 * 60
 # Expire cache-based lock after five minutes.
 DEFAULT_CACHE_LOCK_TTL = 5 * 60
 
+# Flag bits set on memcache values to say how they were compressed.
+# The zlib flag is the same one used by python-memcached and pylibmc.
+FLAG_ZLIB = 1 << 3
+FLAG_LZ4 = 1 << 4
+
+# Flag bit set on memcache values to say that they're encoded with msgpack.
+# Values without it are encoded as JSON.
+FLAG_MSGPACK = 1 << 5
+
+# Compress values that are larger than this many bytes.
+DEFAULT_COMPRESS_THRESHOLD = 1024
+
+# Divide the items of each cached collection between this many keys.
+DEFAULT_CACHE_BUCKETS = 16
+
 # Grace period to allow between expiring of ttl's items, and deletion.
 TTL_EXPIRY_GRACE_PERIOD = 60 * 60 * 24  # 1 day, in seconds
 
+# Number of points on the hash ring for each memcached server.
+# This is the same number used by ketama, and gives an even spread of keys.
+HASH_RING_POINTS = 160
+
+DEFAULT_CACHE_SERVER = "127.0.0.1:11211"
+
+# Default lifetime of entries in the in-process cache, in seconds.
+DEFAULT_LOCAL_CACHE_TTL = 0.5
+
 
 def _key(*names):
     return ":".join(map(str, names))
 
 
+def _hash_key(key):
+    """Get the part of a key that determines which server holds it.
+
+    This is everything before the first colon, which for our keys is the
+    userid, so that all the keys for a user are kept on the same server.
+    """
+    return key.split(":", 1)[0]
+
+
 def bso_sort_key_index(bso):
     return (bso["sortindex"], bso["id"])
 
@@ -89,17 +192,542 @@ def bso_sort_key_modified(bso):
     return (bso["modified"], bso["id"])
 
 
+class JSONCodec(object):
+    """Codec for memcache values, using Decimal-aware JSON."""
+
+    flags = 0
+
+    def encode(self, value):
+        return json_dumps(value)
+
+    def decode(self, data):
+        return json_loads(data)
+
+
+class MsgpackCodec(object):
+    """Codec for memcache values, using msgpack.
+
+    The encoded data starts with a version byte, so that the format can be
+    changed in future.  Timestamps are stored as an integer number of
+    centiseconds, which is exact and much cheaper than parsing a decimal.
+    """
+
+    flags = FLAG_MSGPACK
+
+    VERSION = "\x01"
+
+    # Extension type codes for values that msgpack can't represent natively.
+    EXT_TIMESTAMP = 1
+    EXT_DECIMAL = 2
+
+    def encode(self, value):
+        return self.VERSION + msgpack.packb(value, use_bin_type=True,
+                                            default=self._encode_ext)
+
+    def decode(self, data):
+        if data[:1] != self.VERSION:
+            raise ValueError("unknown msgpack value version")
+        return msgpack.unpackb(data[1:], raw=False, ext_hook=self._decode_ext)
+
+    def _encode_ext(self, value):
+        if isinstance(value, Timestamp):
+            data = msgpack.packb(value.centiseconds)
+            return msgpack.ExtType(self.EXT_TIMESTAMP, data)
+        if isinstance(value, decimal.Decimal):
+            return msgpack.ExtType(self.EXT_DECIMAL, str(value))
+        raise TypeError("can't encode %r" % (value,))
+
+    def _decode_ext(self, code, data):
+        if code == self.EXT_TIMESTAMP:
+            return Timestamp(msgpack.unpackb(data))
+        if code == self.EXT_DECIMAL:
+            return decimal.Decimal(data)
+        return msgpack.ExtType(code, data)
+
+
+class HashRing(object):
+    """Ketama-style consistent hash ring for spreading keys over servers.
+
+    Each server is placed at several pseudo-random points on a circle, taken
+    from the md5 hash of its address, and each key belongs to the server at
+    the first point following the hash of that key.  Adding or removing a
+    server only moves the keys adjacent to its points, about 1/N of them,
+    and the assignment does not depend on the order in which servers are
+    listed.
+    """
+
+    def __init__(self, servers, points=HASH_RING_POINTS):
+        self.servers = sorted(set(servers))
+        if not self.servers:
+            raise ValueError("at least one memcached server is required")
+        ring = []
+        for server in self.servers:
+            # Each md5 digest gives four points on the ring.
+            for i in xrange(points // 4):
+                digest = hashlib.md5("%s-%d" % (server, i)).digest()
+                for point in struct.unpack("<4I", digest):
+                    ring.append((point, server))
+        ring.sort()
+        self._points = [point for point, _ in ring]
+        self._servers = [server for _, server in ring]
+
+    def get_server(self, hashkey):
+        """Get the server responsible for the given hash key."""
+        if len(self.servers) == 1:
+            return self.servers[0]
+        point = struct.unpack("<I", hashlib.md5(hashkey).digest()[:4])[0]
+        idx = bisect.bisect(self._points, point)
+        if idx == len(self._points):
+            idx = 0
+        return self._servers[idx]
+
+
+class LocalCache(object):
+    """Small in-process LRU cache of raw memcache items, with a short TTL.
+
+    This holds the (data, flags, casid) tuple for each key, or None if the
+    key was missing from memcache, for at most ttl seconds.  It is shared by
+    all threads in the process.  Entries that were fetched while a key was
+    being discarded are not stored, since they may already be out of date.
+    """
+
+    def __init__(self, size, ttl=DEFAULT_LOCAL_CACHE_TTL):
+        self.size = int(size)
+        self.ttl = float(ttl)
+        self.generation = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get the raw item for the given key, or raise KeyError."""
+        with self._lock:
+            expires, item = self._items.pop(key)
+            if expires < time.time():
+                raise KeyError(key)
+            self._items[key] = (expires, item)
+            return item
+
+    def set(self, key, item, generation):
+        """Store the raw item for the given key.
+
+        The generation must be the value of the generation attribute from
+        before the item was fetched; the item is not stored if any key has
+        been discarded since.
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._items.pop(key, None)
+            self._items[key] = (time.time() + self.ttl, item)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def discard(self, key):
+        """Discard any item stored for the given key."""
+        with self._lock:
+            self.generation += 1
+            self._items.pop(key, None)
+
+
+def get_value_codec(name):
+    """Get the memcache value codec with the given name."""
+    if name == "json":
+        return JSONCodec()
+    if name == "msgpack":
+        if msgpack is None:
+            raise ValueError("msgpack encoding requires the msgpack module")
+        return MsgpackCodec()
+    raise ValueError("unknown value codec: %r" % (name,))
+
+
 class MemcachedClient(MemcachedClient):
-    """MemcachedClient that can handle decimal.Decimal instances."""
+    """MemcachedClient that can handle decimal.Decimal instances.
+
+    It can also memoize the values read by the current thread, so that
+    repeated reads of the same key during a single request don't each need
+    a round-trip to memcache.  See the memoize() method for details.
+
+    Values are encoded with the given codec, which may be the name of one
+    ("json" or "msgpack") or a codec object with encode() and decode()
+    methods and the flags to identify its values.  Values larger than
+    compress_threshold bytes are compressed, using the named compression
+    scheme: "zlib", "lz4" or "none".  Values are always decoded according
+    to their flags, whatever codec and compression scheme are configured.
+
+    Keys can be spread over several memcached servers, given as a list or
+    as a whitespace-separated string.  Each key is assigned to a server by
+    consistent hashing of the part of the key before its first colon, so
+    all the keys for a userid are held by the same server.  Each server
+    has its own pool of connections.  While moving to a new list of servers
+    the old list can be given as previous_servers, so that the server that
+    used to hold a key can still be found by get_servers().
+
+    If local_cache_size is given, the values read by gets() for keys ending
+    in one of local_cache_suffixes are kept in an in-process LocalCache for
+    local_cache_ttl seconds.  They may be stale by up to that long, except
+    that writing a key through this client discards its cached value.  See
+    the bypass_local_cache() method for reading without it.
+    """
+
+    def __init__(self, servers=None, *args, **kwds):
+        codec = kwds.pop("codec", "json")
+        compression = kwds.pop("compression", "zlib")
+        compress_threshold = kwds.pop("compress_threshold",
+                                      DEFAULT_COMPRESS_THRESHOLD)
+        previous_servers = kwds.pop("previous_servers", None)
+        local_cache_size = int(kwds.pop("local_cache_size", 0))
+        local_cache_ttl = kwds.pop("local_cache_ttl", DEFAULT_LOCAL_CACHE_TTL)
+        local_cache_suffixes = kwds.pop("local_cache_suffixes", ())
+        servers = self._parse_servers(servers or DEFAULT_CACHE_SERVER)
+        super(MemcachedClient, self).__init__(servers[0], *args, **kwds)
+        self.servers = servers
+        self.ring = HashRing(servers)
+        self.previous_ring = None
+        if previous_servers:
+            previous_servers = self._parse_servers(previous_servers)
+            self.previous_ring = HashRing(previous_servers)
+            servers = servers + previous_servers
+        # The base class created the pool for the first server.
+        self.pools = {self.servers[0]: self.pool}
+        for server in servers:
+            if server not in self.pools:
+                self.pools[server] = MCClientPool(server, self.pool.maxsize,
+                                                  self.pool.timeout)
+        if compression not in ("zlib", "lz4", "none"):
+            raise ValueError("unknown compression: %r" % (compression,))
+        if compression == "lz4" and lz4_block is None:
+            raise ValueError("lz4 compression requires the lz4 module")
+        self.compression = compression
+        self.compress_threshold = int(compress_threshold)
+        if isinstance(codec, basestring):
+            codec = get_value_codec(codec)
+        self.codec = codec
+        self._decoders = {}
+        self.local_cache = None
+        if local_cache_size > 0:
+            self.local_cache = LocalCache(local_cache_size, local_cache_ttl)
+        self.local_cache_suffixes = tuple(local_cache_suffixes)
+        self._tldata = threading.local()
+
+    def _parse_servers(self, servers):
+        """Parse a list of server addresses, removing any duplicates."""
+        parsed = []
+        for server in aslist(servers):
+            if server not in parsed:
+                parsed.append(server)
+        return parsed
+
+    def get_server(self, key):
+        """Get the address of the server that holds the given key."""
+        return self.ring.get_server(_hash_key(key))
+
+    def get_servers(self, key):
+        """Get the addresses of all servers that may hold the given key.
+
+        This is the server that holds it now, followed by the server that
+        held it under previous_servers if that is a different one.
+        """
+        servers = [self.get_server(key)]
+        if self.previous_ring is not None:
+            server = self.previous_ring.get_server(_hash_key(key))
+            if server not in servers:
+                servers.append(server)
+        return servers
+
+    def _group_by_server(self, keys):
+        """Group the given keys into a dict mapping servers to keys."""
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.get_server(key), []).append(key)
+        return groups
+
+    @contextlib.contextmanager
+    def _connect(self, server=None):
+        """Context mananager for getting a connection to the given server.
+
+        If no server is given then the first configured server is used.
+        """
+        pool = self.pools[server or self.servers[0]]
+        # This mirrors the error handling of the base class, but uses the
+        # connection pool for the requested server.
+        try:
+            with pool.reserve() as mc:
+                try:
+                    yield mc
+                except (EnvironmentError, RuntimeError):
+                    if mc is not None:
+                        mc.disconnect()
+                    raise
+        except (EnvironmentError, RuntimeError):
+            err = traceback.format_exc()
+            logger.error(err)
+            raise BackendError(str(err))
 
     def _encode_value(self, value):
-        value = json_dumps(value)
+        value = self.codec.encode(value)
+        flags = self.codec.flags
+        if self.compression != "none":
+            if len(value) > self.compress_threshold:
+                value, flags = self._compress_value(value)
         if len(value) > self.max_value_size:
             raise ValueError("value too long")
-        return value, 0
+        return value, flags
+
+    def _compress_value(self, value):
+        """Compress an encoded value, returning the new value and its flags.
+
+        If compression doesn't make the value any smaller then it is left
+        uncompressed.
+        """
+        if self.compression == "lz4":
+            compressed, flags = lz4_block.compress(value), FLAG_LZ4
+        else:
+            compressed, flags = zlib.compress(value), FLAG_ZLIB
+        if len(compressed) >= len(value):
+            return value, self.codec.flags
+        return compressed, self.codec.flags | flags
 
     def _decode_value(self, value, flags):
-        return json_loads(value)
+        if flags & FLAG_ZLIB:
+            value = zlib.decompress(value)
+        elif flags & FLAG_LZ4:
+            if lz4_block is None:
+                raise ValueError("lz4 compression requires the lz4 module")
+            value = lz4_block.decompress(value)
+        return self._get_decoder(flags & FLAG_MSGPACK).decode(value)
+
+    def _get_decoder(self, flags):
+        """Get the codec for decoding values with the given flags."""
+        if flags == self.codec.flags:
+            return self.codec
+        try:
+            return self._decoders[flags]
+        except KeyError:
+            if flags & FLAG_MSGPACK:
+                decoder = get_value_codec("msgpack")
+            else:
+                decoder = get_value_codec("json")
+            self._decoders[flags] = decoder
+            return decoder
+
+    @contextlib.contextmanager
+    def memoize(self):
+        """Context manager to memoize the reads made by the current thread.
+
+        While this is active, the raw value and casid fetched for each key
+        by gets(), gets_multi() or prefetch() are remembered, and later reads
+        of that key are served from memory.  Each read still decodes a fresh
+        copy of the value, so callers are free to modify what they get back.
+        Writing to a key through this client discards its memoized value.
+
+        Changes made by other clients will not be seen until the context
+        exits, so it should only wrap a short unit of work such as a single
+        request.  It is reentrant.
+        """
+        if getattr(self._tldata, "memo", None) is not None:
+            yield None
+            return
+        self._tldata.memo = {}
+        try:
+            yield None
+        finally:
+            self._tldata.memo = None
+
+    @contextlib.contextmanager
+    def bypass_local_cache(self):
+        """Context manager to stop the current thread using the local cache.
+
+        While this is active, reads by the current thread are not served from
+        the in-process cache, but they still refresh the values held in it.
+        Use it when the values must be current, e.g. when about to CAS them.
+        It is reentrant.
+        """
+        bypass = getattr(self._tldata, "bypass_local_cache", False)
+        self._tldata.bypass_local_cache = True
+        try:
+            yield None
+        finally:
+            self._tldata.bypass_local_cache = bypass
+
+    def _use_local_cache(self, key):
+        """Check whether the given key may be kept in the local cache."""
+        if self.local_cache is None:
+            return False
+        return key.endswith(self.local_cache_suffixes)
+
+    def gets(self, key):
+        """Get the current value and casid for the given key."""
+        return self.gets_multi((key,))[key]
+
+    def gets_multi(self, keys):
+        """Get the current values and casids for the given keys.
+
+        This returns a dict mapping each key to a (value, casid) tuple, which
+        will be (None, None) if the key is not present.  Any keys that have
+        not been memoized are fetched in a single round-trip.
+        """
+        items = {}
+        for key, raw_item in self._get_raw_items(keys).iteritems():
+            if raw_item is None:
+                items[key] = (None, None)
+            else:
+                data, flags, casid = raw_item
+                items[key] = (self._decode_value(data, flags), casid)
+        return items
+
+    def prefetch(self, keys):
+        """Fetch the given keys into the memo in a single round-trip.
+
+        This does nothing if memoization is not currently active.
+        """
+        if getattr(self._tldata, "memo", None) is not None:
+            self._get_raw_items(keys)
+
+    def _get_raw_items(self, keys):
+        """Get the (data, flags, casid) tuple for each key, or None if missing.
+
+        Memoized keys are served from memory, then any that are held in the
+        local cache, and the rest are fetched from memcache and added to the
+        memo if it is active, and to the local cache if they belong in it.
+        """
+        memo = getattr(self._tldata, "memo", None)
+        if memo is None:
+            memo = {}
+        bypass = getattr(self._tldata, "bypass_local_cache", False)
+        items = {}
+        missing_keys = []
+        for key in keys:
+            try:
+                items[key] = memo[key]
+            except KeyError:
+                if not bypass and self._use_local_cache(key):
+                    try:
+                        items[key] = memo[key] = self.local_cache.get(key)
+                        continue
+                    except KeyError:
+                        pass
+                missing_keys.append(key)
+        if missing_keys:
+            if self.local_cache is not None:
+                generation = self.local_cache.generation
+            if len(missing_keys) == 1:
+                fetched_items = self._fetch_raw_item(missing_keys[0])
+            else:
+                fetched_items = self._fetch_raw_items(missing_keys)
+            for key in missing_keys:
+                items[key] = memo[key] = fetched_items.get(key)
+                if self._use_local_cache(key):
+                    self.local_cache.set(key, items[key], generation)
+        return items
+
+    @profile_timer("memcache", "gets")
+    def _fetch_raw_item(self, key):
+        with self._connect(self.get_server(key)) as mc:
+            res = mc.gets(self._encode_key(key))
+        if res is None:
+            return {}
+        return {key: res}
+
+    @profile_timer("memcache", "gets_multi")
+    def _fetch_raw_items(self, keys):
+        items = {}
+        for server, server_keys in self._group_by_server(keys).iteritems():
+            with self._connect(server) as mc:
+                encoded_keys = [self._encode_key(key) for key in server_keys]
+                encoded_items = mc.gets_multi(encoded_keys)
+            for key, res in encoded_items.iteritems():
+                items[self._decode_key(key)] = res
+        return items
+
+    def _forget(self, key, missing=False):
+        """Discard any memoized value for the given key.
+
+        If missing is True then the key is instead memoized as being absent.
+        Any value held in the local cache is discarded either way.
+        """
+        if self._use_local_cache(key):
+            self.local_cache.discard(key)
+        memo = getattr(self._tldata, "memo", None)
+        if memo is not None:
+            if missing:
+                memo[key] = None
+            else:
+                memo.pop(key, None)
+
+    @profile_timer("memcache", "get")
+    def get(self, key, server=None):
+        """Get the value stored under the given key.
+
+        The value is read from the server that holds the key, unless some
+        other server is given explicitly.
+        """
+        with self._connect(server or self.get_server(key)) as mc:
+            res = mc.get(self._encode_key(key))
+        if res is None:
+            return None
+        data, flags = res
+        return self._decode_value(data, flags)
+
+    @profile_timer("memcache", "get_multi")
+    def get_multi(self, keys):
+        items = {}
+        for server, server_keys in self._group_by_server(keys).iteritems():
+            with self._connect(server) as mc:
+                encoded_keys = [self._encode_key(key) for key in server_keys]
+                encoded_items = mc.get_multi(encoded_keys)
+            for key, res in encoded_items.iteritems():
+                data, flags = res
+                value = self._decode_value(data, flags)
+                items[self._decode_key(key)] = value
+        return items
+
+    # Writes must discard the memoized value before they're sent, so that
+    # callers who modified a value but failed to write it can't see it.
+
+    @profile_timer("memcache", "set")
+    def set(self, key, value, time=0):
+        return self._store("set", key, value, time)
+
+    @profile_timer("memcache", "add")
+    def add(self, key, value, time=0):
+        return self._store("add", key, value, time)
+
+    @profile_timer("memcache", "replace")
+    def replace(self, key, value, time=0):
+        return self._store("replace", key, value, time)
+
+    @profile_timer("memcache", "cas")
+    def cas(self, key, value, casid, time=0):
+        # Memcached's CAS only works properly on existing keys.
+        # Fortunately ADD has the same semantics for missing keys.
+        if casid is None:
+            return self._store("add", key, value, time)
+        return self._store("cas", key, value, time, casid)
+
+    def _store(self, command, key, value, time, casid=None):
+        """Send a storage command for the key to the server that holds it."""
+        self._forget(key)
+        encoded_key = self._encode_key(key)
+        data, flags = self._encode_value(value)
+        with self._connect(self.get_server(key)) as mc:
+            if command == "cas":
+                res = mc.cas(encoded_key, data, casid, time, flags)
+            else:
+                res = getattr(mc, command)(encoded_key, data, time, flags)
+        return res == "STORED"
+
+    @profile_timer("memcache", "delete")
+    def delete(self, key, server=None):
+        """Delete the value stored under the given key.
+
+        The value is deleted from the server that holds the key, unless some
+        other server is given explicitly.
+        """
+        self._forget(key)
+        with self._connect(server or self.get_server(key)) as mc:
+            res = mc.delete(self._encode_key(key))
+        self._forget(key, missing=True)
+        return res == "DELETED"
 
 
 class MemcachedStorage(SyncStorage):
@@ -109,7 +737,10 @@ class MemcachedStorage(SyncStorage):
     a caching layer.  You may specify the following arguments:
 
         * storage:  the underlying SyncStorage object that is to be wrapped.
-        * cache_servers:  a list of memcached server URLs.
+        * cache_servers:  a list of memcached server URLs.  Users are spread
+                          over these servers by consistent hashing.
+        * cache_previous_servers:  the list of memcached servers used before
+                                   the current one, while moving to it.
         * cached_collections:  a list of names of collections that should
                                be duplicated into memcache for fast access.
         * cache_only_collections:  a list of names of collections that should
@@ -119,16 +750,41 @@ class MemcachedStorage(SyncStorage):
                              useful for namespacing in shared cache setups.
         * cache_pool_size:  the maximum number of active memcache clients.
         * cache_pool_timeout:  the maximum lifetime of each memcache client.
+        * cache_buckets:  the number of buckets into which the items of each
+                          cached collection are divided.
+        * cache_compression:  how to compress large values: "zlib", "lz4"
+                              or "none".
+        * cache_compress_threshold:  the size in bytes above which values
+                                     are compressed.
+        * cache_value_codec:  how to encode values: "json" or "msgpack".
+        * cache_local_size:  the number of users whose metadata is kept in
+                             an in-process cache for reading their total
+                             size; zero to disable it.
+        * cache_local_ttl:  how long to keep the metadata in the in-process
+                            cache, in seconds.  Reads of the total size may
+                            miss other processes' writes for this long.
 
     """
 
     def __init__(self, storage, cache_servers=None, cache_key_prefix="",
                  cache_pool_size=None, cache_pool_timeout=60,
                  cached_collections=(), cache_only_collections=(),
-                 cache_lock=False, cache_lock_ttl=None, **kwds):
+                 cache_lock=False, cache_lock_ttl=None,
+                 cache_buckets=DEFAULT_CACHE_BUCKETS, cache_compression="zlib",
+                 cache_compress_threshold=DEFAULT_COMPRESS_THRESHOLD,
+                 cache_value_codec="json", cache_previous_servers=None,
+                 cache_local_size=0, cache_local_ttl=DEFAULT_LOCAL_CACHE_TTL,
+                 **kwds):
         self.storage = storage
-        self.cache = MemcachedClient(cache_servers, cache_key_prefix,
-                                     cache_pool_size, cache_pool_timeout)
+        self.cache = MemcachedClient(
+            cache_servers, cache_key_prefix, cache_pool_size,
+            cache_pool_timeout, codec=cache_value_codec,
+            previous_servers=cache_previous_servers,
+            local_cache_size=cache_local_size,
+            local_cache_ttl=cache_local_ttl,
+            local_cache_suffixes=(":metadata",),
+            compression=cache_compression,
+            compress_threshold=cache_compress_threshold)
         self.cached_collections = {}
         for collection in aslist(cached_collections):
             colmgr = CachedManager(self, collection)
@@ -142,6 +798,7 @@ class MemcachedStorage(SyncStorage):
             self.cache_lock_ttl = DEFAULT_CACHE_LOCK_TTL
         else:
             self.cache_lock_ttl = cache_lock_ttl
+        self.cache_buckets = int(cache_buckets)
         # Keep a threadlocal to track the currently-held locks.
         # This is needed to make the read locking API reentrant.
         self._tldata = threading.local()
@@ -161,6 +818,21 @@ class MemcachedStorage(SyncStorage):
             for key in colmgr.iter_cache_keys(userid):
                 yield key
 
+    def iter_cache_locations(self, userid):
+        """Iterator over all potential cache locations for the given userid.
+
+        This method yields a (server, key) pair for each of the keys yielded
+        by iter_cache_keys().  While moving to a new list of cache servers,
+        keys that were held by a different server under the previous list
+        are yielded once for each server, current server first, so that any
+        stale copies left on the old server can be found.
+        """
+        # All of the keys for a user are held by the same servers.
+        servers = self.cache.get_servers(_key(userid))
+        for key in self.iter_cache_keys(userid):
+            for server in servers:
+                yield server, key
+
     def _get_collection_manager(self, collection):
         """Get a collection-management object for the named collection.
 
@@ -191,16 +863,54 @@ class MemcachedStorage(SyncStorage):
     def lock_for_read(self, userid, collection):
         """Acquire a shared read lock on the named collection."""
         if self.cache_lock or collection in self.cache_only_collections:
-            return self._lock_in_memcache(userid, collection)
+            lock = self._lock_in_memcache(userid, collection)
         else:
-            return self.storage.lock_for_read(userid, collection)
+            lock = self.storage.lock_for_read(userid, collection)
+        return self._memoize_while_locked(lock)
 
     def lock_for_write(self, userid, collection):
         """Acquire an exclusive write lock on the named collection."""
         if self.cache_lock or collection in self.cache_only_collections:
-            return self._lock_in_memcache(userid, collection)
+            lock = self._lock_in_memcache(userid, collection)
         else:
-            return self.storage.lock_for_write(userid, collection)
+            lock = self.storage.lock_for_write(userid, collection)
+        return self._memoize_while_locked(lock, (userid, collection))
+
+    @contextlib.contextmanager
+    def _memoize_while_locked(self, lock, write_locked=None):
+        """Helper method to memoize cache reads while a lock is held.
+
+        A collection lock is held for the duration of a request, and nobody
+        else can modify the collection while we hold it.  So it's safe to
+        re-use the cached data and timestamp for that collection without
+        going back to memcache each time they're needed.
+
+        For a write lock, the (userid, collection) tuple is recorded while
+        the lock is held, so that we don't prefetch all of the collection's
+        cached items when a write will only need to read a few of them.
+        The in-process cache is bypassed, since the metadata read under a
+        write lock is about to be updated with CAS.
+        """
+        with lock as value:
+            with self.cache.memoize():
+                write_locks = self._get_write_locks()
+                if write_locked is None or write_locked in write_locks:
+                    yield value
+                    return
+                write_locks.add(write_locked)
+                try:
+                    with self.cache.bypass_local_cache():
+                        yield value
+                finally:
+                    write_locks.remove(write_locked)
+
+    def _get_write_locks(self):
+        """Get the set of collections write-locked by the current thread."""
+        try:
+            return self._tldata.write_locks
+        except AttributeError:
+            self._tldata.write_locks = set()
+            return self._tldata.write_locks
 
     @contextlib.contextmanager
     def _lock_in_memcache(self, userid, collection):
@@ -236,7 +946,8 @@ class MemcachedStorage(SyncStorage):
     def get_storage_timestamp(self, userid):
         """Returns the last-modified timestamp for the entire storage."""
         # Try to use the cached value.
-        ts = self._get_metadata(userid)["modified"]
+        with self.cache.bypass_local_cache():
+            ts = self._get_metadata(userid)["modified"]
         # Fall back to live data if it's dirty.
         if ts is None:
             ts = self.storage.get_storage_timestamp(userid)
@@ -249,16 +960,27 @@ class MemcachedStorage(SyncStorage):
 
     def get_collection_timestamps(self, userid):
         """Returns the collection timestamps for a user."""
-        # Try to use the cached value.
-        timestamps = self._get_metadata(userid)["collections"]
-        # Fall back to live data for any collections that are dirty.
-        for collection, ts in timestamps.items():
-            if ts is None:
-                colmgr = self._get_collection_manager(collection)
+        with self.cache.memoize():
+            # Try to use the cached value.
+            with self.cache.bypass_local_cache():
+                timestamps = self._get_metadata(userid)["collections"]
+            # Fall back to live data for any collections that are dirty.
+            # Any that are cached in memcache can be fetched all at once.
+            dirty_colmgrs = []
+            for collection, ts in timestamps.iteritems():
+                if ts is None:
+                    colmgr = self._get_collection_manager(collection)
+                    dirty_colmgrs.append(colmgr)
+            keys = []
+            for colmgr in dirty_colmgrs:
+                keys.extend(colmgr.iter_cache_keys(userid, False))
+            self.cache.prefetch(keys)
+            for colmgr in dirty_colmgrs:
                 try:
-                    timestamps[collection] = colmgr.get_timestamp(userid)
+                    ts = colmgr.get_timestamp(userid)
+                    timestamps[colmgr.collection] = ts
                 except CollectionNotFoundError:
-                    del timestamps[collection]
+                    del timestamps[colmgr.collection]
         return timestamps
 
     def get_collection_counts(self, userid):
@@ -293,7 +1015,12 @@ class MemcachedStorage(SyncStorage):
         return sizes
 
     def get_total_size(self, userid, recalculate=False):
-        """Returns the total size of a user's storage data."""
+        """Returns the total size of a user's storage data.
+
+        Unless a write lock is held, this may be served from the in-process
+        cache, and so miss writes made by other processes for up to
+        cache_local_ttl seconds.
+        """
         return self._get_metadata(userid, recalculate)["size"]
 
     def delete_storage(self, userid):
@@ -310,7 +1037,11 @@ class MemcachedStorage(SyncStorage):
         """Returns the last-modified timestamp for the named collection."""
         # It's likely cheaper to read all cached timestamps out of memcache
         # than to read just the single timestamp from the database.
-        timestamps = self.get_collection_timestamps(userid)
+        # If we're likely to need the cached collection data later in the
+        # request, fetch it at the same time.
+        with self.cache.bypass_local_cache():
+            self._prefetch_metadata(userid, collection)
+            timestamps = self._get_metadata(userid)["collections"]
         try:
             ts = timestamps[collection]
         except KeyError:
@@ -495,20 +1226,36 @@ class MemcachedStorage(SyncStorage):
                 self.cache.cas(key, data, casid)
         return data
 
+    def _prefetch_metadata(self, userid, collection):
+        """Prefetch the metadata along with any cached collection data.
+
+        If cache reads are being memoized, this fetches the metadata and any
+        cached data for the named collection in a single round-trip, so that
+        they can both be used later without going back to memcache.  If the
+        collection is locked for writing then only its index is fetched,
+        since a write only needs the buckets holding the items it changes.
+        """
+        keys = [_key(userid, "metadata")]
+        colmgr = self._get_collection_manager(collection)
+        include_items = (userid, collection) not in self._get_write_locks()
+        keys.extend(colmgr.iter_cache_keys(userid, include_items))
+        self.cache.prefetch(keys)
+
     def _update_total_size(self, userid, size):
         """Update the cached value for total storage size."""
         key = _key(userid, "metadata")
-        data, casid = self.cache.gets(key)
-        if data is None:
-            self._get_metadata(userid)
+        with self.cache.bypass_local_cache():
             data, casid = self.cache.gets(key)
+            if data is None:
+                self._get_metadata(userid)
+                data, casid = self.cache.gets(key)
         data["last_size_recalc"] = int(time.time())
         data["size"] = size
         self.cache.cas(key, data, casid)
 
     def _recalculate_total_size(self, userid):
         """Re-calculate total size from the database."""
-        size = self.storage.get_total_size(userid)
+        size = self.storage.get_total_size(userid, recalculate=True)
         for colmgr in self.cache_only_collections.itervalues():
             try:
                 items = colmgr.get_items(userid)["items"]
@@ -539,21 +1286,29 @@ class MemcachedStorage(SyncStorage):
                 update(ts, ts, len("TEST"))
 
         """
-        # Get the old values from the metadata.
-        # We can't call _get_metadata directly because we also want the casid.
         key = _key(userid, "metadata")
-        data, casid = self.cache.gets(key)
-        if data is None:
-            # No cached data, so refresh.
-            self._get_metadata(userid)
-            data, casid = self.cache.gets(key)
-
-        # Write None into the metadata to mark things as dirty.
-        ts = data["modified"]
-        col_ts = data["collections"].get(collection)
-        data["modified"] = None
-        data["collections"][collection] = None
-        if not self.cache.cas(key, data, casid):
+        self._prefetch_metadata(userid, collection)
+        # The metadata may have been memoized earlier in the request and
+        # then changed by a write to some other collection, in which case
+        # the CAS will fail.  We hold the lock for this collection, so it's
+        # safe to just re-read the metadata and try once more.
+        for _ in xrange(2):
+            # Get the old values from the metadata.
+            # We can't call _get_metadata directly because we want the casid.
+            with self.cache.bypass_local_cache():
+                data, casid = self.cache.gets(key)
+                if data is None:
+                    # No cached data, so refresh.
+                    self._get_metadata(userid)
+                    data, casid = self.cache.gets(key)
+            # Write None into the metadata to mark things as dirty.
+            ts = data["modified"]
+            col_ts = data["collections"].get(collection)
+            data["modified"] = None
+            data["collections"][collection] = None
+            if self.cache.cas(key, data, casid):
+                break
+        else:
             raise ConflictError
 
         # Define the callback function for the calling code to use.
@@ -608,6 +1363,9 @@ class UncachedManager(object):
         self.owner = owner
         self.collection = collection
 
+    def iter_cache_keys(self, userid, include_items=True):
+        return iter(())
+
     def get_timestamp(self, userid):
         storage = self.owner.storage
         return storage.get_collection_timestamp(userid, self.collection)
@@ -678,6 +1436,10 @@ class _CachedManagerBase(object):
     and in the backing store, and collections that exist solely in memcache.
     """
 
+    # Whether items are lost if their bucket goes missing from memcache.
+    # If not, a missing bucket means that the cached data can't be used.
+    evicted_items_are_lost = False
+
     def __init__(self, owner, collection):
         self.owner = owner
         self.collection = collection
@@ -685,8 +1447,14 @@ class _CachedManagerBase(object):
     def get_key(self, userid):
         return _key(userid, "c", self.collection)
 
-    def iter_cache_keys(self, userid):
+    def get_bucket_key(self, userid, bucket):
+        return _key(userid, "c", self.collection, bucket)
+
+    def iter_cache_keys(self, userid, include_items=True):
         yield self.get_key(userid)
+        if include_items:
+            for bucket in xrange(self.owner.cache_buckets):
+                yield self.get_bucket_key(userid, bucket)
 
     @property
     def storage(self):
@@ -701,9 +1469,6 @@ class _CachedManagerBase(object):
     # All the rest of the functionality is implemented in terms of these.
     #
 
-    def get_cached_data(self, userid):
-        raise NotImplementedError
-
     def set_items(self, userid, items):
         raise NotImplementedError
 
@@ -719,28 +1484,155 @@ class _CachedManagerBase(object):
     def del_item(self, userid, item):
         raise NotImplementedError
 
+    #
+    # Helper methods for reading the segmented collection data.
+    #
+
+    def get_cached_index(self, userid):
+        """Get the index of the cached collection data, and its casid."""
+        return self.cache.gets(self.get_key(userid))
+
+    def get_cached_data(self, userid, ids=None):
+        """Get the cached collection data, optionally for only some items.
+
+        This returns a dict with the last-modified time of the collection
+        and a mapping of item ids to BSO objects, along with the casid of
+        the index.  Only the buckets holding the requested items are read.
+        """
+        index, casid = self.get_cached_index(userid)
+        if index is None:
+            return None, None
+        items = self._load_items(userid, index, ids)
+        return {"modified": index["modified"], "items": items}, casid
+
+    def _new_index(self, modified):
+        return {
+            "modified": modified,
+            "nbuckets": self.owner.cache_buckets,
+            "buckets": {},
+        }
+
+    def _get_bucket(self, index, id):
+        """Get the bucket in which the given item id is stored."""
+        if isinstance(id, unicode):
+            id = id.encode("utf8")
+        return str(zlib.crc32(id) % index["nbuckets"])
+
+    def _load_items(self, userid, index, ids=None):
+        """Load the given items, or all items, from the cached collection.
+
+        This returns a dict mapping item ids to BSO objects, or None if some
+        of the required buckets are missing from memcache.
+        """
+        if "items" in index:
+            # A collection cached in the old single-key format.
+            items = index["items"]
+        else:
+            if ids is None:
+                buckets = index["buckets"].keys()
+            else:
+                buckets = set(self._get_bucket(index, id) for id in ids)
+            loaded = self._load_buckets(userid, index, buckets)
+            if loaded is None:
+                return None
+            items = {}
+            for bucket_items in loaded.itervalues():
+                items.update(bucket_items)
+        if ids is not None:
+            items = dict((id, items[id]) for id in ids if id in items)
+        return items
+
+    def _load_buckets(self, userid, index, buckets):
+        """Load the items from the given buckets of the cached collection.
+
+        This fetches the buckets in a single request, and returns a dict
+        mapping each bucket to a dict of the items in it.  Buckets that are
+        not in the index are empty.  If any bucket in the index is missing or
+        doesn't match the index then this returns None, unless the class
+        says that evicted items are lost, in which case it's treated as empty.
+        """
+        loaded = dict((bucket, {}) for bucket in buckets)
+        keys = {}
+        for bucket in loaded:
+            if bucket in index["buckets"]:
+                keys[self.get_bucket_key(userid, bucket)] = bucket
+        if keys:
+            for key, (data, _) in self.cache.gets_multi(keys).iteritems():
+                bucket = keys[key]
+                if data is not None:
+                    if data["modified"] == index["buckets"][bucket]:
+                        loaded[bucket] = data["items"]
+                        continue
+                if not self.evicted_items_are_lost:
+                    return None
+        return loaded
+
     #
     # Helper methods for updating cached collection data.
     # Subclasses use this common logic for updating the cache, but
     # need to layer different steps around it.
     #
 
-    def _set_items(self, userid, items, modified, data, casid):
+    def _load_buckets_for_write(self, userid, index, ids):
+        """Load the buckets that will be affected by writing the given items.
+
+        A collection cached in the old single-key format is converted to use
+        buckets in place, and all of its buckets are returned so that they
+        can all be written out.
+        """
+        if "items" in index:
+            items = index.pop("items")
+            index.update(self._new_index(index["modified"]))
+            buckets = {}
+            for id, bso in items.iteritems():
+                bucket = self._get_bucket(index, id)
+                buckets.setdefault(bucket, {})[id] = bso
+        else:
+            affected = set(self._get_bucket(index, id) for id in ids)
+            buckets = self._load_buckets(userid, index, affected)
+            if buckets is None:
+                raise ConflictError
+        for id in ids:
+            buckets.setdefault(self._get_bucket(index, id), {})
+        return buckets
+
+    def _store_buckets(self, userid, index, casid, buckets, modified):
+        """Write the given buckets into memcache, then update the index.
+
+        The index is written last, using CAS, so that readers never see a
+        partially-written update.  Empty buckets are removed from the index,
+        and any stale data left under their key is ignored.
+        """
+        for bucket, items in buckets.iteritems():
+            if not items:
+                index["buckets"].pop(bucket, None)
+                continue
+            key = self.get_bucket_key(userid, bucket)
+            if not self.cache.set(key, {"modified": modified, "items": items}):
+                raise ConflictError
+            index["buckets"][bucket] = modified
+        index["modified"] = modified
+        if not self.cache.cas(self.get_key(userid), index, casid):
+            raise ConflictError
+
+    def _set_items(self, userid, items, modified, index, casid):
         """Update the cached data by setting the given items.
 
         This method performs the equivalent of SyncStorage.set_items() on
         the cached data.  You must provide the new last-modified timestamp,
-        the existing data dict, and the casid of the data currently stored
-        in memcache.
+        the existing index, and the casid of the index currently stored
+        in memcache.  Only the buckets holding the given items are updated.
 
         It returns the number of items that were newly created, which may
         be less than the number of items given if some already existed in
         the cached data.
         """
-        if not data:
-            data = {"modified": modified, "items": {}}
-        elif data["modified"] >= modified:
+        if not index:
+            index = self._new_index(modified)
+        elif index["modified"] >= modified:
             raise ConflictError
+        buckets = self._load_buckets_for_write(userid, index,
+                                               [item["id"] for item in items])
         num_created = 0
         for item in items:
             # Cache only the fields we need.
@@ -758,55 +1650,59 @@ class _CachedManagerBase(object):
                 else:
                     bso["ttl"] = int(modified) + item["ttl"]
             # Update it in-place, or create if it doesn't exist.
+            bucket_items = buckets[self._get_bucket(index, bso["id"])]
             try:
-                data["items"][bso["id"]].update(bso)
+                bucket_items[bso["id"]].update(bso)
             except KeyError:
                 num_created += 1
                 # Set default payload on newly-created items.
                 bso["modified"] = modified
                 if "payload" not in bso:
                     bso["payload"] = ""
-                data["items"][bso["id"]] = bso
-            data["modified"] = modified
-        # Purge any items that have expired.
+                bucket_items[bso["id"]] = bso
+        # Purge any items that have expired from the buckets we're writing.
         # We can't do this as part of the purge_expired_items()
         # because we don't have a way to enumerate all user ids.
-        expired_ids = set()
         expiry_time = int(time.time()) - TTL_EXPIRY_GRACE_PERIOD
-        for id, bso in data["items"].iteritems():
-            ttl = bso.get("ttl")
-            if ttl is not None and ttl < expiry_time:
-                expired_ids.add(id)
-        for id in expired_ids:
-            del data["items"][id]
-        key = self.get_key(userid)
-        if not self.cache.cas(key, data, casid):
-            raise ConflictError
+        for bucket_items in buckets.itervalues():
+            expired_ids = set()
+            for id, bso in bucket_items.iteritems():
+                ttl = bso.get("ttl")
+                if ttl is not None and ttl < expiry_time:
+                    expired_ids.add(id)
+            for id in expired_ids:
+                del bucket_items[id]
+        if not items:
+            modified = index["modified"]
+        self._store_buckets(userid, index, casid, buckets, modified)
         return num_created
 
-    def _del_items(self, userid, items, modified, data, casid):
+    def _del_items(self, userid, items, modified, index, casid):
         """Update the cached data by deleting the given items.
 
         This method performs the equivalent of SyncStorage.delete_items() on
         the cached data.  You must provide the new last-modified timestamp,
-        the existing data dict, and the casid of the data currently stored
-        in memcache.
+        the existing index, and the casid of the index currently stored
+        in memcache.  Only the buckets holding the given items are updated.
 
         It returns the number of items that were successfully deleted.
         """
-        if not data:
+        if not index:
             raise CollectionNotFoundError
-        if data["modified"] >= modified:
+        if index["modified"] >= modified:
             raise ConflictError
+        was_converted = "items" in index
+        buckets = self._load_buckets_for_write(userid, index, items)
         num_deleted = 0
         for id in items:
-            if data["items"].pop(id, None) is not None:
+            bucket_items = buckets[self._get_bucket(index, id)]
+            if bucket_items.pop(id, None) is not None:
                 num_deleted += 1
-        if num_deleted > 0:
-            data["modified"] = modified
-        key = self.get_key(userid)
-        if not self.cache.cas(key, data, casid):
-            raise ConflictError
+        if num_deleted == 0:
+            modified = index["modified"]
+            if not was_converted:
+                buckets = {}
+        self._store_buckets(userid, index, casid, buckets, modified)
         return num_deleted
 
     #
@@ -814,10 +1710,10 @@ class _CachedManagerBase(object):
     #
 
     def get_timestamp(self, userid):
-        data, _ = self.get_cached_data(userid)
-        if data is None:
+        index, _ = self.get_cached_index(userid)
+        if index is None:
             raise CollectionNotFoundError
-        return data["modified"]
+        return index["modified"]
 
     def get_items(self, userid, **kwds):
         # Decode kwds into individual filter values.
@@ -829,16 +1725,12 @@ class _CachedManagerBase(object):
         ids = kwds.pop("ids", None)
         for unknown_kwd in kwds:
             raise TypeError("Unknown keyword argument: %s" % (unknown_kwd,))
-        # Read all the items out of the cache.
-        data, _ = self.get_cached_data(userid)
+        # Read the items out of the cache.
+        # If specific ids were requested, only their buckets are read.
+        data, _ = self.get_cached_data(userid, ids)
         if data is None:
             raise CollectionNotFoundError
-        # Restrict to certain item ids if specified.
-        bsos_by_id = data["items"]
-        if ids is not None:
-            bsos = (bsos_by_id[item] for item in ids if item in bsos_by_id)
-        else:
-            bsos = bsos_by_id.itervalues()
+        bsos = data["items"].itervalues()
         # Apply the various filters as generator expressions.
         if newer is not None:
             bsos = (bso for bso in bsos if bso["modified"] > newer)
@@ -907,21 +1799,22 @@ class CacheOnlyManager(_CachedManagerBase):
     internally and uses CAS to avoid conflicting writes.
     """
 
+    # There's nowhere else to get the items from if they're evicted.
+    evicted_items_are_lost = True
+
     def get_batches_key(self, userid):
         return _key(userid, "c", self.collection, "batches")
 
-    def iter_cache_keys(self, userid):
-        for key in super(CacheOnlyManager, self).iter_cache_keys(userid):
+    def iter_cache_keys(self, userid, include_items=True):
+        parent = super(CacheOnlyManager, self)
+        for key in parent.iter_cache_keys(userid, include_items):
             yield key
         yield self.get_batches_key(userid)
 
-    def get_cached_data(self, userid):
-        return self.cache.gets(self.get_key(userid))
-
     def set_items(self, userid, items):
         modified = get_timestamp()
-        data, casid = self.get_cached_data(userid)
-        self._set_items(userid, items, modified, data, casid)
+        index, casid = self.get_cached_index(userid)
+        self._set_items(userid, items, modified, index, casid)
         return modified
 
     def del_collection(self, userid):
@@ -931,15 +1824,15 @@ class CacheOnlyManager(_CachedManagerBase):
 
     def del_items(self, userid, items):
         modified = get_timestamp()
-        data, casid = self.get_cached_data(userid)
-        self._del_items(userid, items, modified, data, casid)
-        return data["modified"]
+        index, casid = self.get_cached_index(userid)
+        self._del_items(userid, items, modified, index, casid)
+        return index["modified"]
 
     def set_item(self, userid, item, bso):
         bso["id"] = item
         modified = get_timestamp()
-        data, casid = self.get_cached_data(userid)
-        num_created = self._set_items(userid, [bso], modified, data, casid)
+        index, casid = self.get_cached_index(userid)
+        num_created = self._set_items(userid, [bso], modified, index, casid)
         return {
             "created": num_created == 1,
             "modified": modified,
@@ -947,8 +1840,8 @@ class CacheOnlyManager(_CachedManagerBase):
 
     def del_item(self, userid, item):
         modified = get_timestamp()
-        data, casid = self.get_cached_data(userid)
-        num_deleted = self._del_items(userid, [item], modified, data, casid)
+        index, casid = self.get_cached_index(userid)
+        num_deleted = self._del_items(userid, [item], modified, index, casid)
         if num_deleted == 0:
             raise ItemNotFoundError
         return modified
@@ -972,9 +1865,10 @@ class CacheOnlyManager(_CachedManagerBase):
         batchid = int(ts * 1000)
         if not bdata:
             bdata = {}
-        if batchid in bdata:
+        # Key by the string form of the id, as a JSON round-trip would.
+        if str(batchid) in bdata:
             raise ConflictError
-        bdata[batchid] = {
+        bdata[str(batchid)] = {
             "created": int(ts),
             "items": []
         }
@@ -1013,8 +1907,9 @@ class CacheOnlyManager(_CachedManagerBase):
         if not bdata or batchid not in bdata:
             raise InvalidBatch(batch)
 
-        data, casid = self.get_cached_data(userid)
-        self._set_items(userid, bdata[batchid]["items"], modified, data, casid)
+        index, casid = self.get_cached_index(userid)
+        self._set_items(userid, bdata[batchid]["items"], modified, index,
+                        casid)
         return modified
 
     def close_batch(self, userid, batch):
@@ -1044,33 +1939,74 @@ class CachedManager(_CachedManagerBase):
     underlying store.
     """
 
-    def get_cached_data(self, userid, refresh_if_missing=True):
-        """Get the cached collection data, pulling into cache if missing.
+    def get_cached_index(self, userid, refresh_if_missing=True):
+        """Get the cached collection index, pulling into cache if missing.
 
-        This method returns the cached collection data, populating it from
-        the underlying store if it is not cached.
+        This method returns the index of the cached collection data and its
+        casid, populating the cache from the underlying store if needed.
         """
         key = self.get_key(userid)
-        data, casid = self.cache.gets(key)
-        if data is None and refresh_if_missing:
-            data = {}
-            try:
-                storage = self.storage
-                collection = self.collection
-                ttl_base = int(get_timestamp())
-                with self.owner.lock_for_read(userid, collection):
-                    ts = storage.get_collection_timestamp(userid, collection)
-                    data["modified"] = ts
-                    data["items"] = {}
-                    for bso in storage.get_items(userid, collection)["items"]:
-                        if bso.get("ttl") is not None:
-                            bso["ttl"] = ttl_base + bso["ttl"]
-                        data["items"][bso["id"]] = bso
-                self.cache.add(key, data)
-                data, casid = self.cache.gets(key)
-            except CollectionNotFoundError:
-                data = None
-        return data, casid
+        index, casid = self.cache.gets(key)
+        if index is None and refresh_if_missing:
+            if self._refresh(userid) is not None:
+                index, casid = self.cache.gets(key)
+        return index, casid
+
+    def get_cached_data(self, userid, ids=None):
+        """Get the cached collection data, pulling into cache if missing.
+
+        If some of the cached items have been evicted from memcache then the
+        whole collection is re-populated from the underlying store.
+        """
+        index, casid = self.get_cached_index(userid)
+        if index is None:
+            return None, None
+        items = self._load_items(userid, index, ids)
+        if items is None:
+            key = self.get_key(userid)
+            self.cache.delete(key)
+            data = self._refresh(userid)
+            if data is None:
+                return None, None
+            if ids is not None:
+                items = data["items"]
+                data["items"] = dict((id, items[id])
+                                     for id in ids if id in items)
+            return data, self.cache.gets(key)[1]
+        return {"modified": index["modified"], "items": items}, casid
+
+    def _refresh(self, userid):
+        """Populate the cached data from the underlying store.
+
+        This returns the collection data that was read from the store, or
+        None if the collection does not exist.
+        """
+        data = {}
+        try:
+            storage = self.storage
+            collection = self.collection
+            ttl_base = int(get_timestamp())
+            with self.owner.lock_for_read(userid, collection):
+                ts = storage.get_collection_timestamp(userid, collection)
+                data["modified"] = ts
+                data["items"] = {}
+                for bso in storage.get_items(userid, collection)["items"]:
+                    if bso.get("ttl") is not None:
+                        bso["ttl"] = ttl_base + bso["ttl"]
+                    data["items"][bso["id"]] = bso
+        except CollectionNotFoundError:
+            return None
+        index = self._new_index(data["modified"])
+        buckets = {}
+        for id, bso in data["items"].iteritems():
+            buckets.setdefault(self._get_bucket(index, id), {})[id] = bso
+        try:
+            self._store_buckets(userid, index, None, buckets,
+                                data["modified"])
+        except ConflictError:
+            # Someone else populated it at the same time.
+            pass
+        return data
 
     def set_items(self, userid, items):
         storage = self.storage
@@ -1081,11 +2017,11 @@ class CachedManager(_CachedManagerBase):
             if "payload" not in item:
                 refresh_if_missing = False
                 break
-        with self._mark_dirty(userid, refresh_if_missing) as (data, casid):
+        with self._mark_dirty(userid, refresh_if_missing) as (index, casid):
             ts = storage.set_items(userid, self.collection, items)
         # Update the cached data in-place to reflect the changes.
         if refresh_if_missing:
-            self._set_items(userid, items, ts, data, casid)
+            self._set_items(userid, items, ts, index, casid)
         return ts
 
     def del_collection(self, userid):
@@ -1094,11 +2030,11 @@ class CachedManager(_CachedManagerBase):
 
     def del_items(self, userid, items):
         storage = self.storage
-        with self._mark_dirty(userid) as (data, casid):
+        with self._mark_dirty(userid) as (index, casid):
             ts = storage.delete_items(userid, self.collection, items)
         # Update the cached data, if there was any present.
-        if data is not None:
-            self._del_items(userid, items, ts, data, casid)
+        if index is not None:
+            self._del_items(userid, items, ts, index, casid)
         return ts
 
     def set_item(self, userid, item, bso):
@@ -1108,21 +2044,21 @@ class CachedManager(_CachedManagerBase):
         refresh_if_missing = True
         if "payload" not in bso:
             refresh_if_missing = False
-        with self._mark_dirty(userid, refresh_if_missing) as (data, casid):
+        with self._mark_dirty(userid, refresh_if_missing) as (index, casid):
             res = storage.set_item(userid, self.collection, item, bso)
         # Update the cached data in-place to reflect the change.
         if refresh_if_missing:
             bso["id"] = item
-            self._set_items(userid, [bso], res["modified"], data, casid)
+            self._set_items(userid, [bso], res["modified"], index, casid)
         return res
 
     def del_item(self, userid, item):
         storage = self.storage
-        with self._mark_dirty(userid) as (data, casid):
+        with self._mark_dirty(userid) as (index, casid):
             ts = storage.delete_item(userid, self.collection, item)
         # Update the cached data, if there was any present.
-        if data is not None:
-            self._del_items(userid, [item], ts, data, casid)
+        if index is not None:
+            self._del_items(userid, [item], ts, index, casid)
         return ts
 
     def create_batch(self, userid):
@@ -1161,22 +2097,24 @@ class CachedManager(_CachedManagerBase):
         Once the write operation has successfully completed, the calling code
         should update the cache with the new data.
         """
-        # Grab the current cache state so we can pass it to calling function.
+        # Grab the current index so we can pass it to calling function.
+        # Only the index needs to be removed from the cache; the buckets
+        # can't be read without it.
         key = self.get_key(userid)
-        data, casid = self.get_cached_data(userid, refresh_if_missing)
+        index, casid = self.get_cached_index(userid, refresh_if_missing)
         # Remove it from the cache so that we don't serve stale data.
         # A CAS-DELETE here would be nice, but memcached doesn't have one.
-        if data is not None:
+        if index is not None:
             self.cache.delete(key)
         # Yield control back the the calling function.
-        # Since we've deleted the data, it should always use casid=None.
+        # Since we've deleted the index, it should always use casid=None.
         try:
-            yield data, None
+            yield index, None
         except StorageError:
             # If they get a storage-related error, it's safe to rollback
             # the cache. For any other sort of error we leave the cache clear.
-            if data is not None:
-                self.cache.add(key, data)
+            if index is not None:
+                self.cache.add(key, index)
             raise
 
     def _set_items(self, userid, *args):
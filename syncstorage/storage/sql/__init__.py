@@ -22,10 +22,10 @@ import threading
 import contextlib
 from collections import defaultdict
 
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, DBAPIError
 
 from syncstorage.bso import BSO
-from syncstorage.util import get_timestamp
+from syncstorage.util import get_timestamp, Timestamp
 from syncstorage.storage import (SyncStorage,
                                  ConflictError,
                                  CollectionNotFoundError,
@@ -35,6 +35,8 @@ from syncstorage.storage import (SyncStorage,
 
 from syncstorage.storage.sql.dbconnect import (DBConnector, MAX_TTL,
                                                BackendError)
+from syncstorage.storage.sql.registry import (CollectionsCache,
+                                              CollectionsRegistry)
 
 from mozsvc.metrics import metrics_timer
 
@@ -54,17 +56,32 @@ FIRST_CUSTOM_COLLECTION_ID = 100
 
 MAX_COLLECTIONS_CACHE_SIZE = 1000
 
+# The maximum number of item ids to refer to in internal bookkeeping queries.
+# This keeps us within the limits on the number of query params.
+MAX_IDS_PER_QUERY = 100
+
 
 assert FIRST_CUSTOM_COLLECTION_ID > len(STANDARD_COLLECTIONS)
 assert FIRST_CUSTOM_COLLECTION_ID > max(STANDARD_COLLECTIONS)
 
 
+# The columns of the bso table that are returned as fields of a BSO.
+BSO_ROW_FIELDS = frozenset(("id", "sortindex", "modified", "payload", "ttl"))
+
+
 def ts2bigint(timestamp):
-    return int(timestamp * 1000)
+    try:
+        return timestamp.centiseconds * 10
+    except AttributeError:
+        return int(timestamp * 1000)
 
 
 def bigint2ts(bigint):
-    return get_timestamp(bigint / 1000.0)
+    # Round milliseconds to centiseconds, half-to-even like Decimal does.
+    centiseconds, remainder = divmod(bigint, 10)
+    if remainder > 5 or (remainder == 5 and centiseconds % 2):
+        centiseconds += 1
+    return Timestamp(centiseconds)
 
 
 def convert_db_errors(func):
@@ -109,6 +126,33 @@ def with_session(func):
     return with_session_wrapper
 
 
+def touches_collections(func):
+    """Method decorator for methods that write to collections.
+
+    Such methods record the collections they change on the session, using
+    _touch_collection().  This decorator writes those changes out to the
+    database as soon as the outermost such method returns, so that any
+    error in doing so is raised by the call that made them.  Callers that
+    keep their own state, such as a cache of the data, can then rely on a
+    successful return meaning that the write was made.
+
+    It must be applied inside the @with_session decorator.
+    """
+    @functools.wraps(func)
+    def touches_collections_wrapper(self, session, *args, **kwds):
+        session.write_depth += 1
+        try:
+            res = func(self, session, *args, **kwds)
+            if session.write_depth == 1:
+                self._flush_touched_collections(session)
+            return res
+        finally:
+            session.write_depth -= 1
+            if session.write_depth == 0:
+                session.touched_collections.clear()
+    return touches_collections_wrapper
+
+
 class SQLStorage(SyncStorage):
     """Storage plugin implemented using an SQL database.
 
@@ -121,12 +165,26 @@ class SQLStorage(SyncStorage):
         * create_tables:         create the database tables if they don't
                                  exist at startup
         * shard/shardsize:       enable sharding of the BSO table
+        * sortindex_index:       create an index for paging by sortindex
+        * collections_cache_size:  max number of collection names to cache
+        * collections_registry:  path of a file in which to share collection
+                                 names between all processes on the host
+        * warm_collections_cache:  load collection names into the cache
+                                   at startup; this is always done when
+                                   using a registry, to check its contents
+        * optimistic_writes:     don't hold a row lock for the duration of
+                                 write operations; check for concurrent
+                                 writes as each write is made instead
 
     """
 
-    def __init__(self, sqluri, standard_collections=False, **dbkwds):
+    def __init__(self, sqluri, standard_collections=False,
+                 collections_cache_size=MAX_COLLECTIONS_CACHE_SIZE,
+                 collections_registry=None, warm_collections_cache=True,
+                 optimistic_writes=False, **dbkwds):
 
         self.sqluri = sqluri
+        self.optimistic_writes = optimistic_writes
         self.dbconnector = DBConnector(sqluri, **dbkwds)
         self._optimize_table_before_purge = \
             dbkwds.get("optimize_table_before_purge", True)
@@ -145,13 +203,18 @@ class SQLStorage(SyncStorage):
                     if self.dbconnector.driver == "postgres":
                         raise
 
-        # A local in-memory cache for the name => collectionid mapping.
-        self._collections_by_name = {}
-        self._collections_by_id = {}
-        if self.standard_collections:
-            for id, name in STANDARD_COLLECTIONS.iteritems():
-                self._collections_by_name[name] = id
-                self._collections_by_id[id] = name
+        # A local in-memory cache for the name => collectionid mapping,
+        # optionally backed by a registry file shared with other processes.
+        # The standard collections aren't in the db, so they can't be evicted.
+        if collections_registry is not None:
+            collections_registry = CollectionsRegistry(collections_registry)
+        self._collections = CollectionsCache(
+            max(int(collections_cache_size), 1),
+            pinned=STANDARD_COLLECTIONS if standard_collections else None,
+            registry=collections_registry,
+        )
+        if warm_collections_cache or collections_registry is not None:
+            self._warm_collections_cache()
 
         # A thread-local to track active sessions.
         self._tldata = threading.local()
@@ -179,6 +242,19 @@ class SQLStorage(SyncStorage):
     # than explicit locking, but our ops team have expressed concerns about
     # the efficiency of that approach at scale.
     #
+    # With optimistic_writes enabled, write locks don't lock the row.  They
+    # just remember its last-modified timestamp, and the eventual update of
+    # that timestamp is made conditional on it not having changed.  If some
+    # other writer got there first then the update fails with ConflictError
+    # and the whole transaction is rolled back.  Writers then only block
+    # each other for the duration of that single statement.  (SQLite still
+    # locks the entire database for each write transaction.)
+    #
+    # The update is made as each write method returns, so the ConflictError
+    # is raised by the write call that lost the race rather than when the
+    # lock is released.  Wrappers like MemcachedStorage rely on this to
+    # roll back their cached copy of a write that didn't happen.
+    #
 
     # Note: you can't use the @with_session decorator here.
     # It doesn't work right because of the generator-contextmanager thing.
@@ -224,7 +300,11 @@ class SQLStorage(SyncStorage):
                 raise RuntimeError("Can't escalate read-lock to write-lock")
             params = {"userid": userid, "collectionid": collectionid}
             session.query("BEGIN_TRANSACTION_WRITE")
-            ts = session.query_scalar("LOCK_COLLECTION_WRITE", params)
+            if self.optimistic_writes:
+                ts = session.query_scalar("COLLECTION_TIMESTAMP", params)
+                session.expected_timestamps[(userid, collectionid)] = ts
+            else:
+                ts = session.query_scalar("LOCK_COLLECTION_WRITE", params)
             if ts is not None:
                 ts = bigint2ts(ts)
                 # Forbid the write if it would not properly incr the timestamp.
@@ -264,35 +344,39 @@ class SQLStorage(SyncStorage):
 
     @with_session
     def get_collection_counts(self, session, userid):
-        """Returns the collection counts."""
-        res = session.query_fetchall("COLLECTIONS_COUNTS", {
-            "userid": userid,
-            "ttl": int(session.timestamp),
-        })
-        return self._map_collection_names(session, res)
+        """Returns the collection counts.
+
+        These are taken from the running totals kept for each collection,
+        which include expired items until they're purged.
+        """
+        usage = self._get_collections_usage(session, userid)
+        counts = ((id, count) for id, count, size in usage if count)
+        return self._map_collection_names(session, counts)
 
     @with_session
     def get_collection_sizes(self, session, userid):
-        """Returns the total size for each collection."""
-        res = session.query_fetchall("COLLECTIONS_SIZES", {
-            "userid": userid,
-            "ttl": int(session.timestamp),
-        })
-        # Some db backends return a Decimal() instance for this aggregate.
-        # We want just a plain old integer.
-        rows = ((row[0], int(row[1])) for row in res)
-        return self._map_collection_names(session, rows)
+        """Returns the total size for each collection.
+
+        These are taken from the running totals kept for each collection,
+        which include expired items until they're purged.
+        """
+        usage = self._get_collections_usage(session, userid)
+        sizes = ((id, size) for id, count, size in usage if count)
+        return self._map_collection_names(session, sizes)
 
     @with_session
     def get_total_size(self, session, userid, recalculate=False):
-        """Returns the total size a user's stored data."""
-        size = session.query_scalar("STORAGE_SIZE", {
-            "userid": userid,
-            "ttl": int(session.timestamp),
-        }, default=0)
-        # Some db backends return a Decimal() instance for this aggregate.
-        # We want just a plain old integer.
-        return int(size)
+        """Returns the total size a user's stored data.
+
+        This is normally taken from the running totals of collection sizes,
+        which include expired items until they're purged.  If asked to
+        recalculate, we recalculate the totals from the items and return
+        the size of only the unexpired items.
+        """
+        if recalculate:
+            return self._recalculate_collections_usage(session, userid)
+        usage = self._get_collections_usage(session, userid)
+        return sum(size for id, count, size in usage)
 
     @with_session
     def delete_storage(self, session, userid):
@@ -303,6 +387,9 @@ class SQLStorage(SyncStorage):
         session.query("DELETE_ALL_COLLECTIONS", {
             "userid": userid,
         })
+        for key in session.expected_timestamps:
+            if key[0] == userid:
+                session.expected_timestamps[key] = None
 
     #
     # APIs to operate on an individual collection
@@ -358,7 +445,8 @@ class SQLStorage(SyncStorage):
         offset = params.pop("offset", None)
         if offset is not None:
             self.decode_offset(params, offset)
-        rows = session.query_fetchall("FIND_ITEMS", params)
+        rows = session.query_fetchall("FIND_ITEMS", params,
+                                      stream_results=True)
         items = [self._row_to_bso(row, int(session.timestamp)) for row in rows]
         # If the query returned no results, we don't know whether that's
         # because it's empty or because it doesn't exist.  Read the collection
@@ -377,17 +465,15 @@ class SQLStorage(SyncStorage):
 
     def _row_to_bso(self, row, timestamp):
         """Convert a database table row into a BSO object."""
-        item = dict(row)
-        for key in ("userid", "collection", "payload_size",):
-            item.pop(key, None)
-        ts = item.get("modified")
+        bso = BSO.from_row(zip(row.keys(), row), BSO_ROW_FIELDS)
+        ts = bso.get("modified")
         if ts is not None:
-            item["modified"] = bigint2ts(ts)
+            bso["modified"] = bigint2ts(ts)
         # Convert the ttl back into an offset from the current time.
-        ttl = item.get("ttl")
+        ttl = bso.get("ttl")
         if ttl is not None:
-            item["ttl"] = ttl - timestamp
-        return BSO(item)
+            bso["ttl"] = ttl - timestamp
+        return bso
 
     def encode_next_offset(self, params, items):
         """Encode an "offset token" for resuming query at the given item.
@@ -399,15 +485,19 @@ class SQLStorage(SyncStorage):
         encoded as "bound:offset" with efficient pagination granularity
         limited by the number of items with the same timestamp.
 
-        When sorting by sortindex, we cannot use an index anyway, and we have
-        no bound on the number of items that might share a single sortindex.
-        There's therefore not much to be gained by trying to be clever, and
-        we just use a simple numeric offset.
+        When sorting by sortindex, we have no bound on the number of items
+        that might share a single sortindex, but "id" acts as a tie-breaker
+        to give a total ordering.  We encode the position of the last item
+        as "sortindex:id" and seek directly past it, with an empty sortindex
+        for items that don't have one.
         """
         sort = params.get("sort", None)
-        # Use a simple numeric offset for sortindex ordering.
+        # Use a (sortindex, id) keyset for sortindex ordering.
         if sort == "index":
-            return str(params.get("offset", 0) + len(items))
+            sortindex = items[-1].get("sortindex")
+            if sortindex is None:
+                sortindex = ""
+            return "%s:%s" % (sortindex, items[-1]["id"])
         # Find an appropriate upper bound for faster timestamp ordering.
         bound = items[-1]["modified"]
         bound_as_bigint = ts2bigint(bound)
@@ -442,8 +532,19 @@ class SQLStorage(SyncStorage):
         sort = params.get("sort", None)
         try:
             if sort == "index":
-                # When sorting by sortindex, it's just a numeric offset.
-                params["offset"] = int(offset)
+                # When sorting by sortindex, it's a (sortindex, id) pair.
+                # Older tokens were just a numeric offset; honour them so
+                # that clients can finish paging through their results.
+                if ":" not in offset:
+                    params["offset"] = int(offset)
+                else:
+                    sortindex, id = offset.split(":", 1)
+                    if not id:
+                        raise InvalidOffsetError(offset)
+                    params["index_bound"] = None
+                    if sortindex:
+                        params["index_bound"] = int(sortindex)
+                    params["id_bound"] = id
             else:
                 # When sorting by timestamp, it's a (bound, offset) pair.
                 bound, offset = map(int, offset.split(":", 1))
@@ -463,22 +564,30 @@ class SQLStorage(SyncStorage):
             raise InvalidOffsetError(offset)
 
     @with_session
+    @touches_collections
     def set_items(self, session, userid, collection, items):
         """Creates or updates multiple items in a collection."""
         collectionid = self._get_collection_id(session, collection, create=1)
         rows = []
+        new_sizes = {}
         for data in items:
             id = data["id"]
             row = self._prepare_bso_row(session, userid, collectionid,
                                         id, data)
             rows.append(row)
+            if "payload_size" in row:
+                new_sizes[id] = row["payload_size"]
+        size_delta = sum(new_sizes.itervalues())
+        size_delta -= self._get_items_usage(session, userid, collectionid,
+                                            new_sizes)[1]
         defaults = {
             "modified": ts2bigint(session.timestamp),
             "payload": "",
             "payload_size": 0,
         }
-        session.insert_or_update("bso", rows, defaults)
-        return self._touch_collection(session, userid, collectionid)
+        num_created = session.insert_or_update("bso", rows, defaults)
+        return self._touch_collection(session, userid, collectionid,
+                                      num_created, size_delta)
 
     @with_session
     def create_batch(self, session, userid, collection):
@@ -540,6 +649,7 @@ class SQLStorage(SyncStorage):
 
     @metrics_timer("syncstorage.storage.sql.apply_batch")
     @with_session
+    @touches_collections
     def apply_batch(self, session, userid, collection, batchid):
         collectionid = self._get_collection_id(session, collection)
         params = {
@@ -550,9 +660,12 @@ class SQLStorage(SyncStorage):
             "ttl_base": int(session.timestamp),
             "modified": ts2bigint(session.timestamp)
         }
+        count_delta, size_delta = session.query_fetchone("BATCH_USAGE_DELTA",
+                                                         params)
         session.query("APPLY_BATCH_UPDATE", params)
         session.query("APPLY_BATCH_INSERT", params)
-        return self._touch_collection(session, userid, collectionid)
+        return self._touch_collection(session, userid, collectionid,
+                                      int(count_delta), int(size_delta or 0))
 
     @metrics_timer("syncstorage.storage.sql.close_batch")
     @with_session
@@ -570,47 +683,240 @@ class SQLStorage(SyncStorage):
     def delete_collection(self, session, userid, collection):
         """Deletes an entire collection."""
         collectionid = self._get_collection_id(session, collection)
-        count = session.query("DELETE_COLLECTION_ITEMS", {
-            "userid": userid,
-            "collectionid": collectionid,
-        })
-        count += session.query("DELETE_COLLECTION", {
+        params = {
             "userid": userid,
             "collectionid": collectionid,
-        })
+        }
+        count = session.query("DELETE_COLLECTION_ITEMS", params)
+        key = (userid, collectionid)
+        if key not in session.expected_timestamps:
+            count += session.query("DELETE_COLLECTION", params)
+        else:
+            # Under optimistic locking, only delete the collection if
+            # nobody else has written to it since we read its timestamp.
+            expected = session.expected_timestamps[key]
+            if expected is None:
+                if session.query("DELETE_COLLECTION", params) != 0:
+                    raise ConflictError
+            else:
+                params["last_modified"] = expected
+                if session.query("CAS_DELETE_COLLECTION", params) != 1:
+                    raise ConflictError
+                count += 1
+            session.expected_timestamps[key] = None
         if count == 0:
             raise CollectionNotFoundError
         return self.get_storage_timestamp(userid)
 
     @with_session
+    @touches_collections
     def delete_items(self, session, userid, collection, items):
         """Deletes multiple items from a collection."""
         collectionid = self._get_collection_id(session, collection)
+        count, size = self._get_items_usage(session, userid, collectionid,
+                                            items)
         session.query("DELETE_ITEMS", {
             "userid": userid,
             "collectionid": collectionid,
             "ids": items,
         })
-        return self._touch_collection(session, userid, collectionid)
+        return self._touch_collection(session, userid, collectionid,
+                                      -count, -size)
 
-    def _touch_collection(self, session, userid, collectionid):
-        """Update the last-modified timestamp of the given collection."""
-        params = {
-            "userid": userid,
-            "collectionid": collectionid,
-            "modified": ts2bigint(session.timestamp),
-        }
-        # The common case will be an UPDATE, so try that first.
-        # If it doesn't update any rows then do an INSERT.
-        rowcount = session.query("TOUCH_COLLECTION", params)
-        if rowcount != 1:
+    def _touch_collection(self, session, userid, collectionid,
+                          count_delta=0, size_delta=0):
+        """Update the last-modified timestamp of the given collection.
+
+        The running totals of the collection's usage are adjusted at the same
+        time, by the change in the number and size of items that were written.
+
+        This doesn't write to the database straight away.  The session keeps
+        track of the collections it has touched, and they're all written out
+        by _flush_touched_collections() when the write method returns; see
+        the @touches_collections decorator.
+        """
+        key = (userid, collectionid)
+        deltas = session.touched_collections.get(key, (0, 0))
+        deltas = (deltas[0] + count_delta, deltas[1] + size_delta)
+        session.touched_collections[key] = deltas
+        return session.timestamp
+
+    def _flush_touched_collections(self, session):
+        """Write out the changes to all collections touched by the session."""
+        touched = session.touched_collections
+        # Write them in a consistent order, to avoid deadlocks.
+        for userid, collectionid in sorted(touched):
+            count_delta, size_delta = touched[(userid, collectionid)]
+            params = {
+                "userid": userid,
+                "collectionid": collectionid,
+                "modified": ts2bigint(session.timestamp),
+                "count_delta": count_delta,
+                "size_delta": size_delta,
+            }
+            if (userid, collectionid) in session.expected_timestamps:
+                self._cas_touch_collection(session, params)
+                continue
+            if self.dbconnector.upsert_style != "generic":
+                session.query("UPSERT_COLLECTION", params)
+                continue
+            # The common case will be an UPDATE, so try that first.
+            # If it doesn't update any rows then do an INSERT.
+            rowcount = session.query("TOUCH_COLLECTION", params)
+            if rowcount != 1:
+                try:
+                    session.query("INIT_COLLECTION", params)
+                except IntegrityError:
+                    # Someone else inserted it at the same time.
+                    # Update it instead so we don't lose track of our items.
+                    if self.dbconnector.driver == "postgres":
+                        raise
+                    session.query("TOUCH_COLLECTION", params)
+        touched.clear()
+
+    def _cas_touch_collection(self, session, params):
+        """Touch a collection only if it hasn't changed since it was locked.
+
+        This is the commit step of an optimistic write lock.  If some other
+        session has written to the collection since we read its timestamp
+        then ConflictError is raised, and the session will be rolled back.
+        """
+        key = (params["userid"], params["collectionid"])
+        expected = session.expected_timestamps[key]
+        if expected is None:
+            # It didn't exist, so someone else creating it is a conflict.
             try:
                 session.query("INIT_COLLECTION", params)
             except IntegrityError:
-                # Someone else inserted it at the same time.
-                if self.dbconnector.driver == "postgres":
-                    raise
-        return session.timestamp
+                raise ConflictError
+        else:
+            params["last_modified"] = expected
+            if session.query("CAS_TOUCH_COLLECTION", params) != 1:
+                raise ConflictError
+        # Any further changes in this session are made on top of our own.
+        session.expected_timestamps[key] = params["modified"]
+
+    def _get_items_usage(self, session, userid, collectionid, items):
+        """Get the number and total size of the given items in a collection.
+
+        Only items that are actually stored in the collection are counted.
+        This returns a tuple (count, size).
+        """
+        items = list(items)
+        count = size = 0
+        for i in xrange(0, len(items), MAX_IDS_PER_QUERY):
+            rows = session.query_fetchall("ITEMS_SIZES", {
+                "userid": userid,
+                "collectionid": collectionid,
+                "ids": items[i:i + MAX_IDS_PER_QUERY],
+            })
+            for row in rows:
+                count += 1
+                size += int(row[1])
+        return count, size
+
+    def _get_collections_usage(self, session, userid):
+        """Get the running totals of usage for each of the user's collections.
+
+        This returns a list of (collectionid, count, size) tuples.  If any of
+        the totals are missing then they're recalculated from the items, and
+        stored unless some other write fills them in first.
+        """
+        params = {"userid": userid}
+        rows = list(session.query_fetchall("COLLECTIONS_USAGE", params))
+        missing = set(id for id, count, size in rows
+                      if count is None or size is None)
+        if missing:
+            usage = self._query_collections_usage(session, userid)
+            recalculated = dict((id, usage.get(id, (0, 0, 0))[:2])
+                                for id in missing)
+            self._fill_collections_usage(session, userid, recalculated)
+            rows = [(row[0],) + recalculated.get(row[0], row[1:])
+                    for row in rows]
+        # Some db backends return a Decimal() instance for these.
+        # We want just a plain old integer.
+        return [(id, int(count), int(size)) for id, count, size in rows]
+
+    def _recalculate_collections_usage(self, session, userid):
+        """Recalculate the running totals of the user's collection usage.
+
+        This returns the total size of the user's unexpired items, which
+        is calculated from the same query.  The recalculated totals are
+        stored for any collections that can safely be updated.
+        """
+        usage = self._query_collections_usage(session, userid)
+        recalculated = {}
+        for (locked_userid, id), locked in session.locked_collections.items():
+            if locked_userid == userid and locked:
+                count, size, _ = usage.get(id, (0, 0, 0))
+                recalculated[id] = (count, size)
+        self._store_collections_usage(session, userid, recalculated)
+        return sum(unexpired for _, _, unexpired in usage.itervalues())
+
+    def _query_collections_usage(self, session, userid):
+        """Calculate the usage of each of the user's collections from items.
+
+        This returns a dict mapping collection ids to a tuple giving the
+        number and total size of its stored items, which is what the running
+        totals keep track of, and the size of its unexpired items.
+        """
+        rows = session.query_fetchall("RECALCULATE_COLLECTIONS_USAGE", {
+            "userid": userid,
+            "ttl": int(session.timestamp),
+        })
+        # Some db backends return a Decimal() instance for these aggregates.
+        # We want just a plain old integer.
+        return dict((id, (int(count), int(size), int(unexpired)))
+                    for id, count, size, unexpired in rows)
+
+    def _fill_collections_usage(self, session, userid, usage):
+        """Store recalculated values for missing running totals.
+
+        Every write fills in any missing totals for the collections it
+        touches, so if they're still missing when we come to store them
+        then nothing has been written to the collection since we read its
+        items, and storing them can't clobber anyone else's changes.  This
+        isn't done while holding a read lock, since taking a write lock in
+        the database on top of it could deadlock with another reader.
+        """
+        if 0 in session.locked_collections.itervalues():
+            return
+        for id, (count, size) in usage.iteritems():
+            session.query("FILL_COLLECTION_USAGE", {
+                "userid": userid,
+                "collectionid": id,
+                "count": count,
+                "size": size,
+            })
+
+    def _store_collections_usage(self, session, userid, usage):
+        """Overwrite the running totals with recalculated values.
+
+        Other sessions update the totals with relative adjustments, so they
+        can only be overwritten by a session that stops anyone else writing
+        to the collection between calculating the new values and storing
+        them; otherwise the other write would be lost, and the totals would
+        stay wrong.  So the totals are only stored for collections that this
+        session has write-locked, and under optimistic locking, only if
+        nobody else has written to them since we read their timestamp.
+        The others will be recalculated again when next needed.
+        """
+        for id, (count, size) in usage.iteritems():
+            key = (userid, id)
+            if not session.locked_collections.get(key):
+                continue
+            params = {
+                "userid": userid,
+                "collectionid": id,
+                "count": count,
+                "size": size,
+            }
+            if not self.optimistic_writes:
+                session.query("SET_COLLECTION_USAGE", params)
+            else:
+                params["last_modified"] = session.expected_timestamps[key]
+                if params["last_modified"] is not None:
+                    session.query("CAS_SET_COLLECTION_USAGE", params)
 
     #
     # Items APIs
@@ -645,19 +951,27 @@ class SQLStorage(SyncStorage):
         return self._row_to_bso(row, int(session.timestamp))
 
     @with_session
+    @touches_collections
     def set_item(self, session, userid, collection, item, data):
         """Creates or updates a single item in a collection."""
         collectionid = self._get_collection_id(session, collection, create=1)
         row = self._prepare_bso_row(session, userid, collectionid, item, data)
+        size_delta = 0
+        if "payload_size" in row:
+            size_delta = row["payload_size"]
+            size_delta -= self._get_items_usage(session, userid, collectionid,
+                                                [item])[1]
         defaults = {
             "modified": ts2bigint(session.timestamp),
             "payload": "",
             "payload_size": 0,
         }
         num_created = session.insert_or_update("bso", [row], defaults)
+        modified = self._touch_collection(session, userid, collectionid,
+                                          num_created, size_delta)
         return {
             "created": bool(num_created),
-            "modified": self._touch_collection(session, userid, collectionid)
+            "modified": modified,
         }
 
     def _prepare_bso_row(self, session, userid, collectionid, item, data):
@@ -702,9 +1016,12 @@ class SQLStorage(SyncStorage):
         return row
 
     @with_session
+    @touches_collections
     def delete_item(self, session, userid, collection, item):
         """Deletes a single item from a collection."""
         collectionid = self._get_collection_id(session, collection)
+        size = self._get_items_usage(session, userid, collectionid,
+                                     [item])[1]
         rowcount = session.query("DELETE_ITEM", {
             "userid": userid,
             "collectionid": collectionid,
@@ -713,7 +1030,8 @@ class SQLStorage(SyncStorage):
         })
         if rowcount == 0:
             raise ItemNotFoundError
-        return self._touch_collection(session, userid, collectionid)
+        return self._touch_collection(session, userid, collectionid,
+                                      -1, -size)
 
     #
     # Administrative/maintenance methods.
@@ -753,7 +1071,7 @@ class SQLStorage(SyncStorage):
         num_purged = 0
         is_incomplete = False
         for table in sorted(tables):
-            res = self._purge_items_loop(table, "PURGE_SOME_EXPIRED_ITEMS", {
+            res = self._purge_items_loop(table, self._purge_some_bsos, {
                 "bso": table,
                 "grace": grace_period,
                 "maxitems": max_per_loop,
@@ -765,6 +1083,33 @@ class SQLStorage(SyncStorage):
             "is_complete": not is_incomplete,
         }
 
+    def _purge_some_bsos(self, session, params):
+        """Purge some expired BSOs, updating the collection usage to match."""
+        session.query("BEGIN_TRANSACTION_WRITE")
+        expired = defaultdict(dict)
+        rows = session.query_fetchall("FIND_SOME_EXPIRED_ITEMS", params)
+        for userid, collectionid, item, size in rows:
+            expired[(userid, collectionid)][item] = size
+        num_purged = 0
+        for (userid, collectionid), sizes in expired.iteritems():
+            ids = list(sizes)
+            for i in xrange(0, len(ids), MAX_IDS_PER_QUERY):
+                num_purged += session.query("PURGE_EXPIRED_ITEMS", {
+                    "bso": params["bso"],
+                    "userid": userid,
+                    "collectionid": collectionid,
+                    "ids": ids[i:i + MAX_IDS_PER_QUERY],
+                    "now": params["now"],
+                    "grace": params["grace"],
+                })
+            session.query("ADJUST_COLLECTION_USAGE", {
+                "userid": userid,
+                "collectionid": collectionid,
+                "count_delta": -len(sizes),
+                "size_delta": -sum(int(size) for size in sizes.itervalues()),
+            })
+        return num_purged
+
     def _purge_expired_batches(self, grace_period=0, max_per_loop=1000):
         self._maybe_optimize_table_before_purge("OPTIMIZE_BATCHES_TABLE")
         res = self._purge_items_loop("batch_uploads", "PURGE_BATCHES", {
@@ -808,7 +1153,18 @@ class SQLStorage(SyncStorage):
         }
 
     def _purge_items_loop(self, table, query, params):
-        """Helper function to incrementally purge items in a loop."""
+        """Helper function to incrementally purge items in a loop.
+
+        The query can be the name of a query that deletes some items, or
+        a function taking the session and params that does so and returns
+        the number of items deleted.
+        """
+        if not callable(query):
+            query_name = query
+
+            def query(session, params):
+                return session.query(query_name, params)
+
         # Purge some items, a few at a time, in a loop.
         # We set an upper limit on the number of iterations, to avoid
         # getting stuck indefinitely on a single table.
@@ -822,7 +1178,7 @@ class SQLStorage(SyncStorage):
         # the incrementality can let other jobs run properly.
         with self._get_or_create_session() as session:
             params["now"] = int(session.timestamp)
-            rowcount = session.query(query, params)
+            rowcount = query(session, params)
         while rowcount > 0:
             num_purged += rowcount
             logger.debug("After %d iterations, %s items purged",
@@ -833,7 +1189,7 @@ class SQLStorage(SyncStorage):
                 is_incomplete = True
                 break
             with self._get_or_create_session() as session:
-                rowcount = session.query(query, params)
+                rowcount = query(session, params)
         logger.info("Purged %d expired items from %s", num_purged, table)
         # We use "is_incomplete" rather than "is_complete" in the code above
         # because we expect that, most of the time, the purge will complete.
@@ -891,10 +1247,12 @@ class SQLStorage(SyncStorage):
         create=True.
         """
         # Grab it from the cache if we can.
-        try:
-            return self._collections_by_name[collection]
-        except KeyError:
-            pass
+        collectionid = self._collections.get_id(collection)
+        if collectionid is not None:
+            return collectionid
+        collectionid = session.created_collections.get(collection)
+        if collectionid is not None:
+            return collectionid
 
         # Try to look it up in the database.
         collectionid = session.query_scalar("COLLECTION_ID", {
@@ -913,14 +1271,20 @@ class SQLStorage(SyncStorage):
             except IntegrityError:
                 if self.dbconnector.driver == "postgres":
                     raise
-            # Read the id that was created concurrently.
-            collectionid = self._get_collection_id(session, collection)
+                # Read the id that was created concurrently.
+                return self._get_collection_id(session, collection)
+            # The new id isn't committed yet, and may be given to some other
+            # collection if we roll back.  Keep it on the session until then.
+            collectionid = session.query_scalar("COLLECTION_ID", {
+                "name": collection
+            })
+            session.created_collections[collection] = collectionid
 
         # Sanity-check that we"re not trampling standard collection ids.
         if self.standard_collections:
             assert collectionid >= FIRST_CUSTOM_COLLECTION_ID
 
-        self._cache_collection_id(collectionid, collection)
+        self._cache_collections(session, [(collectionid, collection)])
         return collectionid
 
     def _get_collection_name(self, session, collectionid):
@@ -929,17 +1293,16 @@ class SQLStorage(SyncStorage):
         If the collection id does not exist then CollectionNotFoundError
         will be raised.
         """
-        try:
-            return self._collections_by_id[collectionid]
-        except KeyError:
-            pass
+        collection = self._collections.get_name(collectionid)
+        if collection is not None:
+            return collection
 
         collection = session.query_scalar("COLLECTION_NAME", {
             "collectionid": collectionid,
         })
         if collection is None:
             raise CollectionNotFoundError
-        self._cache_collection_id(collectionid, collection)
+        self._cache_collections(session, [(collectionid, collection)])
         return collection
 
     def _load_collection_names(self, session, collection_ids):
@@ -958,18 +1321,19 @@ class SQLStorage(SyncStorage):
         # Extract as many names as possible from the cache, and
         # build a list of any ids whose names are not cached.
         for id in collection_ids:
-            try:
-                names[id] = self._collections_by_id[id]
-            except KeyError:
+            name = self._collections.get_name(id)
+            if name is not None:
+                names[id] = name
+            else:
                 uncached_ids.append(id)
         # Use a single query to fetch the names for all uncached collections.
         if uncached_ids:
-            uncached_names = session.query_fetchall("COLLECTION_NAMES", {
+            uncached_names = list(session.query_fetchall("COLLECTION_NAMES", {
                 "ids": uncached_ids,
-            })
+            }))
             for id, name in uncached_names:
                 names[id] = name
-                self._cache_collection_id(id, name)
+            self._cache_collections(session, uncached_names)
         # Check that we actually got a name for each specified id.
         for id in collection_ids:
             if id not in names:
@@ -989,15 +1353,39 @@ class SQLStorage(SyncStorage):
         names = self._load_collection_names(session, collection_ids)
         return dict([(names[id], value) for id, value in values])
 
-    def _cache_collection_id(self, collectionid, collection):
-        """Cache the given collection (id, name) pair for fast lookup."""
-        if len(self._collections_by_name) > MAX_COLLECTIONS_CACHE_SIZE:
-            msg = "More than %d collections have been created, "\
-                  "refusing to cache them all"
-            logger.warn(msg % (MAX_COLLECTIONS_CACHE_SIZE,))
+    def _cache_collections(self, session, collections):
+        """Cache the given collection (id, name) pairs for fast lookup.
+
+        Collections created by the session are left out, since they aren't
+        committed yet.  They're cached when the session commits.
+        """
+        created = session.created_collections
+        self._collections.add_many((id, name) for id, name in collections
+                                   if created.get(name) != id)
+
+    def _warm_collections_cache(self):
+        """Load collection names into the cache at startup.
+
+        This loads as many names as will fit in the cache using a single
+        query, so that each process doesn't have to discover them one request
+        at a time.  Any names already in the shared registry are checked
+        against them, in case the registry was written for a different
+        database; see CollectionsCache.check_registry().
+        """
+        limit = self._collections.max_size
+        try:
+            with self.dbconnector.connect() as connection:
+                collections = list(connection.query_fetchall(
+                    "COLLECTIONS", {"limit": limit}
+                ))
+        except (BackendError, DBAPIError):
+            logger.warn("Failed to warm collections cache", exc_info=True)
         else:
-            self._collections_by_name[collection] = collectionid
-            self._collections_by_id[collectionid] = collection
+            # Skip the dummy collection created by SET_MIN_COLLECTION_ID.
+            complete = len(collections) < limit
+            collections = [tuple(c) for c in collections if c[1]]
+            self._collections.check_registry(collections, complete)
+            self._collections.add_many(collections)
 
 
 class SQLStorageSession(object):
@@ -1009,6 +1397,12 @@ class SQLStorageSession(object):
 
         * the "current time" on the server during the snapshot
         * the set of currently-locked collections
+        * the set of collections modified by the current write, which
+          are marked as modified in the database when it returns
+        * the timestamps read by optimistic write locks, which must not
+          have changed when those modifications are written
+        * the ids of any collections created in the snapshot, which are
+          not cached until it's committed
 
     """
 
@@ -1018,6 +1412,10 @@ class SQLStorageSession(object):
         self.timestamp = get_timestamp(timestamp)
         self.cache = defaultdict(SQLCachedCollectionData)
         self.locked_collections = {}
+        self.touched_collections = {}
+        self.write_depth = 0
+        self.expected_timestamps = {}
+        self.created_collections = {}
         self._nesting_level = 0
 
     def __enter__(self):
@@ -1055,10 +1453,11 @@ class SQLStorageSession(object):
         return self.connection.query_fetchone(query, params)
 
     @convert_db_errors
-    def query_fetchall(self, query, params={}):
+    def query_fetchall(self, query, params={}, stream_results=False):
         """Execute a database query, returning iterator over the results."""
         assert self._nesting_level > 0, "Session has not been started"
-        return self.connection.query_fetchall(query, params)
+        return self.connection.query_fetchall(query, params,
+                                              stream_results=stream_results)
 
     def begin(self):
         """Enter the context of this session.
@@ -1086,6 +1485,10 @@ class SQLStorageSession(object):
                 self.connection.commit()
             finally:
                 del self.storage._tldata.session
+            # Any collections we created can now be safely cached.
+            self.storage._collections.add_many(
+                (id, name) for name, id in self.created_collections.iteritems()
+            )
             if self.locked_collections:
                 msg = "You must unlock all collections before ending a session"
                 raise RuntimeError(msg)
@@ -27,6 +27,8 @@ import traceback
 import functools
 from collections import defaultdict
 
+from repoze.lru import LRUCache
+
 import sqlalchemy.event
 from sqlalchemy import create_engine
 from sqlalchemy.util.queue import Queue
@@ -40,6 +42,8 @@ from sqlalchemy.dialects import postgresql, mysql
 from mozsvc.metrics import metrics_timer, annotate_request
 from mozsvc.exceptions import BackendError
 
+from syncstorage.profiler import profile_timer
+
 from syncstorage.storage.sql import (queries_generic,
                                      queries_sqlite,
                                      queries_postgres,
@@ -88,8 +92,12 @@ collections = Table(
 
 # Table mapping (user_id, collection_id) => collection-level metadata.
 #
-# This table holds collection-level metadata on a per-user basis.  Currently
-# the only such metadata is the last-modified timestamp of the collection.
+# This table holds collection-level metadata on a per-user basis:
+#
+#   * the last-modified timestamp of the collection.
+#   * running totals of the number and size of the stored items in the
+#     collection, including any expired items that have not been purged yet.
+#     These are NULL if not known, and must be recalculated from the items.
 
 user_collections = Table(
     "user_collections",
@@ -98,7 +106,9 @@ user_collections = Table(
            autoincrement=False),
     Column("collection", Integer, primary_key=True, nullable=False,
            autoincrement=False),
-    Column("last_modified", BigInteger, nullable=False)
+    Column("last_modified", BigInteger, nullable=False),
+    Column("item_count", Integer, nullable=True),
+    Column("total_size", BigInteger, nullable=True)
 )
 
 
@@ -115,8 +125,8 @@ PAYLOAD_TYPE = PAYLOAD_TYPE.with_variant(mysql.MEDIUMTEXT(), 'mysql')
 
 # Common column definitions between BSO and batch upload item tables
 
-def _get_bso_columns(table_name):
-    return (
+def _get_bso_columns(table_name, sortindex_index=False):
+    columns = (
         Column("userid", Integer, primary_key=True, nullable=False,
                autoincrement=False),
         Column("collection", Integer, primary_key=True, nullable=False,
@@ -139,10 +149,18 @@ def _get_bso_columns(table_name):
         # Index on "modified" for easy filtering by timestamp.
         Index("%s_usr_col_mod_idx" % (table_name,),
               "userid", "collection", "modified"),
-        # There is intentinally no index on "sortindex".
+        # There is intentinally no index on "sortindex" by default.
         # Clients almost always filter on "modified" using the above index,
         # and cannot take advantage of a separate index for sorting.
     )
+    # Optional index for paging through large collections by sortindex.
+    # This includes "id" to match the keyset used for pagination.
+    if sortindex_index:
+        columns += (
+            Index("%s_usr_col_sortidx_idx" % (table_name,),
+                  "userid", "collection", "sortindex", "id"),
+        )
+    return columns
 
 
 #  If the storage controller is not doing sharding based on userid,
@@ -301,7 +319,9 @@ class DBConnector(object):
     def __init__(self, sqluri, create_tables=False, pool_size=100,
                  no_pool=False, pool_recycle=60, reset_on_return=True,
                  pool_max_overflow=10, pool_max_backlog=-1, pool_timeout=30,
-                 shard=False, shardsize=100, **kwds):
+                 shard=False, shardsize=100, query_cache_size=1000,
+                 stream_results=False, stream_results_batch_size=100,
+                 sortindex_index=False, **kwds):
 
         parsed_sqluri = urlparse.urlparse(sqluri)
         self.sqluri = sqluri
@@ -317,6 +337,8 @@ class DBConnector(object):
 
         self.shard = shard
         self.shardsize = shardsize
+        self.stream_results = stream_results
+        self.stream_results_batch_size = int(stream_results_batch_size)
 
         # Construct the pooling-related arguments for SQLAlchemy engine.
         sqlkw = {}
@@ -372,6 +394,9 @@ class DBConnector(object):
                     bsoN.create(self.engine, checkfirst=True)
                     buiN = get_batch_item_table(idx)
                     buiN.create(self.engine, checkfirst=True)
+            if sortindex_index:
+                self._create_sortindex_indexes()
+            self.add_missing_columns()
 
         # Load the pre-built queries to use with this database backend.
         # Currently we have a generic set of queries, and some queries specific
@@ -389,12 +414,54 @@ class DBConnector(object):
                 if nm.isupper():
                     self._prebuilt_queries[nm] = getattr(queries, nm)
 
+        # Pre-render the string queries for each of the sharded tables,
+        # so that we don't have to scan and interpolate them on every call.
+        self._string_queries = {}
+        for nm, query in self._prebuilt_queries.iteritems():
+            if isinstance(query, basestring):
+                self._string_queries[nm] = self._prerender_query(query)
+        self._bso_shard_numbers = {}
+        self._bui_shard_numbers = {}
+        for idx in xrange(self.shardsize if self.shard else 1):
+            self._bso_shard_numbers[self._get_bso_table(idx).name] = idx
+            self._bui_shard_numbers[self._get_bui_table(idx).name] = idx
+        self._ids_bindparams = {}
+
+        # Work out the most efficient way to do a bulk "upsert" of items.
+        # SQLite supports the ON CONFLICT syntax since version 3.24, but
+        # limits the number of params per query to 999 before version 3.32.
+        self.upsert_style = "generic"
+        self.max_query_params = None
+        if self.driver == "mysql":
+            self.upsert_style = "onduplicatekey"
+        elif self.driver == "postgres":
+            self.upsert_style = "onconflict"
+            self.max_query_params = 32767
+        elif self.driver == "sqlite":
+            sqlite_version = self.engine.dialect.dbapi.sqlite_version_info
+            if sqlite_version >= (3, 24, 0):
+                self.upsert_style = "onconflict"
+            if sqlite_version >= (3, 32, 0):
+                self.max_query_params = 32766
+            else:
+                self.max_query_params = 999
+
         # Constuct a Dialect object to use for rendering query objects.
         # This forces rendering of bindparams using the "named" style,
         # so that the resulting string is compatible with sqltext().
         self._render_query_dialect = copy.copy(self.engine.dialect)
         self._render_query_dialect.paramstyle = "named"
 
+        # Cache the rendered SQL for callable queries that support it,
+        # since compiling an SQLAlchemy query object is surprisingly costly.
+        # There's one entry per table per distinct shape of query params,
+        # so we bound the size of the cache to stop it growing without limit.
+        query_cache_size = int(query_cache_size)
+        if query_cache_size > 0:
+            self._rendered_queries = LRUCache(query_cache_size)
+        else:
+            self._rendered_queries = None
+
         # PyMySQL Connection objects hold a reference to their most recent
         # Result object, which can cause large datasets to remain in memory.
         # Explicitly clear it when returning a connection to the pool.
@@ -407,6 +474,66 @@ class DBConnector(object):
             sqlalchemy.event.listen(self.engine.pool, "checkin",
                                     clear_result_on_pool_checkin)
 
+    def add_missing_columns(self):
+        """Add any columns that are missing from the existing tables.
+
+        Creating the tables does nothing to tables that already exist, so
+        they won't have any columns added by later versions of this code.
+        Such columns are always nullable, with NULL meaning "not yet known",
+        so it's safe to add them to a live database.  This returns a list
+        of the names of the columns that were added, as "table.column".
+        """
+        tables = [collections, user_collections, batch_uploads]
+        if not self.shard:
+            tables.extend((bso, bui))
+        else:
+            for idx in xrange(self.shardsize):
+                tables.append(get_bso_table(idx))
+                tables.append(get_batch_item_table(idx))
+        inspector = sqlalchemy.inspect(self.engine)
+        added = []
+        for table in tables:
+            if not self.engine.has_table(table.name):
+                continue
+            existing = set(column["name"]
+                           for column in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable:
+                    msg = "Can't add non-nullable column %s.%s"
+                    raise RuntimeError(msg % (table.name, column.name))
+                coltype = column.type.compile(dialect=self.engine.dialect)
+                query = "ALTER TABLE %s ADD COLUMN %s %s "\
+                        "/* queryName=ADD_COLUMN */"\
+                        % (table.name, column.name, coltype)
+                with self.engine.begin() as connection:
+                    connection.execute(query)
+                logger.info("Added column %s.%s", table.name, column.name)
+                added.append("%s.%s" % (table.name, column.name))
+        return added
+
+    def _create_sortindex_indexes(self):
+        """Create the optional sortindex index on each BSO table.
+
+        The tables in the shared metadata don't declare this index, so we
+        build it from a private copy of the table definition, and create
+        any of that copy's indexes that aren't already present.
+        """
+        if not self.shard:
+            table_names = ["bso"]
+        else:
+            table_names = ["bso%d" % (i,) for i in xrange(self.shardsize)]
+        inspector = sqlalchemy.inspect(self.engine)
+        for table_name in table_names:
+            existing = set(idx["name"]
+                           for idx in inspector.get_indexes(table_name))
+            columns = _get_bso_columns(table_name, sortindex_index=True)
+            table = Table(table_name, MetaData(), *columns)
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(self.engine)
+
     def connect(self, *args, **kwds):
         """Create a new DBConnection object from this connector."""
         return DBConnection(self)
@@ -414,8 +541,8 @@ class DBConnector(object):
     def get_query(self, name, params):
         """Get the named pre-built query.
 
-        This method returns an SQLAlchemy query object for the named query,
-        after performing some sharding based on the given parameters.
+        This method returns an SQLAlchemy query object or SQL string for the
+        named query, after performing some sharding based on the given params.
         """
         # Get the pre-built query with that name.
         # It might be None, a string query, or a callable returning the query.
@@ -427,45 +554,140 @@ class DBConnector(object):
         if query is None:
             return None
         # If it's a callable, call it with the sharded bso table.
+        # The result might be taken from the cache of rendered queries,
+        # in which case we only need to bind the individual item ids.
         if callable(query):
+            if "ids" in params:
+                self._bind_ids(params)
             bso = self.get_bso_table(params.get("userid"))
-            return query(bso, params)
-        # If it's a string, do some interpolation and return it.
-        # XXX TODO: we could pre-parse these queries at load time to look for
-        # string interpolation variables, saving some time on each call.
-        assert isinstance(query, basestring)
-        qvars = {}
-        if "%(bso)s" in query:
+            cache_key = getattr(query, "cache_key", None)
+            if cache_key is None or self._rendered_queries is None:
+                return query(bso, params)
+            key = (name, bso.name, cache_key(params))
+            rendered = self._rendered_queries.get(key)
+            if rendered is None:
+                rendered = self.render_query(query(bso, params))
+                self._rendered_queries.put(key, rendered)
+            query_str, default_params = rendered
+            for param, value in default_params.iteritems():
+                params.setdefault(param, value)
+            return query_str
+        # If it's a string, find the copy pre-rendered for the appropriate
+        # shard, and do any interpolation that has to happen at runtime.
+        shard_by, rendered, runtime_vars = self._string_queries[name]
+        if shard_by is None:
+            query = rendered[0]
+        elif shard_by == "bso":
             if "bso" in params:
-                qvars["bso"] = params["bso"]
+                query = rendered[self._bso_shard_numbers[params["bso"]]]
             else:
-                qvars["bso"] = self.get_bso_table(params["userid"])
-        if "%(bui)s" in query:
+                query = rendered[self._get_shard_number(params["userid"])]
+        else:
             if "bui" in params:
-                qvars["bui"] = params["bui"]
+                query = rendered[self._bui_shard_numbers[params["bui"]]]
             else:
-                qvars["bui"] = self.get_batch_item_table(params["batch"])
-        if "%(ids)s" in query:
-            bindparams = []
-            for i, id in enumerate(params["ids"]):
-                params["id%d" % (i,)] = id
-                bindparams.append(":id%d" % (i,))
-            qvars["ids"] = "(" + ",".join(bindparams) + ")"
-        if qvars:
+                query = rendered[self._get_shard_number(params["batch"])]
+        if runtime_vars:
+            qvars = {}
+            if "bui" in runtime_vars:
+                if "bui" in params:
+                    qvars["bui"] = params["bui"]
+                else:
+                    qvars["bui"] = self.get_batch_item_table(params["batch"])
+            if "ids" in runtime_vars:
+                qvars["ids"] = self._bind_ids(params)
             query = query % qvars
         return query
 
+    def _prerender_query(self, query):
+        """Pre-render a string query for each of the sharded tables.
+
+        This returns a tuple (shard_by, rendered, runtime_vars).  The first
+        item says which table the query is sharded by, the second is a list
+        of copies of the query indexed by shard number, and the third is
+        the set of variables that must still be interpolated at runtime.
+
+        Queries that refer to both the bso and batch_upload_items tables are
+        sharded by bso; pre-rendering every combination of the two would use
+        far too much memory.  The variable-length %(ids)s list must always
+        be interpolated at runtime.
+        """
+        runtime_vars = set()
+        qvars = {"bui": "%(bui)s", "ids": "%(ids)s"}
+        if "%(bso)s" in query:
+            shard_by = "bso"
+            get_table = self._get_bso_table
+            if "%(bui)s" in query:
+                runtime_vars.add("bui")
+        elif "%(bui)s" in query:
+            shard_by = "bui"
+            get_table = self._get_bui_table
+        else:
+            shard_by = None
+        if "%(ids)s" in query:
+            runtime_vars.add("ids")
+        if shard_by is None:
+            rendered = [query]
+        else:
+            rendered = []
+            for idx in xrange(self.shardsize if self.shard else 1):
+                qvars[shard_by] = get_table(idx).name
+                rendered.append(query % qvars)
+        return shard_by, rendered, runtime_vars
+
+    def _bind_ids(self, params):
+        """Bind each item in the "ids" param as a separate ":idN" param.
+
+        This returns the bracketed list of bindparams for use in an "IN"
+        clause, which is cached since it depends only on the number of ids.
+        """
+        ids = params["ids"]
+        for i, id in enumerate(ids):
+            params["id%d" % (i,)] = id
+        try:
+            return self._ids_bindparams[len(ids)]
+        except KeyError:
+            bindparams = ",".join(":id%d" % (i,) for i in xrange(len(ids)))
+            bindparams = "(" + bindparams + ")"
+            self._ids_bindparams[len(ids)] = bindparams
+            return bindparams
+
+    def render_query(self, query):
+        """Render an SQLAlchemy query object into a string.
+
+        The resulting string uses "named" bindparams so that it is compatible
+        with sqltext().  This method returns a tuple giving the string along
+        with a dict of default param values, including any that were generated
+        by the dialect, which must be provided when executing the query.
+        """
+        compiled = query.compile(dialect=self._render_query_dialect)
+        return str(compiled), compiled.params
+
     def get_bso_table(self, userid):
         """Get the BSO table object for the given userid."""
-        if not self.shard or userid is None:
-            return bso
-        return get_bso_table(userid % self.shardsize)
+        return self._get_bso_table(self._get_shard_number(userid))
 
     def get_batch_item_table(self, batchid):
         """Get the batch_upload_items table object for the given userid."""
-        if not self.shard or batchid is None:
+        return self._get_bui_table(self._get_shard_number(batchid))
+
+    def _get_shard_number(self, id):
+        """Get the shard number for the given userid or batchid."""
+        if not self.shard or id is None:
+            return 0
+        return id % self.shardsize
+
+    def _get_bso_table(self, idx):
+        """Get the BSO table object for the given shard number."""
+        if not self.shard:
+            return bso
+        return get_bso_table(idx)
+
+    def _get_bui_table(self, idx):
+        """Get the batch_upload_items table object for the given shard."""
+        if not self.shard:
             return bui
-        return get_batch_item_table(batchid % self.shardsize)
+        return get_batch_item_table(idx)
 
 
 def is_retryable_db_error(engine, exc):
@@ -573,6 +795,7 @@ class DBConnection(object):
         else:
             self.rollback()
 
+    @profile_timer("db", "commit")
     @report_backend_errors
     def commit(self):
         """Commit the active transaction and close the connection."""
@@ -598,13 +821,18 @@ class DBConnection(object):
                 self._connection = None
 
     @report_backend_errors
-    def execute(self, query, params=None, annotations=None):
+    def execute(self, query, params=None, annotations=None,
+                stream_results=False):
         """Execute a database query, with retry and exception-catching logic.
 
         This method executes the given query against the database, lazily
         establishing an actual live connection as required.  It catches
         operational database errors and normalizes them into a BackendError
         exception.
+
+        If stream_results is true then the results will be read from a
+        server-side cursor, if supported by the driver.  The caller must
+        consume or close the result before executing any other query.
         """
         if params is None:
             params = {}
@@ -626,7 +854,9 @@ class DBConnection(object):
             # successfully used as part of this transaction.
             try:
                 query_str = self._render_query(query, params, annotations)
-                return self._exec_with_cleanup(connection, query_str, **params)
+                with profile_timer("db", annotations.get("queryName")):
+                    return self._exec_with_cleanup(connection, query_str,
+                                                   params, stream_results)
             except DBAPIError, exc:
                 if not is_retryable_db_error(self._connector.engine, exc):
                     raise
@@ -640,7 +870,9 @@ class DBConnection(object):
                 transaction = connection.begin()
                 annotations["retry"] = "1"
                 query_str = self._render_query(query, params, annotations)
-                return self._exec_with_cleanup(connection, query_str, **params)
+                with profile_timer("db", annotations.get("queryName")):
+                    return self._exec_with_cleanup(connection, query_str,
+                                                   params, stream_results)
         finally:
             # Now that the underlying connection has been used, remember it
             # so that all subsequent queries are part of the same transaction.
@@ -649,7 +881,8 @@ class DBConnection(object):
                 self._transaction = transaction
 
     @metrics_timer("syncstorage.storage.sql.db.execute")
-    def _exec_with_cleanup(self, connection, query_str, **params):
+    def _exec_with_cleanup(self, connection, query_str, params,
+                           stream_results=False):
         """Execution wrapper that kills queries if it is interrupted.
 
         This is a wrapper around connection.execute() that will clean up
@@ -660,6 +893,8 @@ class DBConnection(object):
         drivers will still execute fine, they just won't get the cleanup.
         """
         try:
+            if stream_results:
+                return self._exec_streaming(connection, query_str, params)
             return connection.execute(sqltext(query_str), **params)
         except Exception:
             # Normal exceptions are passed straight through.
@@ -708,6 +943,26 @@ class DBConnection(object):
                     # Always re-raise the original error.
                     raise exc, val, tb
 
+    def _exec_streaming(self, connection, query_str, params):
+        """Execute a query so that its results are read from the server
+        incrementally, rather than being buffered in memory by the driver.
+
+        SQLAlchemy implements this for some drivers via the "stream_results"
+        option, but not for MySQL.  There, we temporarily switch the DBAPI
+        connection to create an unbuffered SSCursor for this query.
+        """
+        if self._connector.driver != "mysql":
+            connection = connection.execution_options(stream_results=True)
+            return connection.execute(sqltext(query_str), **params)
+        dbapi = self._connector.engine.dialect.dbapi
+        dbapi_connection = connection.connection.connection
+        cursorclass = dbapi_connection.cursorclass
+        dbapi_connection.cursorclass = dbapi.cursors.SSCursor
+        try:
+            return connection.execute(sqltext(query_str), **params)
+        finally:
+            dbapi_connection.cursorclass = cursorclass
+
     def _render_query(self, query, params, annotations):
         """Render a query into its final string form, to send to database.
 
@@ -719,11 +974,9 @@ class DBConnection(object):
         if isinstance(query, basestring):
             query_str = query
         else:
-            dialect = self._connector._render_query_dialect
-            compiled = query.compile(dialect=dialect)
-            for param, value in compiled.params.iteritems():
+            query_str, default_params = self._connector.render_query(query)
+            for param, value in default_params.iteritems():
                 params.setdefault(param, value)
-            query_str = str(compiled)
         # Join all the annotations into a comment string.
         if annotations:
             annotation_items = sorted(annotations.items())
@@ -783,17 +1036,33 @@ class DBConnection(object):
         finally:
             res.close()
 
-    def query_fetchall(self, query_name, params=None, annotations=None):
-        """Execute a named query, returning iterator over the results."""
+    def query_fetchall(self, query_name, params=None, annotations=None,
+                       stream_results=False):
+        """Execute a named query, returning iterator over the results.
+
+        If stream_results is true and streaming is enabled on the connector,
+        the rows are read from a server-side cursor in batches of a fixed
+        size.  This bounds the memory used by the driver for large results,
+        but the iterator must be exhausted before executing another query.
+        """
         query = self._connector.get_query(query_name, params)
         if query is not None:
             if annotations is None:
                 annotations = {}
             annotations.setdefault("queryName", query_name)
-            res = self.execute(query, params, annotations)
+            stream_results = stream_results and self._connector.stream_results
+            res = self.execute(query, params, annotations, stream_results)
             try:
-                for row in res:
-                    yield row
+                if not stream_results:
+                    for row in res:
+                        yield row
+                else:
+                    batch_size = self._connector.stream_results_batch_size
+                    rows = res.fetchmany(batch_size)
+                    while rows:
+                        for row in rows:
+                            yield row
+                        rows = res.fetchmany(batch_size)
             finally:
                 res.close()
 
@@ -808,7 +1077,8 @@ class DBConnection(object):
         For generic database backends, the best we can do is try each insert,
         catch any IntegrityErrors and retry as an update.  For MySQL however
         we can use the "ON DUPLICATE KEY UPDATE" syntax to do the operation
-        in a single query.
+        in a single query, and for PostgreSQL and recent versions of SQLite
+        we can do likewise with the "ON CONFLICT DO UPDATE" syntax.
 
         The number of newly-inserted rows is returned.
         """
@@ -832,9 +1102,13 @@ class DBConnection(object):
         else:
             table = metadata.tables[table]
         # Dispatch to an appropriate implementation.
-        if self._connector.driver == "mysql":
+        upsert_style = self._connector.upsert_style
+        if upsert_style == "onduplicatekey":
             return self._upsert_onduplicatekey(table, items, defaults,
                                                annotations)
+        elif upsert_style == "onconflict":
+            return self._upsert_onconflict(table, items, defaults,
+                                           annotations)
         else:
             return self._upsert_generic(table, items, defaults, annotations)
 
@@ -890,46 +1164,13 @@ class DBConnection(object):
         The values from the given items will be collected into a matching set
         of bind parameters :c11 through :cMN  when executing the query.
         """
-        userid = items[0].get("userid")
-        # Group the items to be inserted into batches that all have the same
-        # set of fields.  Each batch will have the same ON DUPLICATE KEY UPDATE
-        # clause and so can be sent as a single query.
-        batches = defaultdict(list)
-        for item in items:
-            assert item.get("userid") == userid
-            batches[frozenset(item.iterkeys())].append(item)
-        # Now construct and send an appropriate query for each batch.
+        # Each batch of items with the same set of fields will have the same
+        # ON DUPLICATE KEY UPDATE clause and so can be sent as a single query.
         num_created = 0
-        for batch in batches.itervalues():
-            # Since we're crafting SQL by hand, assert that each field is
-            # actually a plain alphanum field name.  Can't be too careful...
-            update_fields = batch[0].keys()
-            insert_fields = batch[0].keys()
-            if defaults is not None:
-                for field in defaults:
-                    if field not in batch[0]:
-                        insert_fields.append(field)
-            assert all(SAFE_FIELD_NAME_RE.match(f) for f in update_fields)
-            assert all(SAFE_FIELD_NAME_RE.match(f) for f in insert_fields)
-            # Each item corresponds to a set of bindparams and a matching
-            # entry in the "VALUES" clause of the query.
-            query = "INSERT INTO %s (%s) VALUES "\
-                    % (table.name, ",".join(insert_fields))
-            binds = [":%s%%(num)d" % field for field in insert_fields]
-            pattern = "(%s) " % ",".join(binds)
-            params = {}
-            vclauses = []
-            for num, item in enumerate(batch):
-                vclauses.append(pattern % {"num": num})
-                for field in insert_fields:
-                    try:
-                        value = item[field]
-                    except KeyError:
-                        value = defaults[field]
-                    params["%s%d" % (field, num)] = value
-            query += ",".join(vclauses)
+        for batch in self._group_upsert_items(items, defaults):
+            query, params = self._render_multi_insert(table, batch, defaults)
             # The ON DUPLICATE KEY CLAUSE updates all the given fields.
-            updates = ["%s = VALUES(%s)" % (f, f) for f in update_fields]
+            updates = ["%s = VALUES(%s)" % (f, f) for f in batch[0]]
             query += " ON DUPLICATE KEY UPDATE " + ",".join(updates)
             # Now we can execute it as one big query.
             res = self.execute(query, params, annotations)
@@ -943,3 +1184,138 @@ class DBConnection(object):
             finally:
                 res.close()
         return num_created
+
+    def _upsert_onconflict(self, table, items, defaults, annotations):
+        """Upsert a batch of items using the ON CONFLICT DO UPDATE syntax.
+
+        This is the PostgreSQL and SQLite equivalent of the MySQL-specific
+        _upsert_onduplicatekey, producing queries like:
+
+            INSERT INTO table (c1, ..., cM)
+            VALUES (:c11, ..., :cM1), ..., (:c1N, ... :cMN)
+            ON CONFLICT (k1, ..., kK)
+            DO UPDATE SET c1 = excluded.c1, ..., cM = excluded.cM
+
+        Unlike MySQL, the rowcount doesn't tell us how many rows were created.
+        PostgreSQL can report it via the RETURNING clause, while for SQLite we
+        count the existing rows beforehand; SQLite takes a database-level lock
+        for writes, so they can't change before the upsert is done.
+        """
+        pkey_fields = [key.name for key in table.primary_key]
+        assert all(SAFE_FIELD_NAME_RE.match(f) for f in pkey_fields)
+        num_created = 0
+        for batch in self._group_upsert_items(items, defaults):
+            for field in pkey_fields:
+                if field not in batch[0]:
+                    msg = "Item is missing primary key column %r"
+                    raise ValueError(msg % (field,))
+            # Neither database allows a single statement to affect the same
+            # row twice, so if there are duplicate items then keep the last.
+            # This matches the result of upserting them in order.
+            unique_items = {}
+            for item in batch:
+                unique_items[tuple(item[f] for f in pkey_fields)] = item
+            if len(unique_items) < len(batch):
+                batch = unique_items.values()
+            query, params = self._render_multi_insert(table, batch, defaults)
+            query += " ON CONFLICT (%s) " % (",".join(pkey_fields),)
+            updates = ["%s = excluded.%s" % (f, f)
+                       for f in batch[0] if f not in pkey_fields]
+            if updates:
+                query += "DO UPDATE SET " + ",".join(updates)
+            else:
+                query += "DO NOTHING"
+            if self._connector.driver == "postgres":
+                # The xmax system column is zero for freshly-inserted rows.
+                query += " RETURNING (xmax = 0)"
+                res = self.execute(query, params, annotations)
+                try:
+                    num_created += sum(1 for row in res if row[0])
+                finally:
+                    res.close()
+            else:
+                num_existing = self._count_existing_items(table, pkey_fields,
+                                                          batch, annotations)
+                self.execute(query, params, annotations).close()
+                num_created += len(batch) - num_existing
+        return num_created
+
+    def _count_existing_items(self, table, pkey_fields, items, annotations):
+        """Count how many of the given items already exist in the table."""
+        params = {}
+        vclauses = []
+        for num, item in enumerate(items):
+            binds = []
+            for field in pkey_fields:
+                params["%s%d" % (field, num)] = item[field]
+                binds.append(":%s%d" % (field, num))
+            vclauses.append("(%s)" % (",".join(binds),))
+        query = "SELECT COUNT(*) FROM %s WHERE (%s) IN (VALUES %s)"\
+                % (table.name, ",".join(pkey_fields), ",".join(vclauses))
+        res = self.execute(query, params, annotations)
+        try:
+            return res.fetchone()[0]
+        finally:
+            res.close()
+
+    def _group_upsert_items(self, items, defaults=None):
+        """Group items into batches that can be upserted in a single query.
+
+        Each batch contains items with the same set of fields, and is limited
+        in size to keep within the driver's limit on the number of params.
+        Any fields that will be filled in from the defaults count towards
+        that limit, since they're sent as params too.
+        """
+        userid = items[0].get("userid")
+        batches = defaultdict(list)
+        for item in items:
+            assert item.get("userid") == userid
+            batches[frozenset(item.iterkeys())].append(item)
+        max_params = self._connector.max_query_params
+        for fields, batch in batches.iteritems():
+            if max_params is None:
+                yield batch
+                continue
+            # Each row has a param for each of the insert columns, i.e. the
+            # fields from the item plus any that are added from the defaults.
+            num_columns = len(fields.union(defaults or ()))
+            batch_size = max(max_params // num_columns, 1)
+            for i in xrange(0, len(batch), batch_size):
+                yield batch[i:i + batch_size]
+
+    def _render_multi_insert(self, table, batch, defaults):
+        """Render a multi-row INSERT statement for the given batch of items.
+
+        All items in the batch must have the same set of fields.  This returns
+        the query string along with the dict of params to use with it.  The
+        values from the given items will be collected into a matching set of
+        bind parameters :c11 through :cMN when executing the query.
+        """
+        # Since we're crafting SQL by hand, assert that each field is
+        # actually a plain alphanum field name.  Can't be too careful...
+        update_fields = batch[0].keys()
+        insert_fields = batch[0].keys()
+        if defaults is not None:
+            for field in defaults:
+                if field not in batch[0]:
+                    insert_fields.append(field)
+        assert all(SAFE_FIELD_NAME_RE.match(f) for f in update_fields)
+        assert all(SAFE_FIELD_NAME_RE.match(f) for f in insert_fields)
+        # Each item corresponds to a set of bindparams and a matching
+        # entry in the "VALUES" clause of the query.
+        query = "INSERT INTO %s (%s) VALUES "\
+                % (table.name, ",".join(insert_fields))
+        binds = [":%s%%(num)d" % field for field in insert_fields]
+        pattern = "(%s) " % ",".join(binds)
+        params = {}
+        vclauses = []
+        for num, item in enumerate(batch):
+            vclauses.append(pattern % {"num": num})
+            for field in insert_fields:
+                try:
+                    value = item[field]
+                except KeyError:
+                    value = defaults[field]
+                params["%s%d" % (field, num)] = value
+        query += ",".join(vclauses)
+        return query, params
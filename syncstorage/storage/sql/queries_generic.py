@@ -15,28 +15,38 @@ string interpolation variables with special meaning:
     * %(bui)s:   insert the name of the user's sharded batch_upload_items table
     * %(ids)s:   insert a list of items matching the "ids" query parameter.
 
+Queries written as functions may also provide a "cache_key" attribute,
+a function that maps the query parameters to a hashable key.  Parameters
+with the same key must produce the same SQL, which lets the connector cache
+the rendered SQL string instead of rebuilding it on every call.  This means
+such queries must use bindparams for *all* values, including limit/offset,
+and use ":id0" through ":idN" to refer to items in the "ids" parameter.
+
 """
 
-from sqlalchemy.sql import select, bindparam
+from sqlalchemy.sql import select, bindparam, and_, or_
 
 # Queries operating on all collections in the storage.
 
 STORAGE_TIMESTAMP = "SELECT MAX(last_modified) FROM user_collections "\
                     "WHERE userid=:userid"
 
-STORAGE_SIZE = "SELECT SUM(payload_size) FROM %(bso)s WHERE "\
-               "userid=:userid AND ttl>:ttl"
+COLLECTIONS_USAGE = "SELECT collection, item_count, total_size "\
+                    "FROM user_collections WHERE userid=:userid"
 
-COLLECTIONS_TIMESTAMPS = "SELECT collection, last_modified "\
-                         "FROM user_collections WHERE userid=:userid"
+# This recalculates both the stored usage of each collection, which is what
+# the running totals in user_collections keep track of, and the size of its
+# unexpired items, which is what the user is actually charged for.
 
-COLLECTIONS_COUNTS = "SELECT collection, COUNT(collection) FROM %(bso)s "\
-                     "WHERE userid=:userid AND ttl>:ttl "\
-                     "GROUP BY collection"
+RECALCULATE_COLLECTIONS_USAGE = "SELECT collection, COUNT(*), "\
+                                "SUM(payload_size), "\
+                                "SUM(CASE WHEN ttl>:ttl "\
+                                "THEN payload_size ELSE 0 END) "\
+                                "FROM %(bso)s WHERE userid=:userid "\
+                                "GROUP BY collection"
 
-COLLECTIONS_SIZES = "SELECT collection, SUM(payload_size) FROM %(bso)s "\
-                    "WHERE userid=:userid AND ttl>:ttl "\
-                    "GROUP BY collection"
+COLLECTIONS_TIMESTAMPS = "SELECT collection, last_modified "\
+                         "FROM user_collections WHERE userid=:userid"
 
 DELETE_ALL_BSOS = "DELETE FROM %(bso)s WHERE userid=:userid"
 
@@ -67,6 +77,9 @@ COLLECTION_NAME = "SELECT name FROM collections "\
 COLLECTION_NAMES = "SELECT collectionid, name FROM collections "\
                    "WHERE collectionid IN %(ids)s"
 
+COLLECTIONS = "SELECT collectionid, name FROM collections "\
+              "ORDER BY collectionid LIMIT :limit"
+
 # This adds a dummy collection at (:id - 1) so the next autoincr value is :id.
 SET_MIN_COLLECTION_ID = "INSERT INTO collections (collectionid, name) "\
                         "VALUES (:collectionid - 1, \"\")"
@@ -75,12 +88,82 @@ CREATE_COLLECTION = "INSERT INTO collections (name) "\
                     "VALUES (:name)"
 
 INIT_COLLECTION = "INSERT INTO user_collections "\
-                  "(userid, collection, last_modified) "\
-                  "VALUES (:userid, :collectionid, :modified)"
-
-TOUCH_COLLECTION = "UPDATE user_collections SET last_modified=:modified "\
+                  "(userid, collection, last_modified, "\
+                  "item_count, total_size) "\
+                  "VALUES (:userid, :collectionid, :modified, "\
+                  ":count_delta, :size_delta)"
+
+# Running totals that are NULL, e.g. in rows that predate them, can't be
+# adjusted.  Writes fill them in from the collection's items instead, which
+# by then include the changes being made.  These are the subqueries to do so.
+
+item_count_subquery = "(SELECT COUNT(*) FROM %(bso)s "\
+                      "WHERE userid=:userid AND collection=:collectionid)"
+
+total_size_subquery = "(SELECT COALESCE(SUM(payload_size), 0) FROM %(bso)s "\
+                      "WHERE userid=:userid AND collection=:collectionid)"
+
+TOUCH_COLLECTION = "UPDATE user_collections SET last_modified=:modified, "\
+                   "item_count=COALESCE(item_count+:count_delta, "\
+                   + item_count_subquery + "), "\
+                   "total_size=COALESCE(total_size+:size_delta, "\
+                   + total_size_subquery + ") "\
                    "WHERE userid=:userid AND collection=:collectionid"
 
+# Used by optimistic write locks, to update the collection only if nobody
+# else has updated it since we read its timestamp.
+
+CAS_TOUCH_COLLECTION = "UPDATE user_collections "\
+                       "SET last_modified=:modified, "\
+                       "item_count=COALESCE(item_count+:count_delta, "\
+                       + item_count_subquery + "), "\
+                       "total_size=COALESCE(total_size+:size_delta, "\
+                       + total_size_subquery + ") "\
+                       "WHERE userid=:userid AND collection=:collectionid "\
+                       "AND last_modified=:last_modified"
+
+# Databases with native upserts can touch a collection in a single query.
+# This version is for PostgreSQL and recent versions of SQLite; others
+# fall back to trying TOUCH_COLLECTION and then INIT_COLLECTION.
+
+UPSERT_COLLECTION = "INSERT INTO user_collections "\
+                    "(userid, collection, last_modified, "\
+                    "item_count, total_size) "\
+                    "VALUES (:userid, :collectionid, :modified, "\
+                    ":count_delta, :size_delta) "\
+                    "ON CONFLICT (userid, collection) DO UPDATE SET "\
+                    "last_modified=excluded.last_modified, "\
+                    "item_count=COALESCE(user_collections.item_count"\
+                    "+excluded.item_count, " + item_count_subquery + "), "\
+                    "total_size=COALESCE(user_collections.total_size"\
+                    "+excluded.total_size, " + total_size_subquery + ")"
+
+SET_COLLECTION_USAGE = "UPDATE user_collections "\
+                       "SET item_count=:count, total_size=:size "\
+                       "WHERE userid=:userid AND collection=:collectionid"
+
+# Used to store recalculated totals that are missing.  Since writes fill
+# them in, they can only be stored if no write has done so in the meantime.
+
+FILL_COLLECTION_USAGE = "UPDATE user_collections "\
+                        "SET item_count=:count, total_size=:size "\
+                        "WHERE userid=:userid "\
+                        "AND collection=:collectionid "\
+                        "AND (item_count IS NULL OR total_size IS NULL)"
+
+CAS_SET_COLLECTION_USAGE = "UPDATE user_collections "\
+                           "SET item_count=:count, total_size=:size "\
+                           "WHERE userid=:userid "\
+                           "AND collection=:collectionid "\
+                           "AND last_modified=:last_modified"
+
+ADJUST_COLLECTION_USAGE = "UPDATE user_collections "\
+                          "SET item_count=COALESCE(item_count+:count_delta, "\
+                          + item_count_subquery + "), "\
+                          "total_size=COALESCE(total_size+:size_delta, "\
+                          + total_size_subquery + ") "\
+                          "WHERE userid=:userid AND collection=:collectionid"
+
 COLLECTION_TIMESTAMP = "SELECT last_modified FROM user_collections "\
                        "WHERE userid=:userid AND collection=:collectionid"
 
@@ -90,9 +173,16 @@ DELETE_COLLECTION_ITEMS = "DELETE FROM %(bso)s WHERE userid=:userid "\
 DELETE_COLLECTION = "DELETE FROM user_collections WHERE userid=:userid "\
                     "AND collection=:collectionid"
 
+CAS_DELETE_COLLECTION = "DELETE FROM user_collections "\
+                        "WHERE userid=:userid AND collection=:collectionid "\
+                        "AND last_modified=:last_modified"
+
 DELETE_ITEMS = "DELETE FROM %(bso)s WHERE userid=:userid "\
                "AND collection=:collectionid AND id IN %(ids)s"
 
+ITEMS_SIZES = "SELECT id, payload_size FROM %(bso)s WHERE userid=:userid "\
+              "AND collection=:collectionid AND id IN %(ids)s"
+
 CREATE_BATCH = "INSERT INTO batch_uploads (batch, userid, collection) "\
                      "VALUES (:batch, :userid, :collection)"
 
@@ -181,6 +271,27 @@ APPLY_BATCH_INSERT = """
         )
 """
 
+# The change in stored usage from applying a batch, as the number of new
+# items and the change in size.  Items without a payload keep their existing
+# size, or get an empty payload if they're new.
+
+BATCH_USAGE_DELTA = """
+    SELECT
+        COUNT(*) - COUNT(%(bso)s.id),
+        SUM(COALESCE(%(bui)s.payload_size - %(bso)s.payload_size,
+                     %(bui)s.payload_size,
+                     0))
+    FROM %(bui)s
+    LEFT OUTER JOIN %(bso)s
+    ON
+        %(bso)s.userid = %(bui)s.userid AND
+        %(bso)s.collection = :collection AND
+        %(bso)s.id = %(bui)s.id
+    WHERE
+        %(bui)s.batch = :batch AND
+        %(bui)s.userid = :userid
+"""
+
 CLOSE_BATCH = """
     DELETE FROM batch_uploads
     WHERE batch = :batch AND userid = :userid AND collection = :collection
@@ -192,12 +303,16 @@ CLOSE_BATCH_ITEMS = """
 """
 
 
-def FIND_ITEMS(bso, params):
+def FIND_ITEMS(bso, params, nulls_sort_first=False):
     """Item search query.
 
     Unlike all the other pre-built queries, this one really can't be written
     as a simple string.  We need to include/exclude various WHERE clauses
     based on the values provided at runtime.
+
+    The nulls_sort_first argument says whether the database sorts NULL as
+    larger than any other value, which we need to know in order to seek
+    past items with a NULL sortindex.
     """
     fields = params.get("fields", None)
     if fields is None:
@@ -208,8 +323,10 @@ def FIND_ITEMS(bso, params):
     query = query.where(bso.c.collection == bindparam("collectionid"))
     # Filter by the various query parameters.
     if "ids" in params:
-        # Sadly, we can't use a bindparam in an "IN" expression.
-        query = query.where(bso.c.id.in_(params.get("ids")))
+        # Sadly, we can't use a single bindparam in an "IN" expression.
+        # Refer to each item individually, as with the %(ids)s variable.
+        ids = [bindparam("id%d" % (i,)) for i in xrange(len(params["ids"]))]
+        query = query.where(bso.c.id.in_(ids))
     if "newer" in params:
         query = query.where(bso.c.modified > bindparam("newer"))
     if "newer_eq" in params:
@@ -220,29 +337,85 @@ def FIND_ITEMS(bso, params):
         query = query.where(bso.c.modified <= bindparam("older_eq"))
     if "ttl" in params:
         query = query.where(bso.c.ttl > bindparam("ttl"))
+    if "id_bound" in params:
+        keyset = _sortindex_keyset_filter(bso, params, nulls_sort_first)
+        query = query.where(keyset)
     # Sort it in the order requested.
     # We always sort by *something*, so that limit/offset work consistently.
     # The default order is by timestamp, which if efficient due to the index.
     # NOTE: ideally we would sort by "id" here as secondary column, to get a
     # consistent total ordering.  But we don't want to bloat the index, so
     # we just assume that the db gives results in a consistent order.
+    # Sorting by sortindex does use "id" as a tie-breaker, since it's needed
+    # for keyset pagination and the optional sortindex index includes it.
     sort = params.get("sort", None)
     if sort == 'index':
-        query = query.order_by(bso.c.sortindex.desc())
+        query = query.order_by(bso.c.sortindex.desc(), bso.c.id.desc())
     elif sort == 'oldest':
         query = query.order_by(bso.c.modified.asc())
     else:
         query = query.order_by(bso.c.modified.desc())
     # Apply limit and/or offset.
-    limit = params.get("limit", None)
-    if limit is not None:
-        query = query.limit(limit)
-    offset = params.get("offset", None)
-    if offset is not None:
-        query = query.offset(offset)
+    if params.get("limit", None) is not None:
+        query = query.limit(bindparam("limit"))
+    if params.get("offset", None) is not None:
+        query = query.offset(bindparam("offset"))
     return query
 
 
+def _sortindex_keyset_filter(bso, params, nulls_sort_first):
+    """Filter for items that sort after the given (sortindex, id) position.
+
+    Items are sorted by descending sortindex and then by descending id.
+    Items with a NULL sortindex sort either before or after all the others,
+    depending on the database.
+    """
+    sortindex = bso.c.sortindex
+    after_id = bso.c.id < bindparam("id_bound")
+    if params.get("index_bound") is None:
+        clause = and_(sortindex.is_(None), after_id)
+        if nulls_sort_first:
+            clause = or_(clause, sortindex.isnot(None))
+    else:
+        bound = bindparam("index_bound")
+        clause = or_(sortindex < bound, and_(sortindex == bound, after_id))
+        if not nulls_sort_first:
+            clause = or_(clause, sortindex.is_(None))
+    return clause
+
+
+def _find_items_cache_key(params):
+    """Cache key for the FIND_ITEMS query.
+
+    This captures everything about the params that affects the structure
+    of the generated SQL, but none of the actual values being searched for.
+    """
+    fields = params.get("fields", None)
+    if fields is not None:
+        fields = tuple(fields)
+    num_ids = None
+    if "ids" in params:
+        num_ids = len(params["ids"])
+    filters = tuple(filter in params for filter in _FIND_ITEMS_FILTERS)
+    keyset = None
+    if "id_bound" in params:
+        keyset = params.get("index_bound") is None
+    return (
+        fields,
+        num_ids,
+        filters,
+        keyset,
+        params.get("sort", None),
+        params.get("limit", None) is not None,
+        params.get("offset", None) is not None,
+    )
+
+
+_FIND_ITEMS_FILTERS = ("newer", "newer_eq", "older", "older_eq", "ttl")
+
+FIND_ITEMS.cache_key = _find_items_cache_key
+
+
 # Queries operating on a particular item.
 
 DELETE_ITEM = "DELETE FROM %(bso)s WHERE userid=:userid AND "\
@@ -258,15 +431,21 @@ ITEM_TIMESTAMP = "SELECT modified FROM %(bso)s "\
 
 # Administrative queries
 
-# This query nominally deletes *some* expired items, but not necessarily all.
-# The idea is to delete them in small batches to keep overhead low.
-# Unfortunately there's no generic way to achieve this in SQL so the default
-# case winds up deleting all expired items.  There is a MySQL-specific
-# version using DELETE <ttlblah> LIMIT 1000.
+# Expired items are purged in small batches to keep overhead low.  We find
+# some expired items and then delete them by id, so that the running totals
+# of collection sizes can be reduced to match.  Databases that support it
+# lock the found rows, so they can't be rewritten before they're deleted.
 
-PURGE_SOME_EXPIRED_ITEMS = """
-    DELETE FROM %(bso)s
+FIND_SOME_EXPIRED_ITEMS = """
+    SELECT userid, collection, id, payload_size FROM %(bso)s
     WHERE ttl < (:now - :grace)
+    ORDER BY ttl LIMIT :maxitems
+"""
+
+PURGE_EXPIRED_ITEMS = """
+    DELETE FROM %(bso)s
+    WHERE userid = :userid AND collection = :collectionid AND
+          id IN %(ids)s AND ttl < (:now - :grace)
 """
 
 PURGE_BATCHES = """
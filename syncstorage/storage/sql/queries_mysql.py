@@ -8,14 +8,18 @@ This module overrides some queries from queries_generic.py with code
 tailored to MySQL.
 """
 
-# MySQL's non-standard DELETE ORDER BY LIMIT is incredibly useful here.
+from syncstorage.storage.sql.queries_generic import (item_count_subquery,
+                                                     total_size_subquery)
 
-PURGE_SOME_EXPIRED_ITEMS = """
-    DELETE FROM %(bso)s
+FIND_SOME_EXPIRED_ITEMS = """
+    SELECT userid, collection, id, payload_size FROM %(bso)s
     WHERE ttl < (:now - :grace)
     ORDER BY ttl LIMIT :maxitems
+    FOR UPDATE
 """
 
+# MySQL's non-standard DELETE ORDER BY LIMIT is incredibly useful here.
+
 PURGE_BATCHES = """
     DELETE FROM batch_uploads
     WHERE batch < (:now - :lifetime - :grace) * 1000
@@ -36,8 +40,20 @@ OPTIMIZE_BUI_TABLE = """
     OPTIMIZE TABLE %(bui)s
 """
 
-# MySQL's non-standard ON DUPLICATE KEY UPDATE means we can
-# apply a batch efficiently with a single query.
+# MySQL's non-standard ON DUPLICATE KEY UPDATE means we can touch
+# a collection, or apply a batch, efficiently with a single query.
+
+UPSERT_COLLECTION = "INSERT INTO user_collections "\
+                    "(userid, collection, last_modified, "\
+                    "item_count, total_size) "\
+                    "VALUES (:userid, :collectionid, :modified, "\
+                    ":count_delta, :size_delta) "\
+                    "ON DUPLICATE KEY UPDATE "\
+                    "last_modified=VALUES(last_modified), "\
+                    "item_count=COALESCE(item_count+VALUES(item_count), "\
+                    + item_count_subquery + "), "\
+                    "total_size=COALESCE(total_size+VALUES(total_size), "\
+                    + total_size_subquery + ")"
 
 APPLY_BATCH_UPDATE = None
 
@@ -8,6 +8,8 @@ This module overrides some queries from queries_generic.py with code
 tailored to PostgreSQL.
 """
 
+from syncstorage.storage.sql import queries_generic
+
 # Queries for locking/unlocking a collection.
 
 LOCK_COLLECTION_READ = "SELECT last_modified FROM user_collections "\
@@ -29,8 +31,10 @@ CREATE_COLLECTION = "INSERT INTO collections (collectionid, name) "\
                     "VALUES (DEFAULT, :name)"
 
 INIT_COLLECTION = "INSERT INTO user_collections "\
-                  "(userid, collection, last_modified) "\
-                  "  SELECT :userid, :collectionid, :modified "\
+                  "(userid, collection, last_modified, "\
+                  " item_count, total_size) "\
+                  "  SELECT :userid, :collectionid, :modified, "\
+                  "         :count_delta, :size_delta "\
                   "  WHERE NOT EXISTS "\
                   "    (SELECT 1 FROM user_collections "\
                   "     WHERE userid=:userid AND collection=:collectionid)"
@@ -54,6 +58,13 @@ END;
 $do$;
 """.strip()
 
+FIND_SOME_EXPIRED_ITEMS = """
+    SELECT userid, collection, id, payload_size FROM %(bso)s
+    WHERE ttl < (:now - :grace)
+    ORDER BY ttl LIMIT :maxitems
+    FOR UPDATE
+"""
+
 # Postgres seems to want to do 32-bit integer math by default,
 # so coerce things into bigints to avoid overflow.
 
@@ -66,3 +77,49 @@ PURGE_BATCH_CONTENTS = """
     DELETE FROM %(bui)s
     WHERE batch < (:now - :lifetime - :grace)::BIGINT * 1000
 """
+
+# Postgres' ON CONFLICT DO UPDATE means we can apply a batch efficiently
+# with a single query.  Unlike MySQL we can't refer to the source table in
+# the DO UPDATE clause, so we look up the corresponding batch item by its
+# primary key to coalesce partial updates with the existing values.  This
+# avoids joining the two tables in the SELECT, for which the planner can pick
+# a quadratic nested loop if the table stats are stale after a bulk load.
+
+APPLY_BATCH_UPDATE = None
+
+APPLY_BATCH_INSERT = """
+    INSERT INTO %(bso)s
+        (userid, collection, id, sortindex, payload,
+        payload_size, ttl, modified)
+    SELECT
+        :userid, :collection, id, sortindex,
+        COALESCE(payload, ''),
+        COALESCE(payload_size, 0),
+        COALESCE(ttl_offset + :ttl_base, :default_ttl),
+        :modified
+    FROM %(bui)s
+    WHERE batch = :batch AND userid = :userid
+    ON CONFLICT (userid, collection, id) DO UPDATE SET
+        (sortindex, payload, payload_size, ttl, modified) = (
+            SELECT
+                COALESCE(%(bui)s.sortindex, %(bso)s.sortindex),
+                COALESCE(%(bui)s.payload, %(bso)s.payload),
+                COALESCE(%(bui)s.payload_size, %(bso)s.payload_size),
+                COALESCE(%(bui)s.ttl_offset + :ttl_base, %(bso)s.ttl),
+                :modified
+            FROM %(bui)s
+            WHERE %(bui)s.batch = :batch AND
+                  %(bui)s.userid = :userid AND
+                  %(bui)s.id = EXCLUDED.id
+        )
+"""
+
+
+# PostgreSQL sorts NULL as larger than any other value, so items with a NULL
+# sortindex come first in descending order rather than last.
+
+def FIND_ITEMS(bso, params):
+    return queries_generic.FIND_ITEMS(bso, params, nulls_sort_first=True)
+
+
+FIND_ITEMS.cache_key = queries_generic.FIND_ITEMS.cache_key
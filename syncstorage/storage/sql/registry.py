@@ -0,0 +1,279 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Caching of collection names and ids for the SQL storage backend.
+
+Almost every request needs to map a collection name to its id or vice-versa,
+but the mapping changes very rarely, so we keep it in memory:
+
+  CollectionsCache:  a bounded, bidirectional name <=> id cache for use
+                     within a single process.
+  CollectionsRegistry:  an append-only log of (id, name) pairs in a memory-
+                        mapped file, so that all worker processes on a host
+                        can share the names learned by any one of them.
+
+The registry file stores a fixed header followed by a sequence of records.
+The header holds a magic string and the number of bytes of committed data,
+and each record is a packed (id, length) pair followed by the name itself.
+Writers take an exclusive flock() on the file while appending, and bump
+the committed length only after the record data has been written, so that
+readers can safely consume the mmapped data without taking any locks.
+
+Since records are never removed from the registry, it must only ever be
+shared by processes talking to the same database, and must only be given
+collections that have been committed to it.  It's checked against the
+database when each process starts up, and ignored if it doesn't match.
+"""
+
+import os
+import mmap
+import fcntl
+import struct
+import logging
+import threading
+
+from repoze.lru import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_MAGIC = "SYNCCOL1"
+
+REGISTRY_HEADER = struct.Struct("<8sQ")
+
+REGISTRY_RECORD = struct.Struct("<IH")
+
+# Grow the file in chunks of this size, to avoid remapping it too often.
+REGISTRY_CHUNK_SIZE = 64 * 1024
+
+
+class CollectionsCache(object):
+    """Bounded bidirectional cache mapping collection names <=> ids.
+
+    This is an LRU cache holding up to max_size entries in each direction.
+    Any "pinned" collections are always available and are never evicted,
+    which is important for the fixed ids of the standard collections since
+    they do not exist in the database.
+
+    If a CollectionsRegistry is provided then it will be consulted on each
+    cache miss, and newly-cached collections will be added to it.
+    """
+
+    def __init__(self, max_size, pinned=None, registry=None):
+        self.max_size = max_size
+        self.registry = registry
+        self._pinned_by_name = {}
+        self._pinned_by_id = {}
+        if pinned is not None:
+            for id, name in pinned.iteritems():
+                self._pinned_by_name[name] = id
+                self._pinned_by_id[id] = name
+        self._by_name = LRUCache(max_size)
+        self._by_id = LRUCache(max_size)
+
+    def get_id(self, name):
+        """Get the id for the named collection, or None if not cached."""
+        try:
+            return self._pinned_by_name[name]
+        except KeyError:
+            pass
+        id = self._by_name.get(name)
+        if id is None and self.refresh_from_registry():
+            id = self._by_name.get(name)
+        return id
+
+    def get_name(self, id):
+        """Get the name of the given collection id, or None if not cached."""
+        try:
+            return self._pinned_by_id[id]
+        except KeyError:
+            pass
+        name = self._by_id.get(id)
+        if name is None and self.refresh_from_registry():
+            name = self._by_id.get(id)
+        return name
+
+    def add(self, id, name):
+        """Add the given (id, name) pair to the cache."""
+        self.add_many([(id, name)])
+
+    def add_many(self, items):
+        """Add the given sequence of (id, name) pairs to the cache."""
+        items = list(items)
+        if self.registry is not None:
+            items.extend(self.registry.append(items))
+        self._put(items)
+
+    def check_registry(self, items, complete=False):
+        """Check the registry against the given (id, name) pairs from the db.
+
+        If the registry disagrees with them then it must have been written
+        for a different database, or for data that has since been lost.  Its
+        records can't be removed, so it's closed and no longer used by this
+        cache, and an error is logged.  If complete is True then the pairs
+        are all of the collections in the database, and any other ids in the
+        registry are also treated as a mismatch.  Otherwise, the registered
+        collections are loaded into the cache.
+
+        Returns True if the registry is still in use, False otherwise.
+        """
+        if self.registry is None:
+            return False
+        names = dict(items)
+        ids = dict((name, id) for id, name in items)
+        records = self.registry.refresh()
+        for id, name in records:
+            if id in names:
+                matches = names[id] == name
+            else:
+                matches = not complete and name not in ids
+            if not matches:
+                logger.error("Collections registry %r does not match the "
+                             "database; not using it", self.registry.filename)
+                self.registry.close()
+                self.registry = None
+                return False
+        self._put(records)
+        return True
+
+    def refresh_from_registry(self):
+        """Load any collections newly added to the registry.
+
+        Returns True if any new collections were loaded, False otherwise.
+        """
+        if self.registry is None:
+            return False
+        return self._put(self.registry.refresh())
+
+    def _put(self, items):
+        put = False
+        for id, name in items:
+            self._by_name.put(name, id)
+            self._by_id.put(id, name)
+            put = True
+        return put
+
+
+class CollectionsRegistry(object):
+    """Append-only log of collection (id, name) pairs in a shared file.
+
+    Each process keeps a read offset into the file, and the refresh() method
+    returns any records that have been appended since it was last called.
+    The set of ids seen in the log is remembered so that append() does not
+    write duplicate records.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0600)
+        self._mmap = None
+        self._offset = REGISTRY_HEADER.size
+        self._logged_ids = set()
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size < REGISTRY_HEADER.size:
+                    self._write_header(REGISTRY_HEADER.size)
+                self._remap()
+                magic, _ = REGISTRY_HEADER.unpack_from(self._mmap, 0)
+                if magic != REGISTRY_MAGIC:
+                    msg = "Not a collections registry file: %r"
+                    raise ValueError(msg % (filename,))
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        except Exception:
+            # Don't leak the file descriptor or mapping if setup fails.
+            self.close()
+            raise
+
+    def close(self):
+        """Close the underlying file."""
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def refresh(self):
+        """Get a list of (id, name) pairs appended since the last refresh."""
+        with self._lock:
+            return self._read_new_records()
+
+    def append(self, items):
+        """Append the given (id, name) pairs to the log.
+
+        Any pairs that are already in the log are silently ignored, including
+        those appended concurrently by other processes.  Since this requires
+        catching up with the log, it returns a list of any (id, name) pairs
+        that would otherwise have been returned by the next refresh().
+        """
+        with self._lock:
+            items = [item for item in items
+                     if item[0] not in self._logged_ids]
+            if not items:
+                return []
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                records = self._read_new_records()
+                data = []
+                for id, name in items:
+                    if id not in self._logged_ids:
+                        self._logged_ids.add(id)
+                        name = name.encode("utf8")
+                        data.append(REGISTRY_RECORD.pack(id, len(name)))
+                        data.append(name)
+                if data:
+                    self._write_records("".join(data))
+                return records
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _read_new_records(self):
+        """Read any records after our current offset.
+
+        This must be called while holding self._lock.
+        """
+        _, length = REGISTRY_HEADER.unpack_from(self._mmap, 0)
+        if length > len(self._mmap):
+            self._remap()
+        records = []
+        offset = self._offset
+        while offset < length:
+            id, size = REGISTRY_RECORD.unpack_from(self._mmap, offset)
+            offset += REGISTRY_RECORD.size
+            name = self._mmap[offset:offset + size].decode("utf8")
+            offset += size
+            self._logged_ids.add(id)
+            records.append((id, name))
+        self._offset = offset
+        return records
+
+    def _write_records(self, data):
+        """Write record data at the end of the log and commit it.
+
+        This must be called while holding self._lock and the file lock,
+        and after reading all existing records.
+        """
+        length = self._offset + len(data)
+        size = os.fstat(self._fd).st_size
+        if length > size:
+            size = (length // REGISTRY_CHUNK_SIZE + 1) * REGISTRY_CHUNK_SIZE
+            os.ftruncate(self._fd, size)
+        os.lseek(self._fd, self._offset, os.SEEK_SET)
+        os.write(self._fd, data)
+        self._write_header(length)
+        self._offset = length
+
+    def _write_header(self, length):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.write(self._fd, REGISTRY_HEADER.pack(REGISTRY_MAGIC, length))
+
+    def _remap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        size = os.fstat(self._fd).st_size
+        self._mmap = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
@@ -27,6 +27,7 @@ import contextlib
 # import math
 
 from pyramid.interfaces import IAuthenticationPolicy
+from pyramid.httpexceptions import HTTPPreconditionFailed
 
 import tokenlib
 
@@ -62,6 +63,10 @@ class TestStorage(StorageFunctionalTestCase):
         # Reset the storage to a known state, aka "empty".
         self.app.delete(self.root)
 
+    def assertRecordCount(self, resp, count):
+        """Check the X-Weave-Records header of a multi-record response."""
+        self.assertEquals(int(resp.headers['X-Weave-Records']), count)
+
     @contextlib.contextmanager
     def _switch_user(self):
         orig_root = self.root
@@ -144,7 +149,7 @@ class TestStorage(StorageFunctionalTestCase):
         res = resp.json
         res.sort()
         self.assertEquals(res, ['0', '1', '2', '3', '4'])
-        self.assertEquals(int(resp.headers['X-Weave-Records']), 5)
+        self.assertRecordCount(resp, 5)
 
         # trying various filters
 
@@ -533,6 +538,21 @@ class TestStorage(StorageFunctionalTestCase):
         self.assertEquals(items[0]["payload"], bsos[0]["payload"])
         self.assertEquals(items[1]["payload"], bsos[1]["payload"])
 
+    def test_large_payloads_are_rendered_correctly_after_update(self):
+        # Large payloads have their escaped form cached by the renderer.
+        for char in ("\"", "\n", "X"):
+            payload = "{%s}" % (char * 10000,)
+            bso = {"id": "big", "payload": payload}
+            self.app.post_json(self.root + "/storage/col2", [bso])
+            for _ in xrange(2):
+                item = self.app.get(self.root + "/storage/col2/big").json
+                self.assertEquals(item["payload"], payload)
+                res = self.app.get(self.root + "/storage/col2?full=1")
+                self.assertEquals(res.json[0]["payload"], payload)
+                res = self.app.get(self.root + "/storage/col2?full=1",
+                                   headers={"Accept": "application/newlines"})
+                self.assertEquals(json_loads(res.body)["payload"], payload)
+
     def test_collection_usage(self):
         self.app.delete(self.root + "/storage")
 
@@ -547,6 +567,33 @@ class TestStorage(StorageFunctionalTestCase):
         wanted = (len(bso1['payload']) + len(bso2['payload'])) / 1024.0
         self.assertEqual(round(col2_size, 2), round(wanted, 2))
 
+    def test_collection_counts_and_usage_include_expired_items(self):
+        # This can't be run against a live server.
+        if self.distant:
+            raise unittest2.SkipTest
+
+        bsos = [{'id': '1', 'payload': 'x' * 1024},
+                {'id': '2', 'payload': 'x' * 1024, 'ttl': 1}]
+        self.app.post_json(self.root + '/storage/col3', bsos)
+        time.sleep(2.1)
+        items = self.app.get(self.root + '/storage/col3').json
+        self.assertEquals(items, ['1'])
+
+        # The counts and usage are kept as running totals, so they
+        # include expired items until those are purged.
+        res = self.app.get(self.root + '/info/collection_counts')
+        self.assertEquals(res.json, {'col3': 2})
+        res = self.app.get(self.root + '/info/collection_usage')
+        self.assertEquals(res.json, {'col3': 2.0})
+
+        for key in self.config.registry:
+            if key.startswith("syncstorage:storage:"):
+                self.config.registry[key].purge_expired_items()
+        res = self.app.get(self.root + '/info/collection_counts')
+        self.assertEquals(res.json, {'col3': 1})
+        res = self.app.get(self.root + '/info/collection_usage')
+        self.assertEquals(res.json, {'col3': 1.0})
+
     def test_delete_collection_items(self):
         # creating a collection of three
         bso1 = {'id': '12', 'payload': _PLD}
@@ -1465,7 +1512,7 @@ class TestStorage(StorageFunctionalTestCase):
         res = resp.json
         res.sort()
         self.assertEquals(res, ['12', '13', '14', 'a', 'b', 'c'])
-        self.assertEquals(int(resp.headers['X-Weave-Records']), 6)
+        self.assertRecordCount(resp, 6)
         resp = self.app.get(endpoint + '/13')
         self.assertEquals(resp.json['payload'], 'portnoy')
         self.assertEquals(committed, float(resp.headers['X-Last-Modified']))
@@ -2129,6 +2176,75 @@ class TestStoragePaginated(TestStorage):
     TEST_INI_FILE = "tests-paginated.ini"
 
 
+class TestStorageStreaming(TestStorage):
+    """Storage testcases run using streamed internal pagination."""
+
+    TEST_INI_FILE = "tests-streaming.ini"
+
+    def assertRecordCount(self, resp, count):
+        # Multi-page responses are streamed, so the total isn't known
+        # in advance and the X-Weave-Records header is omitted.
+        if count > 4:
+            self.assertTrue("X-Weave-Records" not in resp.headers)
+            self.assertEquals(len(resp.json), count)
+        else:
+            super(TestStorageStreaming, self).assertRecordCount(resp, count)
+
+    def test_streamed_responses_match_buffered_output(self):
+        bsos = [{"id": str(i), "payload": "x\ny" * i} for i in xrange(10)]
+        resp = self.app.post_json(self.root + "/storage/col2", bsos)
+        ts = resp.json["modified"]
+
+        resp = self.app.get(self.root + "/storage/col2?full=1&sort=oldest")
+        self.assertTrue("X-Weave-Records" not in resp.headers)
+        self.assertEquals(float(resp.headers["X-Last-Modified"]), ts)
+        items = json_loads(resp.body)
+        self.assertEquals(len(items), 10)
+        # A large-but-limited request is paginated without streaming.
+        resp = self.app.get(self.root + "/storage/col2?full=1&sort=oldest"
+                            "&limit=100")
+        self.assertEquals(int(resp.headers["X-Weave-Records"]), 10)
+        self.assertEquals(json_loads(resp.body), items)
+
+        resp = self.app.get(self.root + "/storage/col2?full=1&sort=oldest",
+                            headers={"Accept": "application/newlines"})
+        self.assertTrue("X-Weave-Records" not in resp.headers)
+        lines = resp.body.split("\n")
+        self.assertEquals(lines.pop(), "")
+        self.assertEquals([json_loads(line) for line in lines], items)
+
+        # Limited requests are not streamed, to preserve X-Weave-Next-Offset.
+        resp = self.app.get(self.root + "/storage/col2?limit=6")
+        self.assertEquals(int(resp.headers["X-Weave-Records"]), 6)
+        self.assertTrue("X-Weave-Next-Offset" in resp.headers)
+
+    def test_streamed_response_aborts_on_concurrent_write(self):
+        bsos = [{"id": str(i), "payload": "xxx"} for i in xrange(10)]
+        self.app.post_json(self.root + "/storage/col2", bsos)
+        storage = self.config.registry["syncstorage:storage:default"]
+        orig_get_item_ids = storage.get_item_ids
+        calls = []
+
+        def get_item_ids_and_write(userid, collection, **kwds):
+            calls.append(True)
+            if len(calls) == 2:
+                storage.set_items(userid, collection, bsos[:1])
+            return orig_get_item_ids(userid, collection, **kwds)
+
+        # The write uses the timestamp of the session in which it is made,
+        # so make sure that will be later than the timestamp of the POST.
+        time.sleep(0.02)
+
+        # The status line has already been sent by the time the conflict
+        # is detected, so the error propagates out to abort the response.
+        storage.get_item_ids = get_item_ids_and_write
+        try:
+            self.assertRaises(HTTPPreconditionFailed, self.app.get,
+                              self.root + "/storage/col2")
+        finally:
+            storage.get_item_ids = orig_get_item_ids
+
+
 class TestStorageWithBatchUploadDisabled(TestStorage):
     """Storage testcases run with batch uploads disabled via feature flag."""
 
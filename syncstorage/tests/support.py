@@ -53,6 +53,8 @@ def validate_database_query(conn, cursor, statement, *args):
         return
     if " pg_class " in statement:
         return
+    if " pg_catalog." in statement:
+        return
     if "queryName=" not in statement:
         assert False, "SQL query does not have a name: %s" % (statement,)
 
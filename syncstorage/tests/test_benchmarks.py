@@ -0,0 +1,77 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import sys
+import json
+import unittest2
+from StringIO import StringIO
+
+from syncstorage.storage.memcached import MemcachedClient
+from syncstorage.benchmarks import sessions, contention
+from syncstorage.benchmarks.mcserver import MemcachedServer
+
+
+class TestMemcachedServer(unittest2.TestCase):
+
+    def setUp(self):
+        self.server = MemcachedServer()
+        self.server.start()
+        self.client = MemcachedClient(self.server.address)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_basic_commands(self):
+        self.assertEquals(self.client.get("a"), None)
+        self.assertTrue(self.client.set("a", {"x": 1}))
+        self.assertEquals(self.client.get("a"), {"x": 1})
+        self.assertFalse(self.client.add("a", 2))
+        self.assertTrue(self.client.add("b", 2))
+        self.assertFalse(self.client.replace("c", 3))
+        self.assertEquals(self.client.get_multi(["a", "b", "c"]),
+                          {"a": {"x": 1}, "b": 2})
+        value, casid = self.client.gets("b")
+        self.assertTrue(self.client.cas("b", 3, casid))
+        self.assertFalse(self.client.cas("b", 4, casid))
+        self.assertEquals(self.client.get("b"), 3)
+        self.assertTrue(self.client.delete("b"))
+        self.assertFalse(self.client.delete("b"))
+
+
+class TestSessionsBenchmark(unittest2.TestCase):
+
+    def _run_benchmark(self, *args):
+        orig_stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.assertEquals(sessions.main(list(args)), 0)
+            return json.loads(sys.stdout.getvalue())
+        finally:
+            sys.stdout = orig_stdout
+
+    def test_sessions_against_memcached_storage(self):
+        results = self._run_benchmark("--backend", "memcached",
+                                      "--sessions", "10", "--seed", "42")
+        self.assertEquals(results["sessions"], 10)
+        operations = results["operations"]
+        self.assertEquals(operations["get_info_collections"]["count"], 10)
+        for stats in operations.itervalues():
+            self.assertTrue(stats["p50_ms"] <= stats["p99_ms"])
+
+
+class TestContentionBenchmark(unittest2.TestCase):
+
+    def test_writers_in_each_locking_mode(self):
+        orig_stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            args = ["--users", "2", "--writers", "2", "--writes", "3"]
+            self.assertEquals(contention.main(args), 0)
+            results = json.loads(sys.stdout.getvalue())
+        finally:
+            sys.stdout = orig_stdout
+        self.assertEquals(sorted(results["modes"]), ["locking", "optimistic"])
+        for stats in results["modes"].itervalues():
+            self.assertEquals(stats["writes"] + stats["failures"], 12)
+            self.assertTrue(stats["p50_ms"] <= stats["p99_ms"])
@@ -87,3 +87,13 @@ class TestBSO(unittest2.TestCase):
         bso = BSO(data)
         result, failure = bso.validate()
         self.assertFalse(result)
+
+    def test_from_row_skips_nulls_and_unknown_fields(self):
+        row = [("userid", 42), ("id", "abc"), ("sortindex", None),
+               ("modified", 1234), ("payload", "data"), ("ttl", None)]
+        bso = BSO.from_row(row, fields=("id", "sortindex", "payload"))
+        self.assertTrue(isinstance(bso, BSO))
+        self.assertEquals(bso, {"id": "abc", "payload": "data"})
+        bso = BSO.from_row(row)
+        self.assertEquals(bso, {"id": "abc", "modified": 1234,
+                                "payload": "data"})
@@ -4,21 +4,30 @@
 
 import unittest2
 import time
+import threading
 
 try:
     from syncstorage.storage.memcached import MemcachedStorage  # NOQA
     from syncstorage.storage.memcached import SIZE_RECALCULATION_PERIOD
+    from syncstorage.storage.memcached import FLAG_ZLIB, FLAG_MSGPACK
+    from syncstorage.storage.memcached import JSONCodec, get_value_codec
+    from syncstorage.storage.memcached import HashRing, LocalCache
     MEMCACHED = True
 except ImportError:
     MEMCACHED = False
 
 from mozsvc.exceptions import BackendError
 
+from syncstorage.util import get_timestamp
+from syncstorage.profiler import start_profile, stop_profile
+from syncstorage.storage.sql import SQLStorage
+from syncstorage.benchmarks.mcserver import MemcachedServer
 from syncstorage.tests.support import StorageTestCase
 from syncstorage.tests.test_storage import StorageTestsMixin
 
 from syncstorage.storage import (load_storage_from_settings,
                                  CollectionNotFoundError,
+                                 ConflictError,
                                  ItemNotFoundError)
 
 _UID = 1
@@ -44,6 +53,17 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         except BackendError:
             raise unittest2.SkipTest
 
+    def _get_cached_collection(self, collection):
+        # Read the index and buckets for a collection straight from memcache.
+        index = self.storage.cache.get('1:c:' + collection)
+        if index is None:
+            return None
+        items = {}
+        for bucket in index['buckets']:
+            key = '1:c:%s:%s' % (collection, bucket)
+            items.update(self.storage.cache.get(key)['items'])
+        return {'modified': index['modified'], 'items': items}
+
     def test_basic(self):
         # just make sure calls goes through
         self.storage.set_item(_UID, 'col1', '1', {'payload': _PLD})
@@ -66,7 +86,7 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         self.assertEquals(res['payload'], _PLD)
 
         # That should have populated some cache entries.
-        collection = self.storage.cache.get('1:c:meta')
+        collection = self._get_cached_collection('meta')
         self.assertEquals(collection["items"].keys(), ["global"])
         metadata = self.storage.cache.get('1:metadata')
         self.assertTrue(metadata['collections']['meta'])
@@ -80,7 +100,7 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         time.sleep(0.01)
         self.storage.delete_item(_UID, 'meta', 'global')
 
-        collection = self.storage.cache.get('1:c:meta')
+        collection = self._get_cached_collection('meta')
         self.assertEquals(collection["items"].keys(), [])
         metadata = self.storage.cache.get('1:metadata')
         self.assertEquals(metadata['size'], len(_PLD))
@@ -96,7 +116,7 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
                  {'id': 'other', 'payload': 'xxx'}]
         self.storage.set_items(_UID, 'meta', items)
 
-        collection = self.storage.cache.get('1:c:meta')
+        collection = self._get_cached_collection('meta')
         self.assertEquals(sorted(collection["items"].keys()),
                           ['global', 'other'])
 
@@ -108,7 +128,7 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         self.assertRaises(CollectionNotFoundError,
                           sqlstorage.get_items, _UID, 'meta')
 
-        collection = self.storage.cache.get('1:c:meta')
+        collection = self._get_cached_collection('meta')
         self.assertEquals(collection, None)
 
     def test_tabs(self):
@@ -118,7 +138,7 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         # these calls should be cached
         res = self.storage.get_item(_UID, 'tabs', '1')
         self.assertEquals(res['payload'], _PLD)
-        collection = self.storage.cache.get('1:c:tabs')
+        collection = self._get_cached_collection('tabs')
         self.assertEquals(collection['items']['1']['payload'], _PLD)
 
         # it should not exist in the underlying store
@@ -128,7 +148,7 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         # this should remove the cache
         time.sleep(0.01)
         self.storage.delete_item(_UID, 'tabs', '1')
-        collection = self.storage.cache.get('1:c:tabs')
+        collection = self._get_cached_collection('tabs')
         self.assertEquals(collection['items'].keys(), [])
 
         #  adding some stuff
@@ -136,7 +156,7 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
                  {'id': '2', 'payload': 'xxx'}]
         time.sleep(0.01)
         self.storage.set_items(_UID, 'tabs', items)
-        collection = self.storage.cache.get('1:c:tabs')
+        collection = self._get_cached_collection('tabs')
         self.assertEquals(len(collection['items']), 2)
 
         # this should remove the cache
@@ -144,7 +164,7 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         self.storage.delete_collection(_UID, 'tabs')
         self.assertRaises(CollectionNotFoundError,
                           self.storage.get_items, _UID, 'tabs')
-        collection = self.storage.cache.get('1:c:tabs')
+        collection = self._get_cached_collection('tabs')
         self.assertEquals(collection, None)
 
     def test_size(self):
@@ -292,11 +312,411 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         self.assertEquals(storage.get_total_size(_UID), len(_PLD))
         self.assertEquals(storage.get_total_size(_UID, True), 0)
 
+    def _count_memcache_calls(self, func, *args):
+        start_profile()
+        try:
+            func(*args)
+        finally:
+            profile = stop_profile()
+        counts = {}
+        for key, durations in profile.calls.iteritems():
+            if key.startswith("memcache."):
+                counts[key[len("memcache."):]] = len(durations)
+        return counts
+
+    def test_reads_are_memoized_while_locked(self):
+        self.storage.set_item(_UID, 'meta', 'global', {'payload': _PLD})
+
+        def get_meta():
+            with self.storage.lock_for_read(_UID, 'meta'):
+                self.storage.get_collection_timestamp(_UID, 'meta')
+                self.storage.get_total_size(_UID)
+                item = self.storage.get_item(_UID, 'meta', 'global')
+                self.assertEquals(item['payload'], _PLD)
+                # Modifying the returned item doesn't affect the memo.
+                item['payload'] = 'XXX'
+                item = self.storage.get_item(_UID, 'meta', 'global')
+                self.assertEquals(item['payload'], _PLD)
+
+        # Metadata and collection data are fetched in a single request.
+        self.assertEquals(self._count_memcache_calls(get_meta),
+                          {"gets_multi": 1})
+
+    def test_writes_to_cached_collection_reuse_memoized_reads(self):
+        self.storage.set_item(_UID, 'meta', 'global', {'payload': _PLD})
+        time.sleep(0.01)
+
+        def set_meta():
+            with self.storage.lock_for_write(_UID, 'meta'):
+                self.storage.get_collection_timestamp(_UID, 'meta')
+                self.storage.get_total_size(_UID)
+                items = [{'id': 'global', 'payload': 'xyx'}]
+                self.storage.set_items(_UID, 'meta', items)
+
+        # Only the bucket holding the item needs to be read and written.
+        self.assertEquals(self._count_memcache_calls(set_meta), {
+            "gets_multi": 1,
+            "gets": 1,
+            "cas": 2,
+            "delete": 1,
+            "set": 2,
+        })
+        collection = self._get_cached_collection('meta')
+        self.assertEquals(collection['items']['global']['payload'], 'xyx')
+        metadata = self.storage.cache.get('1:metadata')
+        self.assertEquals(metadata['size'], len(_PLD) + 3)
+        self.assertEquals(metadata['collections']['meta'],
+                          collection['modified'])
+
+    def test_writes_only_touch_the_affected_buckets(self):
+        items = [{'id': str(i), 'payload': _PLD} for i in xrange(50)]
+        self.storage.set_items(_UID, 'tabs', items)
+        index = self.storage.cache.get('1:c:tabs')
+        self.assertEquals(len(index['buckets']), 16)
+        time.sleep(0.01)
+
+        def set_tab():
+            with self.storage.lock_for_write(_UID, 'tabs'):
+                self.storage.get_collection_timestamp(_UID, 'tabs')
+                self.storage.set_item(_UID, 'tabs', '7', {'payload': 'X'})
+
+        counts = self._count_memcache_calls(set_tab)
+        self.assertEquals(counts["gets"], 1)
+        self.assertEquals(counts["cas"], 2)
+        new_index = self.storage.cache.get('1:c:tabs')
+        changed = [bucket for bucket, ts in new_index['buckets'].iteritems()
+                   if ts != index['buckets'][bucket]]
+        self.assertEquals(len(changed), 1)
+        self.assertEquals(new_index['modified'],
+                          new_index['buckets'][changed[0]])
+
+        # Reading the collection fetches all of its buckets at once.
+        def get_tabs():
+            with self.storage.lock_for_read(_UID, 'tabs'):
+                self.storage.get_collection_timestamp(_UID, 'tabs')
+                return self.storage.get_items(_UID, 'tabs')['items']
+
+        self.assertEquals(self._count_memcache_calls(get_tabs),
+                          {"gets_multi": 1, "add": 1, "delete": 1})
+        items = dict((item['id'], item['payload']) for item in get_tabs())
+        self.assertEquals(len(items), 50)
+        self.assertEquals(items['7'], 'X')
+
+    def test_evicted_buckets(self):
+        items = [{'id': str(i), 'payload': _PLD} for i in xrange(50)]
+        self.storage.set_items(_UID, 'meta', items)
+        self.storage.set_items(_UID, 'tabs', items)
+        for collection in ('meta', 'tabs'):
+            index = self.storage.cache.get('1:c:' + collection)
+            bucket = sorted(index['buckets'])[0]
+            key = '1:c:%s:%s' % (collection, bucket)
+            evicted = self.storage.cache.get(key)['items'].keys()
+            self.storage.cache.delete(key)
+            # Cached collections are re-populated from the store.
+            # Cache-only collections have lost the evicted items.
+            items = self.storage.get_items(_UID, collection)['items']
+            if collection == 'meta':
+                self.assertEquals(len(items), 50)
+                self.assertTrue(self.storage.cache.get(key) is not None)
+            else:
+                self.assertEquals(len(items), 50 - len(evicted))
+                self.assertFalse(set(evicted) & set(i['id'] for i in items))
+
+    def test_collections_cached_as_a_single_key_are_converted(self):
+        tabs = {
+            'modified': get_timestamp(time.time() - 10),
+            'items': {
+                'a': {'id': 'a', 'payload': 'A', 'modified': 1},
+                'b': {'id': 'b', 'payload': 'B', 'modified': 1},
+            }
+        }
+        self.storage.cache.set('1:c:tabs', tabs)
+        self.storage.set_item(_UID, 'tabs', 'c', {'payload': 'C'})
+        index = self.storage.cache.get('1:c:tabs')
+        self.assertFalse('items' in index)
+        items = self._get_cached_collection('tabs')['items']
+        self.assertEquals(sorted(items), ['a', 'b', 'c'])
+
+    def test_large_values_are_compressed(self):
+        cache = self.storage.cache
+        cache.max_value_size = 2000
+        payload = 'ABCD' * 1000
+        self.storage.set_item(_UID, 'tabs', '1', {'payload': payload})
+        bucket = cache.get('1:c:tabs')['buckets'].keys()[0]
+        with cache.pool.reserve() as mc:
+            data, flags = mc.get(cache._encode_key('1:c:tabs:' + bucket))
+            self.assertTrue(flags & FLAG_ZLIB)
+            self.assertTrue(len(data) < len(payload))
+            # Small values are stored as-is.
+            data, flags = mc.get(cache._encode_key('1:metadata'))
+            self.assertFalse(flags & FLAG_ZLIB)
+        item = self.storage.get_item(_UID, 'tabs', '1')
+        self.assertEquals(item['payload'], payload)
+        # Without compression, the value would be too big to store.
+        cache.compression = 'none'
+        time.sleep(0.01)
+        self.assertRaises(ValueError, self.storage.set_item,
+                          _UID, 'tabs', '2', {'payload': payload})
+
+    def test_stale_memoized_metadata_does_not_cause_conflicts(self):
+        self.storage.set_item(_UID, 'col1', '1', {'payload': _PLD})
+        time.sleep(0.01)
+        with self.storage.lock_for_write(_UID, 'col1'):
+            self.storage.get_collection_timestamp(_UID, 'col1')
+            # Simulate a concurrent write to another collection.
+            metadata = self.storage.cache.get('1:metadata')
+            metadata['collections']['col2'] = metadata['modified']
+            thread = threading.Thread(target=self.storage.cache.set,
+                                      args=('1:metadata', metadata))
+            thread.start()
+            thread.join()
+            ts = self.storage.set_item(_UID, 'col1', '1', {'payload': 'X'})
+        timestamps = self.storage.cache.get('1:metadata')['collections']
+        self.assertEquals(timestamps['col1'], ts['modified'])
+        self.assertEquals(timestamps['col2'], metadata['modified'])
+
+    def test_metadata_is_kept_in_the_local_cache(self):
+        cache = self.storage.cache
+        cache.local_cache = LocalCache(10, ttl=60)
+        self.storage.set_item(_UID, 'col1', '1', {'payload': _PLD})
+
+        def get_total_size():
+            return self.storage.get_total_size(_UID)
+
+        def get_timestamps():
+            return self.storage.get_collection_timestamps(_UID)
+
+        self.assertEquals(self._count_memcache_calls(get_total_size),
+                          {"gets": 1})
+        self.assertEquals(self._count_memcache_calls(get_total_size), {})
+        # Writes from other processes aren't seen until the entry expires.
+        metadata = cache.get('1:metadata')
+        metadata['size'] += 1
+        metadata['collections']['col2'] = metadata['modified']
+        data, flags = cache._encode_value(metadata)
+        with cache.pool.reserve() as mc:
+            mc.set(cache._encode_key('1:metadata'), data, 0, flags)
+        self.assertEquals(get_total_size(), metadata['size'] - 1)
+        # But timestamps are always read from memcache.
+        self.assertEquals(self._count_memcache_calls(get_timestamps),
+                          {"gets": 1})
+        self.assertTrue('col2' in get_timestamps())
+        # And our own writes are seen straight away, and are made
+        # against the current metadata rather than the cached copy.
+        time.sleep(0.01)
+        ts = self.storage.set_item(_UID, 'col1', '1', {'payload': 'X'})
+        self.assertEquals(get_total_size(), metadata['size'] + 1)
+        timestamps = get_timestamps()
+        self.assertEquals(timestamps['col1'], ts['modified'])
+        self.assertEquals(timestamps['col2'], metadata['modified'])
+        # The local cache isn't used while holding a write lock.
+        time.sleep(0.01)
+        with self.storage.lock_for_write(_UID, 'col1'):
+            self.assertEquals(
+                self._count_memcache_calls(get_total_size), {"gets": 1})
+
+    def test_failed_collection_writes_leave_the_cache_unchanged(self):
+        self.storage.set_item(_UID, 'meta', 'global', {'payload': _PLD})
+        self.storage.set_item(_UID, 'col1', '1', {'payload': _PLD})
+        metadata = self.storage.cache.get('1:metadata')
+        meta = self._get_cached_collection('meta')
+        sqlstorage = self.storage.storage
+
+        # Simulate losing a lock while writing out the collection changes.
+        def fail_to_flush(session):
+            if session.touched_collections:
+                raise ConflictError
+        sqlstorage._flush_touched_collections = fail_to_flush
+        try:
+            for collection in ('meta', 'col1'):
+                time.sleep(0.01)
+                with self.assertRaises(ConflictError):
+                    with self.storage.lock_for_write(_UID, collection):
+                        self.storage.set_item(_UID, collection, '2',
+                                              {'payload': 'X'})
+        finally:
+            del sqlstorage._flush_touched_collections
+        self.assertEquals(self.storage.cache.get('1:metadata'), metadata)
+        self.assertEquals(self._get_cached_collection('meta'), meta)
+        self.assertRaises(ItemNotFoundError, self.storage.get_item,
+                          _UID, 'meta', '2')
+        self.assertRaises(ItemNotFoundError, self.storage.get_item,
+                          _UID, 'col1', '2')
+
+    def test_lost_optimistic_writes_leave_the_cache_unchanged(self):
+        sqlstorage = self.storage.storage
+        sqlstorage.optimistic_writes = True
+        self.storage.set_item(_UID, 'meta', 'global', {'payload': _PLD})
+        self.storage.set_item(_UID, 'col1', '1', {'payload': _PLD})
+        metadata = self.storage.cache.get('1:metadata')
+        meta = self._get_cached_collection('meta')
+
+        def sneak_in_a_write(collection):
+            # Simulate a concurrent write, landing after we read the timestamp.
+            session = sqlstorage._tldata.session
+            collectionid = sqlstorage._get_collection_id(session, collection)
+            session.connection.execute(
+                "UPDATE user_collections "
+                "SET last_modified=last_modified+1 "
+                "WHERE userid=%d AND collection=%d "
+                "/* queryName=BUMP_TIMESTAMP */" % (_UID, collectionid))
+
+        for collection in ('meta', 'col1'):
+            time.sleep(0.01)
+            with self.assertRaises(ConflictError):
+                with self.storage.lock_for_write(_UID, collection):
+                    sneak_in_a_write(collection)
+                    self.storage.set_item(_UID, collection, '2',
+                                          {'payload': 'X'})
+        self.assertEquals(self.storage.cache.get('1:metadata'), metadata)
+        self.assertEquals(self._get_cached_collection('meta'), meta)
+        self.assertRaises(ItemNotFoundError, self.storage.get_item,
+                          _UID, 'meta', '2')
+        self.assertRaises(ItemNotFoundError, self.storage.get_item,
+                          _UID, 'col1', '2')
+
+    def test_memoized_values_are_discarded_on_write(self):
+        cache = self.storage.cache
+        cache.set('test', {'a': 1})
+        with cache.memoize():
+            self.assertEquals(cache.gets('test')[0], {'a': 1})
+            cache.set('test', {'a': 2})
+            self.assertEquals(cache.gets('test')[0], {'a': 2})
+            cache.delete('test')
+            self.assertEquals(cache.gets('test'), (None, None))
+            self.assertEquals(cache.gets_multi(['test', 'other']), {
+                'test': (None, None),
+                'other': (None, None),
+            })
+
+
+class TestMemcachedSQLStorageWithMsgpack(TestMemcachedSQLStorage):
+
+    def setUp(self):
+        super(TestMemcachedSQLStorageWithMsgpack, self).setUp()
+        try:
+            self.storage.cache.codec = get_value_codec("msgpack")
+        except ValueError:
+            raise unittest2.SkipTest("msgpack is not installed")
+
+    def test_values_are_flagged_with_their_encoding(self):
+        cache = self.storage.cache
+        self.storage.set_item(_UID, 'tabs', '1', {'payload': 'X'})
+        with cache.pool.reserve() as mc:
+            data, flags = mc.get(cache._encode_key('1:metadata'))
+        self.assertEquals(flags, FLAG_MSGPACK)
+        metadata = cache.get('1:metadata')
+        self.assertEquals(type(metadata['modified']), type(get_timestamp()))
+        # Values written as JSON can still be read, e.g. during an upgrade.
+        cache.codec = JSONCodec()
+        self.assertEquals(cache.get('1:metadata'), metadata)
+        time.sleep(0.01)
+        ts = self.storage.set_item(_UID, 'tabs', '2', {'payload': 'Y'})
+        cache.codec = get_value_codec("msgpack")
+        timestamps = self.storage.get_collection_timestamps(_UID)
+        self.assertEquals(timestamps['tabs'], ts['modified'])
+        items = self.storage.get_items(_UID, 'tabs')['items']
+        self.assertEquals(sorted(item['payload'] for item in items),
+                          ['X', 'Y'])
+
+
+class TestMemcachedSQLStorageOnManyServers(unittest2.TestCase):
+
+    def setUp(self):
+        super(TestMemcachedSQLStorageOnManyServers, self).setUp()
+        if not MEMCACHED:
+            raise unittest2.SkipTest
+        self.servers = {}
+        for _ in xrange(4):
+            server = MemcachedServer()
+            server.start()
+            self.servers[server.address] = server
+        self.addresses = sorted(self.servers)
+        self.sqlstorage = SQLStorage("sqlite:///:memory:",
+                                     standard_collections=False,
+                                     create_tables=True)
+
+    def tearDown(self):
+        for server in self.servers.itervalues():
+            server.stop()
+        super(TestMemcachedSQLStorageOnManyServers, self).tearDown()
+
+    def _make_storage(self, servers, previous_servers=None):
+        return MemcachedStorage(self.sqlstorage, cache_servers=servers,
+                                cache_previous_servers=previous_servers,
+                                cache_lock=True,
+                                cached_collections="meta",
+                                cache_only_collections="tabs")
+
+    def _find_keys(self, storage, userid):
+        # Find which of the servers hold each of the user's keys.
+        found = {}
+        for key in storage.iter_cache_keys(userid):
+            for address, server in self.servers.iteritems():
+                if server.get_item(storage.cache._encode_key(key)):
+                    found.setdefault(key, []).append(address)
+        return found
+
+    def test_all_keys_for_a_user_are_on_the_same_server(self):
+        storage = self._make_storage(" ".join(self.addresses[:3]))
+        used_servers = set()
+        for userid in xrange(20):
+            storage.set_item(userid, "meta", "global", {"payload": "X"})
+            with storage.lock_for_write(userid, "tabs"):
+                storage.set_item(userid, "tabs", "1", {"payload": "Y"})
+                storage.create_batch(userid, "tabs")
+                server = storage.cache.get_server(str(userid))
+                key = storage.cache._encode_key("%d:lock:tabs" % (userid,))
+                self.assertTrue(self.servers[server].get_item(key))
+            found = self._find_keys(storage, userid)
+            self.assertTrue(len(found) >= 5)
+            self.assertTrue(all(v == [server] for v in found.itervalues()))
+            used_servers.add(server)
+            self.assertEquals(
+                storage.get_items(userid, "tabs")["items"][0]["payload"], "Y")
+        self.assertEquals(used_servers, set(self.addresses[:3]))
+
+    def test_adding_a_server_moves_only_a_few_users(self):
+        old_ring = HashRing(self.addresses[:3])
+        new_ring = HashRing(reversed(self.addresses))
+        self.assertEquals(HashRing(reversed(self.addresses[:3])).servers,
+                          old_ring.servers)
+        moved = 0
+        for userid in xrange(1000):
+            old_server = old_ring.get_server(str(userid))
+            new_server = new_ring.get_server(str(userid))
+            if old_server != new_server:
+                self.assertEquals(new_server, self.addresses[3])
+                moved += 1
+        self.assertTrue(100 < moved < 400)
+
+    def test_stale_copies_are_found_while_moving_servers(self):
+        old_storage = self._make_storage(self.addresses[:3])
+        for userid in xrange(20):
+            old_storage.set_item(userid, "tabs", "1", {"payload": "X"})
+        storage = self._make_storage(self.addresses, self.addresses[:3])
+        moved_users = []
+        for userid in xrange(20):
+            servers = storage.cache.get_servers(str(userid))
+            if servers[0] == self.addresses[3]:
+                moved_users.append(userid)
+                self.assertEquals(len(servers), 2)
+            else:
+                self.assertEquals(len(servers), 1)
+            locations = set(storage.iter_cache_locations(userid))
+            for server, key in locations:
+                storage.cache.delete(key, server=server)
+            self.assertEquals(self._find_keys(storage, userid), {})
+        self.assertTrue(moved_users)
+
 
 def test_suite():
     suite = unittest2.TestSuite()
     if MEMCACHED:
         suite.addTest(unittest2.makeSuite(TestMemcachedSQLStorage))
+        suite.addTest(unittest2.makeSuite(TestMemcachedSQLStorageWithMsgpack))
+        suite.addTest(unittest2.makeSuite(
+            TestMemcachedSQLStorageOnManyServers))
     return suite
 
 
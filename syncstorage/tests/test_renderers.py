@@ -0,0 +1,101 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import decimal
+import unittest2
+
+from pyramid import testing
+
+from syncstorage.util import json_dumps, get_timestamp
+from syncstorage.views.renderers import (EscapedPayloadCache,
+                                         JsonRenderer,
+                                         NewlinesRenderer,
+                                         MAX_PAYLOAD_CACHE_SIZE,
+                                         includeme,
+                                         render_flat_dict)
+
+
+BSOS = [
+    {u"id": u"one", u"modified": get_timestamp("1234.50"),
+     u"payload": u'{"ciphertext": "\\u2603\n"}', u"sortindex": 12},
+    {"id": "two", "modified": decimal.Decimal("1.5"), "payload": "",
+     "ttl": 42L},
+]
+
+
+class TestRenderers(unittest2.TestCase):
+
+    def test_flat_dicts_render_same_as_json_dumps(self):
+        for bso in BSOS:
+            self.assertEquals(render_flat_dict(bso), json_dumps(bso))
+        others = [{}, {"a": None}, {"a": True}, {"a": 1.5},
+                  {"a": [1, 2]}, {"a": {"b": 1}}, {1: "x"}]
+        for value in others:
+            self.assertEquals(render_flat_dict(value), json_dumps(value))
+
+    def test_json_renderer_output(self):
+        renderer = JsonRenderer(None)
+        for value in (BSOS, BSOS[0], ["a", "b"], [], [1.5, None]):
+            self.assertEquals(renderer(value, {}), json_dumps(value))
+
+    def test_newlines_renderer_output(self):
+        renderer = NewlinesRenderer(None)
+        output = renderer(BSOS, {})
+        lines = output.split("\n")
+        self.assertEquals(len(lines), 3)
+        self.assertEquals(lines[0], json_dumps(BSOS[0]))
+        self.assertEquals(lines[1], json_dumps(BSOS[1]))
+        self.assertEquals(lines[2], "")
+
+    def test_json_renderer_renders_large_payloads_by_hand(self):
+        renderer = JsonRenderer(None)
+        escaped = []
+
+        def escape_payload(bso, payload):
+            escaped.append(bso["id"])
+            return json_dumps(payload)
+
+        bsos = [dict(BSOS[0], payload="X" * 5000), BSOS[0], BSOS[1],
+                dict(BSOS[1], payload="\"" * 5000)]
+        output = renderer.render_value(bsos, escape_payload)
+        self.assertEquals(output, json_dumps(bsos))
+        self.assertEquals(escaped, ["one", "two"])
+        output = renderer.render_value(bsos[0], escape_payload)
+        self.assertEquals(output, json_dumps(bsos[0]))
+        self.assertEquals(escaped, ["one", "two", "one"])
+
+    def test_escaped_payload_cache(self):
+        cache = EscapedPayloadCache(max_size=100)
+        payload = u'{"data": "\u2603"}'
+        escaped = cache.get_escaped("key", payload)
+        self.assertEquals(escaped, json_dumps(payload))
+        self.assertTrue(cache.get_escaped("key", payload) is escaped)
+        # A different payload under the same key is not served stale.
+        self.assertEquals(cache.get_escaped("key", u"changed"), '"changed"')
+        self.assertEquals(cache.size, len('"changed"'))
+        # Old entries are evicted to stay within the size limit.
+        for i in xrange(10):
+            cache.get_escaped(i, "x" * 20)
+        self.assertTrue(cache.size <= 100)
+        self.assertEquals(cache.get_escaped(9, "x" * 20), json_dumps("x" * 20))
+        # Entries too big for the cache are not stored at all.
+        cache.get_escaped("big", "x" * 100)
+        self.assertTrue(cache.size <= 100)
+        cache.clear()
+        self.assertEquals(cache.size, 0)
+
+    def test_payload_cache_size_is_configurable(self):
+        def get_payload_cache(**settings):
+            config = testing.setUp(settings=settings)
+            self.addCleanup(testing.tearDown)
+            includeme(config)
+            return config.registry.payload_cache
+
+        cache = get_payload_cache()
+        self.assertEquals(cache.max_size, MAX_PAYLOAD_CACHE_SIZE)
+        cache = get_payload_cache(**{"storage.payload_cache_size": "1024"})
+        self.assertEquals(cache.max_size, 1024)
+        # It can be disabled entirely.
+        cache = get_payload_cache(**{"storage.payload_cache_size": 0})
+        self.assertEquals(cache, None)
@@ -95,13 +95,17 @@ class TestMemcacheManagementScripts(StorageTestCase):
         proc.stdin.close()
         output = [ln.strip() for ln in proc.stdout]
         assert proc.wait() == 0
-        # There should be 4 items, two for each queried user.
-        self.assertEquals(len(output), 4)
+        # There should be 6 items, three for each queried user.
+        self.assertEquals(len(output), 6)
         output_keys = [ln.split()[0] for ln in output]
         self.assertTrue("2:metadata" in output_keys)
         self.assertTrue("2:c:tabs" in output_keys)
         self.assertTrue("3:metadata" in output_keys)
         self.assertTrue("3:c:tabs" in output_keys)
+        # The remaining two hold the single bucket of each user's tabs.
+        bucket_keys = [key for key in output_keys if key.count(":") == 3]
+        self.assertEquals(sorted(key.split(":")[0] for key in bucket_keys),
+                          ["2", "3"])
 
 
 class TestPurgeTTLScript(StorageTestCase):
@@ -192,3 +196,17 @@ class TestPurgeTTLScript(StorageTestCase):
         self.assertEquals(count_bso_items(), 1)
         self.assertEquals(count_bui_items(), 3)
         self.assertEquals(count_batches(), 1)
+
+
+class TestUpgradeDBScript(StorageTestCase):
+
+    TEST_INI_FILE = "tests-hostname.ini"
+
+    def test_upgradedb_script(self):
+        # The tables are already up to date, so this should do nothing.
+        ini_file = os.path.join(os.path.dirname(__file__), self.TEST_INI_FILE)
+        proc = spawn_script("upgradedb.py", ini_file)
+        assert proc.wait() == 0
+        key = "syncstorage:storage:host:another-test-host"
+        storage = self.config.registry[key]
+        self.assertEquals(storage.dbconnector.add_missing_columns(), [])
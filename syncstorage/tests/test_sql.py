@@ -2,15 +2,26 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
 import time
+import tempfile
 import threading
 
+import sqlalchemy
+
 from mozsvc.plugin import load_and_register
 from mozsvc.tests.support import get_test_configurator
 
+from syncstorage.profiler import start_profile, stop_profile
 from syncstorage.tests.support import StorageTestCase
-from syncstorage.storage import load_storage_from_settings
+from syncstorage.storage import (load_storage_from_settings,
+                                 ConflictError,
+                                 CollectionNotFoundError,
+                                 InvalidOffsetError)
+from syncstorage.storage.sql import SQLStorage
+from syncstorage.storage.sql.registry import CollectionsRegistry
 from syncstorage.storage.sql.dbconnect import (create_engine,
+                                               DBConnection,
                                                QueuePoolWithMaxBacklog)
 
 from syncstorage.tests.test_storage import StorageTestsMixin
@@ -193,3 +204,644 @@ class TestSQLStorage(StorageTestCase, StorageTestsMixin):
         self.assertEquals(res["num_bso_rows_purged"], 2000)
         self.assertEquals(count_items(), 5)
         self.assertEquals(len(self.storage.get_items(_UID, "col")["items"]), 5)
+
+    def test_collection_usage_is_maintained_by_writes(self):
+        storage = self.storage
+
+        def check_usage(counts, sizes):
+            for recalculate in (False, True):
+                total_size = storage.get_total_size(_UID, recalculate)
+                self.assertEquals(total_size, sum(sizes.itervalues()))
+                self.assertEquals(storage.get_collection_counts(_UID), counts)
+                self.assertEquals(storage.get_collection_sizes(_UID), sizes)
+
+        storage.set_items(_UID, "col1", [
+            {"id": "a", "payload": "x" * 10},
+            {"id": "b", "payload": "x" * 20},
+        ])
+        storage.set_item(_UID, "col2", "c", {"payload": "x" * 30})
+        check_usage({"col1": 2, "col2": 1}, {"col1": 30, "col2": 30})
+
+        # Replacing payloads counts only the difference in size,
+        # and writes without a payload don't change it.
+        storage.set_items(_UID, "col1", [
+            {"id": "a", "payload": "x" * 15},
+            {"id": "b", "sortindex": 2},
+            {"id": "d", "sortindex": 3},
+        ])
+        storage.set_item(_UID, "col2", "c", {"payload": "x" * 5})
+        check_usage({"col1": 3, "col2": 1}, {"col1": 35, "col2": 5})
+
+        # Batches are counted when they're applied.
+        batchid = storage.create_batch(_UID, "col1")
+        storage.append_items_to_batch(_UID, "col1", batchid, [
+            {"id": "a", "payload": "x" * 5},
+            {"id": "b", "sortindex": 4},
+            {"id": "e", "payload": "x" * 100},
+            {"id": "f", "sortindex": 5},
+        ])
+        check_usage({"col1": 3, "col2": 1}, {"col1": 35, "col2": 5})
+        storage.apply_batch(_UID, "col1", batchid)
+        check_usage({"col1": 5, "col2": 1}, {"col1": 125, "col2": 5})
+
+        # Emptied collections are not reported.
+        storage.delete_items(_UID, "col1", ["a", "d", "missing"])
+        storage.delete_item(_UID, "col2", "c")
+        check_usage({"col1": 3}, {"col1": 120})
+        storage.delete_collection(_UID, "col1")
+        check_usage({}, {})
+
+    def test_collection_usage_counts_expired_items_until_purged(self):
+        self.storage.set_items(_UID, "col", [
+            {"id": "live", "payload": "x" * 10},
+            {"id": "expired", "payload": "x" * 20, "ttl": 0},
+        ])
+        time.sleep(1)
+        self.assertEquals(self.storage.get_total_size(_UID), 30)
+        self.assertEquals(self.storage.get_total_size(_UID, True), 10)
+        self.assertEquals(self.storage.get_total_size(_UID), 30)
+        self.assertEquals(self.storage.get_collection_counts(_UID),
+                          {"col": 2})
+        self.storage.purge_expired_items(grace_period=0)
+        self.assertEquals(self.storage.get_total_size(_UID), 10)
+        self.assertEquals(self.storage.get_collection_counts(_UID),
+                          {"col": 1})
+        self.assertEquals(self.storage.get_collection_sizes(_UID),
+                          {"col": 10})
+
+    def test_collection_usage_is_recalculated_if_missing(self):
+        self.storage.set_items(_UID, "col", [
+            {"id": "a", "payload": "x" * 10},
+        ])
+        with self.storage.dbconnector.connect() as c:
+            c.execute("UPDATE user_collections "
+                      "SET item_count=NULL, total_size=NULL "
+                      "/* queryName=FORGET_USAGE */")
+        self.assertEquals(self.storage.get_collection_counts(_UID),
+                          {"col": 1})
+        self.storage.set_item(_UID, "col", "b", {"payload": "x" * 20})
+        self.assertEquals(self.storage.get_total_size(_UID), 30)
+        self.assertEquals(self.storage.get_collection_counts(_UID),
+                          {"col": 2})
+
+    def test_recalculated_usage_does_not_clobber_concurrent_writes(self):
+        self.storage.set_item(_UID, "col1", "a", {"payload": "x" * 10})
+        self.storage.set_item(_UID, "col2", "b", {"payload": "x" * 20})
+        with self.storage.dbconnector.connect() as c:
+            c.execute("UPDATE user_collections "
+                      "SET item_count=NULL, total_size=NULL "
+                      "/* queryName=FORGET_USAGE */")
+
+        # Simulate a write to col2 by another session, landing between
+        # the recalculation reading the items and writing the totals.
+        orig_query_usage = self.storage._query_collections_usage
+
+        def query_usage(session, userid):
+            usage = orig_query_usage(session, userid)
+            thread = threading.Thread(target=self.storage.set_item, args=(
+                _UID, "col2", "c", {"payload": "x" * 30},
+            ))
+            thread.start()
+            thread.join()
+            return usage
+
+        self.storage._query_collections_usage = query_usage
+        counts = self.storage.get_collection_counts(_UID)
+        del self.storage._query_collections_usage
+        self.assertEquals(counts, {"col1": 1, "col2": 1})
+        # The other write filled in the totals for col2, so the stale ones
+        # weren't stored over them.  Those for col1 were stored.
+        self.assertEquals(self.get_stored_usage(),
+                          {"col1": (1, 10), "col2": (2, 50)})
+        self.assertEquals(self.storage.get_collection_counts(_UID),
+                          {"col1": 1, "col2": 2})
+        self.assertEquals(self.storage.get_total_size(_UID), 60)
+
+    def test_missing_usage_is_filled_in_by_writes_and_reads(self):
+        self.storage.set_item(_UID, "col1", "a", {"payload": "x" * 10})
+        self.storage.set_item(_UID, "col2", "b", {"payload": "x" * 20})
+        self.storage.set_item(_UID, "col3", "c", {"payload": "x" * 30})
+        self.storage.set_item(_UID, "col3", "d", {"payload": "x" * 40,
+                                                  "ttl": 0})
+
+        def forget_usage():
+            # As for rows added before the totals were kept.
+            with self.storage.dbconnector.connect() as c:
+                c.execute("UPDATE user_collections "
+                          "SET item_count=NULL, total_size=NULL "
+                          "/* queryName=FORGET_USAGE */")
+
+        def count_recalculations(func, *args):
+            start_profile()
+            try:
+                func(*args)
+            finally:
+                profile = stop_profile()
+            return len(profile.calls.get("db.RECALCULATE_COLLECTIONS_USAGE",
+                                         ()))
+
+        # Writes fill in the totals of the collections they touch.
+        forget_usage()
+        time.sleep(0.02)
+        self.storage.set_item(_UID, "col1", "e", {"payload": "x" * 50})
+        self.storage.delete_item(_UID, "col2", "b")
+        self.storage.purge_expired_items(grace_period=-10)
+        self.assertEquals(self.get_stored_usage(), {
+            "col1": (2, 60), "col2": (0, 0), "col3": (1, 30),
+        })
+
+        # Reads store the totals they recalculate, except under a read lock.
+        forget_usage()
+        with self.storage.lock_for_read(_UID, "col1"):
+            self.assertEquals(self.storage.get_collection_counts(_UID),
+                              {"col1": 2, "col3": 1})
+        self.assertEquals(self.get_stored_usage(), {
+            "col1": (None, None), "col2": (None, None), "col3": (None, None),
+        })
+        self.assertEquals(count_recalculations(
+            self.storage.get_collection_sizes, _UID), 1)
+        self.assertEquals(self.get_stored_usage(), {
+            "col1": (2, 60), "col2": (0, 0), "col3": (1, 30),
+        })
+
+        # After which the totals are read without recalculating them.
+        self.assertEquals(count_recalculations(
+            self.storage.get_collection_counts, _UID), 0)
+        self.assertEquals(count_recalculations(
+            self.storage.get_total_size, _UID), 0)
+
+    def get_stored_usage(self):
+        """Get the stored totals for each collection, by name."""
+        with self.storage.dbconnector.connect() as c:
+            rows = c.execute("SELECT name, item_count, total_size "
+                             "FROM user_collections JOIN collections "
+                             "ON collection=collectionid "
+                             "/* queryName=GET_USAGE */").fetchall()
+        return dict((row[0], tuple(row[1:])) for row in rows)
+
+    def test_find_items_query_cache(self):
+        self.storage.set_items(_UID, "col", [
+            {"id": str(i), "payload": str(i), "sortindex": i}
+            for i in xrange(10)
+        ])
+        rendered_queries = self.storage.dbconnector._rendered_queries
+        rendered_queries.clear()
+
+        def get_ids(**kwds):
+            items = self.storage.get_items(_UID, "col", **kwds)["items"]
+            return [item["id"] for item in items]
+
+        # Queries of the same shape share a single rendered query,
+        # but see the values of their own params.
+        self.assertEquals(get_ids(ids=["1", "2"], sort="index"), ["2", "1"])
+        self.assertEquals(get_ids(ids=["3", "4"], sort="index"), ["4", "3"])
+        self.assertEquals(len(rendered_queries.data), 1)
+        self.assertEquals(get_ids(sort="index", limit=2), ["9", "8"])
+        self.assertEquals(get_ids(sort="index", limit=3), ["9", "8", "7"])
+        self.assertEquals(len(rendered_queries.data), 2)
+
+        # Changing the shape of the params produces a new query.
+        self.assertEquals(get_ids(ids=["3", "4", "5"], sort="index"),
+                          ["5", "4", "3"])
+        self.assertEquals(len(get_ids(sort="oldest", limit=2)), 2)
+        self.assertEquals(len(get_ids(limit=2)), 2)
+        self.assertEquals(len(rendered_queries.data), 5)
+
+    def test_string_queries_are_prerendered_for_each_shard(self):
+        config = get_test_configurator(__file__, 'tests-shard.ini')
+        storage = load_and_register("storage", config)
+        dbconnector = storage.dbconnector
+
+        params = {"userid": 2, "ids": ["a", "b"]}
+        query = dbconnector.get_query("DELETE_ITEMS", params)
+        self.assertTrue("FROM bso2 " in query)
+        self.assertTrue("id IN (:id0,:id1)" in query)
+        self.assertEquals(params["id0"], "a")
+        self.assertEquals(params["id1"], "b")
+
+        # Explicitly-named tables override the sharding by userid.
+        params = {"userid": 2, "bso": "bso7"}
+        query = dbconnector.get_query("FIND_SOME_EXPIRED_ITEMS", params)
+        self.assertTrue("FROM bso7" in query)
+
+        # Queries using both tables are sharded by userid and batchid.
+        params = {"userid": 2, "batch": 34}
+        query = dbconnector.get_query("APPLY_BATCH_INSERT", params)
+        self.assertTrue("INTO bso2" in query)
+        self.assertTrue("batch_upload_items34" in query)
+        self.assertFalse("%(" in query)
+
+    def test_collections_cache_evicts_old_entries(self):
+        storage = SQLStorage(self.storage.sqluri, standard_collections=True,
+                             collections_cache_size=2)
+        for i in xrange(5):
+            storage.set_item(_UID, "col%d" % (i,), "x", {"payload": _PLD})
+        self.assertEquals(len(storage._collections._by_name.data), 2)
+        # Evicted collections can still be found in the database,
+        # and the standard collections are never evicted.
+        for i in xrange(5):
+            storage.get_item(_UID, "col%d" % (i,), "x")
+        self.assertEquals(storage._collections.get_id("bookmarks"), 7)
+
+    def test_collections_registry_is_shared_between_instances(self):
+        fd, registry = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(registry)
+        self.addCleanup(os.unlink, registry)
+        storage1 = SQLStorage(self.storage.sqluri,
+                              collections_registry=registry)
+        storage1.set_item(_UID, "col1", "x", {"payload": _PLD})
+        col1 = storage1._collections.get_id("col1")
+
+        # A new instance gets warmed from the registry.
+        storage2 = SQLStorage(self.storage.sqluri,
+                              collections_registry=registry)
+        self.assertEquals(storage2._collections.get_id("col1"), col1)
+        self.assertEquals(storage2._collections.get_name(col1), "col1")
+
+        # And lazily picks up collections added by other instances.
+        storage1.set_item(_UID, "col2", "x", {"payload": _PLD})
+        col2 = storage1._collections.get_id("col2")
+        self.assertEquals(storage2._collections.get_id("col2"), col2)
+
+        # Without writing duplicate entries into the registry.
+        storage2.get_item(_UID, "col1", "x")
+        storage2.get_item(_UID, "col2", "x")
+        records = CollectionsRegistry(registry).refresh()
+        self.assertEquals(sorted(records), [(col1, "col1"), (col2, "col2")])
+
+    def test_collections_registry_rejects_other_files(self):
+        fd, registry = tempfile.mkstemp()
+        os.write(fd, "this is not a registry file")
+        os.close(fd)
+        self.addCleanup(os.unlink, registry)
+        num_fds = len(os.listdir("/proc/self/fd"))
+        self.assertRaises(ValueError, CollectionsRegistry, registry)
+        # The file isn't left open.
+        self.assertEquals(len(os.listdir("/proc/self/fd")), num_fds)
+
+    def test_collections_registry_only_holds_committed_collections(self):
+        fd, registry = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(registry)
+        self.addCleanup(os.unlink, registry)
+        storage = SQLStorage(self.storage.sqluri,
+                             collections_registry=registry)
+
+        # A collection created by a session that rolls back isn't cached,
+        # since its id could then be given to some other collection.
+        with self.assertRaises(ConflictError):
+            with storage.lock_for_write(_UID, "col1"):
+                storage.set_item(_UID, "col1", "x", {"payload": _PLD})
+                self.assertEquals(storage.get_collection_timestamps(_UID),
+                                  {"col1": storage.get_collection_timestamp(
+                                      _UID, "col1")})
+                raise ConflictError
+        self.assertEquals(storage._collections.get_id("col1"), None)
+        self.assertEquals(CollectionsRegistry(registry).refresh(), [])
+
+        # Once it's committed it's cached, and shared with other processes.
+        storage.set_item(_UID, "col1", "x", {"payload": _PLD})
+        col1 = storage._collections.get_id("col1")
+        self.assertNotEquals(col1, None)
+        self.assertEquals(CollectionsRegistry(registry).refresh(),
+                          [(col1, "col1")])
+
+    def test_collections_registry_is_checked_against_the_database(self):
+        self.storage.set_item(_UID, "col1", "x", {"payload": _PLD})
+        col1 = self.storage._collections.get_id("col1")
+
+        def make_registry(records):
+            fd, registry = tempfile.mkstemp()
+            os.close(fd)
+            os.unlink(registry)
+            self.addCleanup(os.unlink, registry)
+            CollectionsRegistry(registry).append(records)
+            return registry
+
+        # A registry that matches the database is used.
+        registry = make_registry([(col1, "col1")])
+        storage = SQLStorage(self.storage.sqluri,
+                             collections_registry=registry)
+        self.assertNotEquals(storage._collections.registry, None)
+        self.assertEquals(storage._collections.get_name(col1), "col1")
+
+        # One that gives a different name to the same id is not.
+        registry = make_registry([(col1, "col2")])
+        storage = SQLStorage(self.storage.sqluri,
+                             collections_registry=registry)
+        self.assertEquals(storage._collections.registry, None)
+        self.assertEquals(storage._collections.get_name(col1), "col1")
+        self.assertEquals(storage._collections.get_id("col2"), None)
+
+        # Nor is one with ids that aren't in the database at all.
+        registry = make_registry([(col1, "col1"), (col1 + 1, "col2")])
+        storage = SQLStorage(self.storage.sqluri,
+                             collections_registry=registry)
+        self.assertEquals(storage._collections.registry, None)
+        self.assertEquals(storage._collections.get_id("col2"), None)
+
+    def test_missing_columns_are_added_to_existing_tables(self):
+        fd, dbfile = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.addCleanup(os.unlink, dbfile)
+        sqluri = "sqlite:///" + dbfile
+        # Create a database from before the collection totals were added.
+        storage = SQLStorage(sqluri, create_tables=True)
+        storage.set_item(_UID, "col1", "a", {"payload": "XX"})
+        with storage.dbconnector.connect() as c:
+            c.execute("CREATE TABLE old_user_collections ("
+                      "userid INTEGER NOT NULL, "
+                      "collection INTEGER NOT NULL, "
+                      "last_modified BIGINT NOT NULL, "
+                      "PRIMARY KEY (userid, collection))")
+            c.execute("INSERT INTO old_user_collections "
+                      "SELECT userid, collection, last_modified "
+                      "FROM user_collections "
+                      "/* queryName=COPY_OLD_USER_COLLECTIONS */")
+            c.execute("DROP TABLE user_collections")
+            c.execute("ALTER TABLE old_user_collections "
+                      "RENAME TO user_collections "
+                      "/* queryName=RENAME_OLD_USER_COLLECTIONS */")
+        storage = SQLStorage(sqluri)
+        added = storage.dbconnector.add_missing_columns()
+        self.assertEquals(sorted(added), ["user_collections.item_count",
+                                          "user_collections.total_size"])
+        self.assertEquals(storage.dbconnector.add_missing_columns(), [])
+        # The totals for existing collections are calculated when needed.
+        storage.set_item(_UID, "col1", "b", {"payload": "YYY"})
+        self.assertEquals(storage.get_collection_counts(_UID), {"col1": 2})
+        self.assertEquals(storage.get_total_size(_UID), 5)
+
+    def test_native_upsert_matches_generic_upsert(self):
+        dbconnector = self.storage.dbconnector
+        self.assertEquals(dbconnector.upsert_style, "onconflict")
+        # Use a tiny limit on query params, to force several queries.
+        dbconnector.max_query_params = 20
+        results = {}
+        for userid, style in enumerate(("generic", "onconflict")):
+            dbconnector.upsert_style = style
+            created = [
+                self.storage.set_item(userid, "col", "a", {"payload": "1"}),
+                self.storage.set_item(userid, "col", "a", {"sortindex": 2}),
+            ]
+            bsos = [{"id": str(i), "payload": "x"} for i in xrange(10)]
+            bsos.append({"id": "3", "payload": "y"})
+            bsos.append({"id": "4", "sortindex": 4})
+            self.storage.set_items(userid, "col", bsos)
+            items = self.storage.get_items(userid, "col")["items"]
+            results[style] = (
+                [res["created"] for res in created],
+                sorted((bso["id"], bso["payload"], bso.get("sortindex"))
+                       for bso in items),
+            )
+        self.assertEquals(results["onconflict"], results["generic"])
+        self.assertEquals(results["onconflict"][0], [True, False])
+        self.assertTrue(("3", "y", None) in results["onconflict"][1])
+        self.assertTrue(("4", "x", 4) in results["onconflict"][1])
+
+    def test_upserts_stay_within_the_limit_on_query_params(self):
+        dbconnector = self.storage.dbconnector
+        # Simulate the limit imposed by SQLite before version 3.32.
+        dbconnector.max_query_params = 999
+        num_params = []
+        orig_execute = DBConnection.execute
+
+        def execute(self, query, params=None, *args, **kwds):
+            if query.startswith("INSERT INTO bso"):
+                num_params.append(len(params))
+            return orig_execute(self, query, params, *args, **kwds)
+
+        DBConnection.execute = execute
+        self.addCleanup(setattr, DBConnection, "execute", orig_execute)
+        # Items with only a sortindex get three fields from the defaults.
+        bsos = [{"id": str(i), "sortindex": i} for i in xrange(400)]
+        self.storage.set_items(_UID, "col", bsos)
+        self.assertTrue(len(num_params) > 1)
+        self.assertTrue(max(num_params) <= 999)
+        items = self.storage.get_items(_UID, "col", limit=1000)["items"]
+        self.assertEquals(len(items), 400)
+
+    def test_touched_collections_are_written_once_per_write(self):
+        dbconnector = self.storage.dbconnector
+        self.assertEquals(dbconnector.upsert_style, "onconflict")
+        expected_queries = {
+            "generic": {"TOUCH_COLLECTION": 3, "INIT_COLLECTION": 1},
+            "onconflict": {"UPSERT_COLLECTION": 3},
+        }
+        for userid, style in enumerate(("generic", "onconflict")):
+            dbconnector.upsert_style = style
+            start_profile()
+            try:
+                with self.storage.lock_for_write(userid, "col"):
+                    self.storage.set_items(userid, "col", [
+                        {"id": "a", "payload": "xx"},
+                    ])
+                    ts = self.storage.set_item(userid, "col", "b", {
+                        "payload": "yyy",
+                    })["modified"]
+                    self.storage.delete_item(userid, "col", "a")
+            finally:
+                profile = stop_profile()
+            queries = {}
+            for key, durations in profile.calls.iteritems():
+                if key in ("db.TOUCH_COLLECTION", "db.INIT_COLLECTION",
+                           "db.UPSERT_COLLECTION"):
+                    queries[key[len("db."):]] = len(durations)
+            self.assertEquals(queries, expected_queries[style])
+            self.assertEquals(self.storage.get_collection_timestamps(userid),
+                              {"col": ts})
+            self.assertEquals(self.storage.get_collection_sizes(userid),
+                              {"col": 3})
+
+            # Reads in the same session see the changes.
+            time.sleep(0.02)
+            with self.storage.lock_for_write(userid, "col"):
+                ts = self.storage.set_item(userid, "col", "c", {
+                    "payload": "z",
+                })["modified"]
+                timestamps = self.storage.get_collection_timestamps(userid)
+                self.assertEquals(timestamps, {"col": ts})
+                counts = self.storage.get_collection_counts(userid)
+                self.assertEquals(counts, {"col": 2})
+
+    def test_optimistic_writes_roll_back_if_they_lose_the_race(self):
+        self.storage.optimistic_writes = True
+
+        def sneak_in_a_write(query, collection="col"):
+            # Simulate a concurrent write, landing after we read the timestamp.
+            session = self.storage._tldata.session
+            collectionid = self.storage._get_collection_id(session,
+                                                           collection)
+            session.connection.execute(query % {
+                "userid": _UID,
+                "collectionid": collectionid,
+            })
+
+        BUMP_TIMESTAMP = "UPDATE user_collections "\
+                         "SET last_modified=last_modified+1 "\
+                         "WHERE userid=%(userid)d "\
+                         "AND collection=%(collectionid)d "\
+                         "/* queryName=BUMP_TIMESTAMP */"
+        CREATE_COLLECTION = "INSERT INTO user_collections "\
+                            "(userid, collection, last_modified) "\
+                            "VALUES (%(userid)d, %(collectionid)d, 1) "\
+                            "/* queryName=CREATE_COLLECTION */"
+
+        # Writes that don't conflict are applied without taking a row lock.
+        start_profile()
+        try:
+            with self.storage.lock_for_write(_UID, "col"):
+                self.storage.set_item(_UID, "col", "a", {"payload": "x"})
+            time.sleep(0.02)
+            with self.storage.lock_for_write(_UID, "col"):
+                ts = self.storage.set_item(_UID, "col", "b", {
+                    "payload": "yy",
+                })["modified"]
+        finally:
+            profile = stop_profile()
+        self.assertFalse("db.LOCK_COLLECTION_WRITE" in profile.calls)
+        self.assertEquals(len(profile.calls["db.CAS_TOUCH_COLLECTION"]), 1)
+        self.assertEquals(self.storage.get_collection_timestamp(_UID, "col"),
+                          ts)
+
+        # A write that loses the race is rolled back entirely,
+        # and the conflict is reported by the write itself.
+        time.sleep(0.02)
+        with self.assertRaises(ConflictError):
+            with self.storage.lock_for_write(_UID, "col"):
+                self.storage.set_item(_UID, "col", "c", {"payload": "z"})
+                sneak_in_a_write(BUMP_TIMESTAMP)
+                self.assertRaises(ConflictError, self.storage.delete_item,
+                                  _UID, "col", "a")
+                raise ConflictError
+        self.assertEquals(self.storage.get_collection_timestamp(_UID, "col"),
+                          ts)
+        items = self.storage.get_items(_UID, "col")["items"]
+        self.assertEquals(sorted(item["id"] for item in items), ["a", "b"])
+        self.assertEquals(self.storage.get_collection_sizes(_UID),
+                          {"col": 3})
+
+        # As does creating a collection that someone else just created.
+        with self.assertRaises(ConflictError):
+            with self.storage.lock_for_write(_UID, "col2"):
+                sneak_in_a_write(CREATE_COLLECTION, "col2")
+                self.storage.set_item(_UID, "col2", "a", {"payload": "x"})
+        self.assertRaises(CollectionNotFoundError,
+                          self.storage.get_collection_timestamp, _UID, "col2")
+
+        # And deleting a collection that has been written to.
+        time.sleep(0.02)
+        with self.assertRaises(ConflictError):
+            with self.storage.lock_for_write(_UID, "col"):
+                sneak_in_a_write(BUMP_TIMESTAMP)
+                self.storage.delete_collection(_UID, "col")
+        self.assertEquals(self.storage.get_collection_counts(_UID),
+                          {"col": 2})
+
+    def test_apply_large_batch_with_partial_updates(self):
+        self.storage.set_items(_UID, "col", [
+            {"id": str(i), "payload": "old", "sortindex": 1}
+            for i in xrange(5000)
+        ])
+        batch = self.storage.create_batch(_UID, "col")
+        self.storage.append_items_to_batch(_UID, "col", batch, [
+            {"id": str(i), "payload": "new"} if i % 2 == 0 else
+            {"id": str(i), "sortindex": 2}
+            for i in xrange(10000)
+        ])
+        self.storage.apply_batch(_UID, "col", batch)
+        items = self.storage.get_items(_UID, "col")["items"]
+        self.assertEquals(len(items), 10000)
+        for item in items:
+            i = int(item["id"])
+            if i % 2 == 0:
+                self.assertEquals(item["payload"], "new")
+                self.assertEquals(item.get("sortindex"),
+                                  1 if i < 5000 else None)
+            else:
+                self.assertEquals(item["payload"],
+                                  "old" if i < 5000 else "")
+                self.assertEquals(item.get("sortindex"), 2)
+
+    def test_find_items_with_streamed_results(self):
+        storage = SQLStorage(self.storage.sqluri, stream_results=True,
+                             stream_results_batch_size=3)
+        storage.set_items(_UID, "col", [
+            {"id": str(i), "payload": str(i), "sortindex": i}
+            for i in xrange(10)
+        ])
+        # Spy on the size of each batch of rows read from the database.
+        fetches = []
+        orig_execute = DBConnection.execute
+
+        def execute(self, query, params, annotations, stream_results=False):
+            res = orig_execute(self, query, params, annotations,
+                               stream_results)
+            if stream_results:
+                orig_fetchmany = res.fetchmany
+
+                def fetchmany(size):
+                    rows = orig_fetchmany(size)
+                    fetches.append(len(rows))
+                    return rows
+
+                res.fetchmany = fetchmany
+            return res
+
+        DBConnection.execute = execute
+        try:
+            items = storage.get_items(_UID, "col", sort="index")["items"]
+        finally:
+            DBConnection.execute = orig_execute
+        self.assertEquals([item["id"] for item in items],
+                          [str(i) for i in xrange(9, -1, -1)])
+        self.assertEquals(fetches, [3, 3, 3, 1, 0])
+
+    def test_keyset_pagination_by_sortindex(self):
+        # Include some ties and some items without a sortindex,
+        # which will sort first or last depending on the database.
+        bsos = [{"id": str(i), "payload": "x", "sortindex": i // 3 - 1}
+                for i in xrange(9)]
+        bsos.extend({"id": "n%d" % (i,), "payload": "x"} for i in xrange(3))
+        self.storage.set_items(_UID, "col", bsos)
+        res = self.storage.get_item_ids(_UID, "col", sort="index")
+        all_ids = res["items"]
+        self.assertEquals(len(all_ids), 12)
+        self.assertEquals(all_ids[all_ids.index("8"):][:3], ["8", "7", "6"])
+
+        # Page through them, seeking past the last item in each page.
+        ids = []
+        offset = None
+        while True:
+            res = self.storage.get_item_ids(_UID, "col", sort="index",
+                                            limit=2, offset=offset)
+            ids.extend(res["items"])
+            offset = res["next_offset"]
+            if offset is None:
+                break
+            self.assertEquals(offset.split(":", 1)[1], ids[-1])
+        self.assertEquals(ids, all_ids)
+
+        # Old-style numeric offsets are still accepted.
+        res = self.storage.get_item_ids(_UID, "col", sort="index",
+                                        limit=3, offset="5")
+        self.assertEquals(res["items"], all_ids[5:8])
+        self.assertEquals(res["next_offset"].split(":", 1)[1], all_ids[7])
+
+        # Malformed tokens are rejected.
+        for offset in ("1:", "x:1", "x"):
+            self.assertRaises(InvalidOffsetError, self.storage.get_items,
+                              _UID, "col", sort="index", offset=offset)
+
+    def test_sortindex_index_is_created_on_demand(self):
+        def get_index_names():
+            inspector = sqlalchemy.inspect(self.storage.dbconnector.engine)
+            return [idx["name"] for idx in inspector.get_indexes("bso")]
+
+        self.assertFalse("bso_usr_col_sortidx_idx" in get_index_names())
+        # It's safe to enable it on an existing database, more than once.
+        for _ in xrange(2):
+            SQLStorage(self.storage.sqluri, create_tables=True,
+                       sortindex_index=True)
+            self.assertTrue("bso_usr_col_sortidx_idx" in get_index_names())
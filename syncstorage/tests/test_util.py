@@ -0,0 +1,72 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import copy
+import pickle
+import decimal
+import unittest2
+
+from syncstorage.util import Timestamp, get_timestamp, json_dumps, json_loads
+from syncstorage.storage.sql import ts2bigint, bigint2ts
+
+
+class TestTimestamps(unittest2.TestCase):
+
+    def test_get_timestamp_matches_decimal_rounding(self):
+        values = ["1234.56", "1234.5", " 1234 ", "-0.05", "1e3", "1.005",
+                  "1.015", "0", 12, 1234.567, decimal.Decimal("1.234")]
+        for value in values:
+            expected = decimal.Decimal(str(value)).quantize(
+                decimal.Decimal("1.00"))
+            ts = get_timestamp(value)
+            self.assertTrue(isinstance(ts, Timestamp))
+            self.assertEquals(ts, expected)
+            self.assertEquals(str(ts), str(expected))
+            self.assertEquals(hash(ts), hash(expected))
+
+    def test_get_timestamp_rejects_bad_values(self):
+        for value in ("", "abc", "NaN", "Infinity", "1.2.3"):
+            self.assertRaises(ValueError, get_timestamp, value)
+
+    def test_timestamp_arithmetic(self):
+        ts = get_timestamp("1234.56")
+        self.assertEquals(str(ts + 1), "1235.56")
+        self.assertEquals(str(1 + ts), "1235.56")
+        self.assertEquals(str(ts - 1), "1233.56")
+        self.assertEquals(str(2000 - ts), "765.44")
+        self.assertEquals(str(ts - ts), "0.00")
+        self.assertEquals(str(ts + decimal.Decimal("0.01")), "1234.57")
+        self.assertEquals(int(ts), 1234)
+        self.assertEquals(int(get_timestamp("-1.50")), -1)
+        self.assertEquals(float(ts), 1234.56)
+        self.assertTrue(ts < get_timestamp("1234.57"))
+        self.assertTrue(ts > decimal.Decimal("1234.55"))
+        self.assertTrue(ts == decimal.Decimal("1234.560"))
+        self.assertTrue(ts >= 1234)
+        self.assertFalse(get_timestamp(0))
+
+    def test_timestamp_copying(self):
+        ts = get_timestamp("1234.56")
+        self.assertTrue(copy.copy(ts) is ts)
+        self.assertTrue(copy.deepcopy(ts) is ts)
+        self.assertEquals(pickle.loads(pickle.dumps(ts)), ts)
+        self.assertEquals(pickle.loads(pickle.dumps(ts, 2)), ts)
+
+    def test_timestamp_json_roundtrip(self):
+        ts = get_timestamp("1234.50")
+        data = json_loads(json_dumps({"modified": ts, "ratio": 1.5}))
+        self.assertEquals(json_dumps(ts), "1234.50")
+        self.assertTrue(isinstance(data["modified"], Timestamp))
+        self.assertEquals(data["modified"], ts)
+        self.assertEquals(type(data["ratio"]), decimal.Decimal)
+
+    def test_bigint_conversion(self):
+        ts = get_timestamp("1234.56")
+        self.assertEquals(ts2bigint(ts), 1234560)
+        self.assertEquals(ts2bigint(decimal.Decimal("1234.56")), 1234560)
+        self.assertEquals(bigint2ts(1234560), ts)
+        # Milliseconds are rounded half-to-even, as Decimal would do.
+        self.assertEquals(str(bigint2ts(1234565)), "1234.56")
+        self.assertEquals(str(bigint2ts(1234575)), "1234.58")
+        self.assertEquals(str(bigint2ts(1234566)), "1234.57")
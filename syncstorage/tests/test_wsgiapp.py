@@ -132,3 +132,104 @@ class TestWSGIApp(StorageTestCase):
                 break
         else:
             assert False, "timer metrics were not emitted"
+
+
+class TestProfiledWSGIApp(TestWSGIApp):
+
+    TEST_INI_FILE = "tests-profiler.ini"
+
+    def test_server_timing_header(self):
+        app = self._make_test_app()
+
+        res = app.post_json("/1.5/42/storage/col1", [
+            {"id": "1", "payload": "x"},
+            {"id": "2", "payload": "y"},
+        ])
+        timings = self._parse_server_timing(res)
+        self.assertTrue("lock.write" in timings)
+        self.assertTrue("db.commit" in timings)
+        self.assertTrue("total" in timings)
+        self.assertTrue(any(key.startswith("db.") and key != "db.commit"
+                            for key in timings))
+
+        res = app.get("/1.5/42/storage/col1?full=1")
+        timings = self._parse_server_timing(res)
+        self.assertTrue("lock.read" in timings)
+        self.assertEquals(timings["serialize.json"]["desc"], '"1"')
+
+        # Responses that are errors are profiled too.
+        res = app.get("/1.5/42/storage/col1/missing", status=404)
+        self.assertTrue("total" in self._parse_server_timing(res))
+
+    def test_resource_timestamp_is_looked_up_only_once(self):
+        app = self._make_test_app()
+        res = app.post_json("/1.5/42/storage/col1", [
+            {"id": "1", "payload": "x"},
+        ])
+        ts = res.headers["X-Last-Modified"]
+
+        # The timestamp of a fetched item comes from the item itself.
+        res = app.get("/1.5/42/storage/col1/1")
+        self.assertEquals(res.headers["X-Last-Modified"], ts)
+        timings = self._parse_server_timing(res)
+        self.assertTrue("db.ITEM_DETAILS" in timings)
+        self.assertFalse("db.ITEM_TIMESTAMP" in timings)
+
+        # Checking preconditions fetches the item only once.
+        res = app.get("/1.5/42/storage/col1/1", headers={
+            "X-If-Modified-Since": "1.00",
+        })
+        self.assertEquals(res.headers["X-Last-Modified"], ts)
+        self.assertEquals(res.json["payload"], "x")
+        timings = self._parse_server_timing(res)
+        self.assertEquals(timings["db.ITEM_DETAILS"]["desc"], '"1"')
+        self.assertFalse("db.ITEM_TIMESTAMP" in timings)
+        app.get("/1.5/42/storage/col1/1", status=304, headers={
+            "X-If-Modified-Since": ts,
+        })
+
+        # Writes still need to check the timestamp on its own.
+        res = app.put_json("/1.5/42/storage/col1/1", {"payload": "y"},
+                           headers={"X-If-Unmodified-Since": ts})
+        timings = self._parse_server_timing(res)
+        self.assertEquals(timings["db.ITEM_TIMESTAMP"]["desc"], '"1"')
+        self.assertFalse("db.ITEM_DETAILS" in timings)
+
+    def test_info_usage_views_read_only_collection_totals(self):
+        app = self._make_test_app()
+        app.post_json("/1.5/42/storage/col1", [
+            {"id": "1", "payload": "x"},
+            {"id": "2", "payload": "yy"},
+        ])
+        for view in ("/info/collection_counts", "/info/collection_usage"):
+            res = app.get("/1.5/42" + view)
+            timings = self._parse_server_timing(res)
+            queries = sorted(key for key in timings
+                             if key.startswith("db.") and key != "db.commit")
+            self.assertEquals(queries, ["db.COLLECTIONS_USAGE",
+                                        "db.STORAGE_TIMESTAMP"])
+        res = app.get("/1.5/42/info/collection_counts")
+        self.assertEquals(res.json, {"col1": 2})
+
+    def test_profile_stats_endpoint(self):
+        app = self._make_test_app()
+        app.post_json("/1.5/42/storage/col1", [{"id": "1", "payload": "x"}])
+        app.get("/1.5/42/storage/col1")
+        app.get("/1.5/42/storage/col1")
+
+        stats = app.get("/__profile__").json
+        self.assertEquals(stats["requests"], 3)
+        num_buckets = len(stats["buckets_ms"]) + 1
+        self.assertEquals(stats["timings"]["total"]["count"], 3)
+        self.assertEquals(stats["timings"]["lock.write"]["count"], 1)
+        self.assertEquals(stats["timings"]["lock.read"]["count"], 2)
+        for histogram in stats["timings"].itervalues():
+            self.assertEquals(len(histogram["counts"]), num_buckets)
+            self.assertEquals(sum(histogram["counts"]), histogram["count"])
+
+    def _parse_server_timing(self, res):
+        timings = {}
+        for entry in res.headers["Server-Timing"].split(", "):
+            parts = entry.split(";")
+            timings[parts[0]] = dict(p.split("=", 1) for p in parts[1:])
+        return timings
@@ -7,6 +7,9 @@ import json
 from pyramid.httpexceptions import HTTPException
 
 from syncstorage.util import get_timestamp
+from syncstorage.profiler import (start_profile,
+                                  stop_profile,
+                                  is_profiler_enabled)
 
 try:
     from mozsvc.storage.mcclient import MemcachedClient
@@ -138,9 +141,43 @@ def convert_non_json_responses(handler, registry):
     return convert_non_json_responses_tween
 
 
+def profile_storage_calls(handler, registry):
+    """Tween to profile the storage calls made by each request.
+
+    If profiling is enabled, this tween records the timings of the storage
+    calls made while handling each request.  It reports them to the client
+    in a Server-Timing header, and adds them to the aggregate histograms.
+    """
+    if not is_profiler_enabled(registry.settings):
+        return handler
+
+    def report_profile(response):
+        profile = stop_profile()
+        if profile is not None:
+            response.headers["Server-Timing"] = profile.get_server_timing()
+            registry.profile_stats.add(profile)
+
+    def profile_storage_calls_tween(request):
+        start_profile()
+        try:
+            response = handler(request)
+        except HTTPException, response:
+            report_profile(response)
+            raise
+        else:
+            report_profile(response)
+            return response
+        finally:
+            # Don't leak the profile if the request failed with an error.
+            stop_profile()
+
+    return profile_storage_calls_tween
+
+
 def includeme(config):
     """Include all the SyncServer tweens into the given config."""
     config.add_tween("syncstorage.tweens.set_x_timestamp_header")
     config.add_tween("syncstorage.tweens.set_default_accept_header")
     config.add_tween("syncstorage.tweens.convert_cornice_errors_to_respcodes")
     config.add_tween("syncstorage.tweens.convert_non_json_responses")
+    config.add_tween("syncstorage.tweens.profile_storage_calls")
@@ -2,6 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import re
 import time
 import decimal
 import simplejson
@@ -9,24 +10,174 @@ import simplejson
 
 TWO_DECIMAL_PLACES = decimal.Decimal("1.00")
 
+# Matches timestamp strings that can be parsed without any rounding.
+TIMESTAMP_STRING_RE = re.compile(r"^(-?)(\d+)(?:\.(\d{0,2}))?$")
+
+
+class Timestamp(decimal.Decimal):
+    """A syncstorage timestamp, as an integer number of centiseconds.
+
+    Timestamps are written on the wire as decimal numbers with exactly two
+    decimal places, e.g. "1234.56", and we used to represent them internally
+    as instances of decimal.Decimal.  But Decimal is implemented in pure
+    python and is slow to construct, compare and format, which adds up when
+    converting thousands of rows from the database.
+
+    This class is a Decimal subclass that sets up the internal state of its
+    Decimal parent directly from an integer, and does comparisons, simple
+    arithmetic and formatting on that integer.  It can still be used
+    anywhere a Decimal is expected, including with json_dumps().
+    """
+
+    __slots__ = ("centiseconds",)
+
+    def __new__(cls, centiseconds=0):
+        self = object.__new__(cls)
+        self.centiseconds = centiseconds
+        if centiseconds < 0:
+            self._sign = 1
+            self._int = str(-centiseconds)
+        else:
+            self._sign = 0
+            self._int = str(centiseconds)
+        self._exp = -2
+        self._is_special = False
+        return self
+
+    @classmethod
+    def from_decimal(cls, value):
+        """Create a Timestamp from a Decimal with at most 2 decimal places."""
+        if value.is_nan() or value.is_infinite():
+            raise ValueError("Not a finite number: %s" % (value,))
+        return cls(int(value.scaleb(2)))
+
+    def __reduce__(self):
+        return (self.__class__, (self.centiseconds,))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __str__(self, eng=False, context=None):
+        cs = self.centiseconds
+        if cs < 0:
+            return "-%d.%02d" % divmod(-cs, 100)
+        return "%d.%02d" % divmod(cs, 100)
+
+    def __repr__(self):
+        return "Timestamp('%s')" % (self,)
+
+    def __int__(self):
+        cs = self.centiseconds
+        if cs < 0:
+            return -(-cs // 100)
+        return cs // 100
+
+    __long__ = __int__
+
+    def __float__(self):
+        return self.centiseconds / 100.0
+
+    def __hash__(self):
+        return decimal.Decimal.__hash__(self)
+
+    def __eq__(self, other, context=None):
+        if type(other) is Timestamp:
+            return self.centiseconds == other.centiseconds
+        return decimal.Decimal.__eq__(self, other)
+
+    def __ne__(self, other, context=None):
+        if type(other) is Timestamp:
+            return self.centiseconds != other.centiseconds
+        return decimal.Decimal.__ne__(self, other)
+
+    def __lt__(self, other, context=None):
+        if type(other) is Timestamp:
+            return self.centiseconds < other.centiseconds
+        return decimal.Decimal.__lt__(self, other)
+
+    def __le__(self, other, context=None):
+        if type(other) is Timestamp:
+            return self.centiseconds <= other.centiseconds
+        return decimal.Decimal.__le__(self, other)
+
+    def __gt__(self, other, context=None):
+        if type(other) is Timestamp:
+            return self.centiseconds > other.centiseconds
+        return decimal.Decimal.__gt__(self, other)
+
+    def __ge__(self, other, context=None):
+        if type(other) is Timestamp:
+            return self.centiseconds >= other.centiseconds
+        return decimal.Decimal.__ge__(self, other)
+
+    def __add__(self, other, context=None):
+        if type(other) is Timestamp:
+            return Timestamp(self.centiseconds + other.centiseconds)
+        if isinstance(other, (int, long)):
+            return Timestamp(self.centiseconds + other * 100)
+        return decimal.Decimal.__add__(self, other)
+
+    __radd__ = __add__
+
+    def __sub__(self, other, context=None):
+        if type(other) is Timestamp:
+            return Timestamp(self.centiseconds - other.centiseconds)
+        if isinstance(other, (int, long)):
+            return Timestamp(self.centiseconds - other * 100)
+        return decimal.Decimal.__sub__(self, other)
+
+    def __rsub__(self, other, context=None):
+        if isinstance(other, (int, long)):
+            return Timestamp(other * 100 - self.centiseconds)
+        return decimal.Decimal.__rsub__(self, other)
+
 
 def get_timestamp(value=None):
     """Transforms a python time value into a syncstorage timestamp."""
     if value is None:
-        value = time.time()
+        return Timestamp(int(round(time.time() * 100)))
+    if type(value) is Timestamp:
+        return value
+    if isinstance(value, (int, long)):
+        return Timestamp(value * 100)
+    if isinstance(value, float):
+        value = str(value)
+    if isinstance(value, basestring):
+        match = TIMESTAMP_STRING_RE.match(value.strip())
+        if match is not None:
+            sign, whole, fraction = match.groups()
+            cs = int(whole) * 100 + int((fraction or "").ljust(2, "0"))
+            return Timestamp(-cs if sign else cs)
     try:
         if not isinstance(value, decimal.Decimal):
-            value = decimal.Decimal(str(value))
-        return value.quantize(TWO_DECIMAL_PLACES)
+            value = decimal.Decimal(value)
+        return Timestamp.from_decimal(value.quantize(TWO_DECIMAL_PLACES))
     except decimal.InvalidOperation, e:
         raise ValueError(str(e))
 
 
+def _parse_json_float(value):
+    """Parse a JSON float, as a Timestamp if it looks like one."""
+    if value[-3:-2] == ".":
+        try:
+            return get_timestamp(value)
+        except ValueError:
+            pass
+    return decimal.Decimal(value)
+
+
 def json_dumps(value):
     """Decimal-aware version of json.dumps()."""
     return simplejson.dumps(value, use_decimal=True)
 
 
 def json_loads(value):
-    """Decimal-aware version of json.loads()."""
-    return simplejson.loads(value, use_decimal=True)
+    """Decimal-aware version of json.loads().
+
+    Numbers with exactly two decimal places are parsed as a Timestamp, and
+    any other non-integer numbers are parsed as a Decimal.
+    """
+    return simplejson.loads(value, parse_float=_parse_json_float)
@@ -7,6 +7,7 @@ import logging
 from base64 import b64encode
 
 from pyramid.security import Allow
+from pyramid.httpexceptions import HTTPPreconditionFailed
 
 from cornice import Service
 
@@ -28,7 +29,10 @@ from syncstorage.views.decorators import (convert_storage_errors,
                                           with_collection_lock,
                                           check_precondition_headers,
                                           check_storage_quota)
-from syncstorage.views.util import get_resource_timestamp, get_limit_config
+from syncstorage.views.util import (get_resource_timestamp,
+                                    get_resource_item,
+                                    get_limit_config,
+                                    StreamedItems)
 
 
 logger = logging.getLogger(__name__)
@@ -265,8 +269,12 @@ def get_collection_with_internal_pagination(request):
         if limit is not None and limit < batch_size:
             return get_collection(request)
         # Otherwise, we'll have to paginate internally for reduce db load.
-        items = []
         request.validated["limit"] = batch_size
+        # If it's an unlimited fetch and streaming is enabled, we can avoid
+        # buffering the whole result by writing out each page as we get it.
+        if limit is None and settings.get("storage.streaming_responses"):
+            return get_collection_streamed(request)
+        items = []
         while True:
             # Do the actual fetch, knowing it won't be too big.
             res = get_collection(request)
@@ -298,11 +306,80 @@ def get_collection_with_internal_pagination(request):
         return []
 
 
+def get_collection_streamed(request):
+    """Get the contents of a collection, as a streamed list of pages.
+
+    This fetches the first page of results as normal, so that any errors
+    or precondition failures produce a proper error response.  If there
+    are more pages to come, it returns a StreamedItems object from which
+    the renderer will lazily fetch and write out the remaining pages.  This
+    bounds memory usage to a single page, at the cost of omitting the
+    X-Weave-Records header since we don't know the total in advance.
+
+    If the collection is concurrently modified while streaming then there
+    is no way to report the error, so the response is aborted mid-stream.
+    """
+    items = get_collection(request)
+    try:
+        offset = request.response.headers.pop("X-Weave-Next-Offset")
+    except KeyError:
+        return items
+    if "if_unmodified_since" not in request.validated:
+        last_modified = request.response.headers["X-Last-Modified"]
+        last_modified = get_timestamp(last_modified)
+        request.validated["if_unmodified_since"] = last_modified
+
+    def iter_pages(offset):
+        yield items
+        try:
+            while offset is not None:
+                request.validated["offset"] = offset
+                page, offset = get_collection_page(request)
+                yield page
+        except Exception, e:
+            logger.error("Aborting streamed response: %r", e)
+            raise
+
+    return StreamedItems(iter_pages(offset))
+
+
+@sleep_and_retry_on_conflict
+@with_collection_lock
+def get_collection_page(request):
+    """Get a subsequent page of items for a streamed collection fetch.
+
+    By the time this is called the response headers have already been
+    sent, so unlike get_collection() it must not touch the response.
+    """
+    ts = get_resource_timestamp(request)
+    if ts > request.validated["if_unmodified_since"]:
+        raise HTTPPreconditionFailed
+    res = find_collection_items(request)
+    next_offset = res.get("next_offset")
+    if next_offset is not None:
+        next_offset = str(next_offset)
+    return res["items"], next_offset
+
+
 @sleep_and_retry_on_conflict
 @with_collection_lock
 @check_precondition_headers
 @check_storage_quota
 def get_collection(request):
+    res = find_collection_items(request)
+    next_offset = res.get("next_offset")
+    if next_offset is not None:
+        request.response.headers["X-Weave-Next-Offset"] = str(next_offset)
+    # Ensure that X-Last-Modified is present, since it's needed when
+    # doing pagination.  This lookup is essentially free since we already
+    # loaded and cached the timestamp when taking the collection lock.
+    ts = get_resource_timestamp(request)
+    request.response.headers["X-Last-Modified"] = str(ts)
+    return res["items"]
+
+
+def find_collection_items(request):
+    """Fetch items or item ids from a collection, per the request params."""
     storage = request.validated["storage"]
     userid = request.validated["userid"]
     collection = request.validated["collection"]
@@ -319,15 +396,7 @@ def get_collection(request):
             bso.pop("ttl", None)
     else:
         res = storage.get_item_ids(userid, collection, **filters)
-    next_offset = res.get("next_offset")
-    if next_offset is not None:
-        request.response.headers["X-Weave-Next-Offset"] = str(next_offset)
-    # Ensure that X-Last-Modified is present, since it's needed when
-    # doing pagination.  This lookup is essentially free since we already
-    # loaded and cached the timestamp when taking the collection lock.
-    ts = get_resource_timestamp(request)
-    request.response.headers["X-Last-Modified"] = str(ts)
-    return res["items"]
+    return res
 
 
 @collection.post(accept="application/json", renderer="sync-json",
@@ -460,11 +529,9 @@ def delete_collection(request):
 @item.get(accept="application/json", renderer="sync-json")
 @default_decorators
 def get_item(request):
-    storage = request.validated["storage"]
-    userid = request.validated["userid"]
-    collection = request.validated["collection"]
-    item = request.validated["item"]
-    bso = storage.get_item(userid, collection, item)
+    # This may have already been fetched when checking preconditions.
+    # Either way, it records the item timestamp for use in the response.
+    bso = get_resource_item(request)
     bso.pop("ttl", None)
     return bso
 
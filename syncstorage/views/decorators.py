@@ -16,9 +16,11 @@ from syncstorage.storage import (ConflictError,
                                  InvalidOffsetError,
                                  InvalidBatch)
 
+from syncstorage.profiler import profiled_enter
 from syncstorage.views.util import (make_decorator,
                                     json_error,
-                                    get_resource_timestamp)
+                                    get_resource_timestamp,
+                                    set_resource_timestamp)
 
 logger = logging.getLogger(__name__)
 
@@ -173,6 +175,10 @@ def with_collection_lock(viewfunc, request):
     a write lock, while read requests will take a read lock.
 
     If the request does not target a specific collection, no lock is taken.
+
+    Any memoized timestamp for the target resource is discarded when the
+    lock is taken, since it may have changed while the lock was not held.
+    It is also discarded after a write, since the write may have changed it.
     """
     storage = request.validated["storage"]
     userid = request.validated["userid"]
@@ -187,7 +193,16 @@ def with_collection_lock(viewfunc, request):
     # enumerate the safer read methods, and assume anything else is a write.
     if request.method in ("GET", "HEAD",):
         lock_collection = storage.lock_for_read
+        lock_name = "read"
     else:
         lock_collection = storage.lock_for_write
-    with lock_collection(userid, collection):
-        return viewfunc(request)
+        lock_name = "write"
+    # Record how long we wait for the lock, if the request is being profiled.
+    lock = lock_collection(userid, collection)
+    with profiled_enter("lock", lock_name, lock):
+        set_resource_timestamp(request, None)
+        try:
+            return viewfunc(request)
+        finally:
+            if lock_name == "write":
+                set_resource_timestamp(request, None)
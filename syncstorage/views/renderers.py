@@ -1,10 +1,207 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Pyramid renderers for syncstorage responses.
 
+Payloads are opaque strings that can be up to a few MB in size, and escaping
+them is the most expensive part of rendering a collection.  So BSOs with a
+large payload have their JSON envelope written out by hand, and take the
+escaped form of the payload from a size-bounded cache.
+
+The cache is keyed by the userid, collection, id and modified time of the
+BSO.  The modified time of an item changes on every write, and each write
+must strictly increase the timestamp of its collection, so this key changes
+whenever the payload changes.  As a guard against clock skew between
+webheads, each entry also records the length, head and tail of the payload
+it was made from, and is discarded if they do not match.  Checking these is
+much cheaper than escaping or comparing the whole payload.
+
+Small BSOs are cheaper to render in bulk with a single call to json_dumps(),
+so runs of them are still rendered that way.
+"""
+
+import decimal
+import threading
+from collections import OrderedDict
+
+from simplejson.encoder import encode_basestring_ascii
 
 from syncstorage.util import json_dumps
-from syncstorage.views.util import get_resource_timestamp
+from syncstorage.profiler import profile_timer
+from syncstorage.views.util import get_resource_timestamp, StreamedItems
+
+
+# Payloads smaller than this are cheap enough to escape on every read.
+MIN_CACHED_PAYLOAD_SIZE = 4 * 1024
+
+# Default maximum combined size of the escaped payloads held in the cache.
+# This is per process, and can be set with the storage.payload_cache_size
+# setting; zero disables the cache.
+MAX_PAYLOAD_CACHE_SIZE = 32 * 1024 * 1024
+
+# Number of chars from each end of a payload to check on a cache hit.
+PAYLOAD_FINGERPRINT_SIZE = 64
+
+
+def get_payload_fingerprint(payload):
+    """Get a cheap fingerprint to sanity-check a cached payload."""
+    size = PAYLOAD_FINGERPRINT_SIZE
+    return (len(payload), payload[:size], payload[-size:])
+
+
+class EscapedPayloadCache(object):
+    """Size-bounded LRU cache of JSON-escaped BSO payloads.
+
+    It is safe to use from multiple threads.
+    """
+
+    def __init__(self, max_size=MAX_PAYLOAD_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get_escaped(self, key, payload):
+        """Get the escaped form of a payload, stored under the given key."""
+        fingerprint = get_payload_fingerprint(payload)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                if entry[0] == fingerprint:
+                    self._entries[key] = entry
+                    return entry[1]
+                self.size -= len(entry[1])
+        escaped = encode_basestring_ascii(payload)
+        if len(escaped) <= self.max_size:
+            with self._lock:
+                old_entry = self._entries.pop(key, None)
+                if old_entry is not None:
+                    self.size -= len(old_entry[1])
+                self._entries[key] = (fingerprint, escaped)
+                self.size += len(escaped)
+                while self.size > self.max_size:
+                    _, old_entry = self._entries.popitem(last=False)
+                    self.size -= len(old_entry[1])
+        return escaped
+
+    def clear(self):
+        """Discard all the cached payloads."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+def get_payload_escaper(request):
+    """Get a function to escape large BSO payloads for the given request.
+
+    The returned function is called as escape_payload(bso, payload).  This
+    returns None if the request is not for a collection or item, in which
+    case payloads are not cached.
+    """
+    if request is None:
+        return None
+    cache = getattr(request.registry, "payload_cache", None)
+    matchdict = request.matchdict
+    if cache is None or not matchdict or "collection" not in matchdict:
+        return None
+    userid = matchdict.get("userid")
+    collection = matchdict["collection"]
+
+    def escape_payload(bso, payload):
+        key = (userid, collection, bso.get("id"), str(bso.get("modified")))
+        return cache.get_escaped(key, payload)
+
+    return escape_payload
+
+
+def has_large_payload(value):
+    """Check whether a value is a dict with a cacheable payload."""
+    try:
+        return len(value["payload"]) >= MIN_CACHED_PAYLOAD_SIZE
+    except (KeyError, TypeError):
+        return False
+
+
+def render_flat_dict(value, escape_payload=None):
+    """Render a dict of scalar values such as a BSO, writing it by hand.
+
+    This produces the same output as json_dumps().  If a callable
+    escape_payload is given then it will be used to get the escaped form of
+    any large "payload" field.
+    """
+    output = []
+    append_flat_dict(output, value, escape_payload)
+    return "".join(output)
+
+
+def append_flat_dict(output, value, escape_payload=None):
+    """Append the JSON for a dict of scalar values to a list of strings.
+
+    Appending the individual fragments avoids repeatedly copying what might
+    be a very large payload.  Dicts containing anything other than strings,
+    integers and Decimals are passed through to json_dumps() instead.
+    """
+    fragments = ["{"]
+    for name, field in value.iteritems():
+        if not isinstance(name, basestring):
+            output.append(json_dumps(value))
+            return
+        if isinstance(field, basestring):
+            if name == "payload" and escape_payload is not None and \
+                    len(field) >= MIN_CACHED_PAYLOAD_SIZE:
+                field = escape_payload(value, field)
+            else:
+                field = encode_basestring_ascii(field)
+        elif isinstance(field, (int, long, decimal.Decimal)) and \
+                not isinstance(field, bool):
+            field = str(field)
+        elif field is None:
+            field = "null"
+        else:
+            output.append(json_dumps(value))
+            return
+        if len(fragments) > 1:
+            fragments.append(", ")
+        fragments.append(encode_basestring_ascii(name))
+        fragments.append(": ")
+        fragments.append(field)
+    fragments.append("}")
+    output.extend(fragments)
+
+
+def append_json_item(output, value, escape_payload=None):
+    """Append the JSON for a single item to a list of strings."""
+    if isinstance(value, dict):
+        append_flat_dict(output, value, escape_payload)
+    else:
+        output.append(json_dumps(value))
+
+
+def append_json_items(output, items, escape_payload=None):
+    """Append the JSON for a list of items, without the enclosing brackets.
+
+    Runs of items without a large payload are rendered with a single call
+    to json_dumps(), and the rest are rendered by hand.
+    """
+    num_fragments = len(output)
+    run = []
+    for item in items:
+        if escape_payload is not None and has_large_payload(item):
+            if run:
+                if len(output) > num_fragments:
+                    output.append(", ")
+                output.append(json_dumps(run)[1:-1])
+                run = []
+            if len(output) > num_fragments:
+                output.append(", ")
+            append_flat_dict(output, item, escape_payload)
+        else:
+            run.append(item)
+    if run:
+        if len(output) > num_fragments:
+            output.append(", ")
+        output.append(json_dumps(run)[1:-1])
 
 
 class SyncStorageRenderer(object):
@@ -20,7 +217,15 @@ class SyncStorageRenderer(object):
         if request is not None:
             response = request.response
             self.adjust_response(value, request, response)
-        return self.render_value(value)
+        escape_payload = get_payload_escaper(request)
+        if isinstance(value, StreamedItems):
+            pages = self.render_pages(value.pages, escape_payload)
+            # Streamed values are written out lazily, page by page.
+            if request is not None:
+                response.app_iter = pages
+                return None
+            return "".join(pages)
+        return self.render_value(value, escape_payload)
 
     def adjust_response(self, value, request, response):
         # Ensure that every response reports the last-modified timestamp.
@@ -30,7 +235,10 @@ class SyncStorageRenderer(object):
             ts = get_resource_timestamp(request)
             response.headers["X-Last-Modified"] = str(ts)
 
-    def render_value(self, value):
+    def render_value(self, value, escape_payload=None):
+        raise NotImplementedError
+
+    def render_pages(self, pages, escape_payload=None):
         raise NotImplementedError
 
 
@@ -44,9 +252,32 @@ class JsonRenderer(SyncStorageRenderer):
         if isinstance(value, (list, tuple)):
             response.headers["X-Weave-Records"] = str(len(value))
 
-    def render_value(self, value):
+    @profile_timer("serialize", "json")
+    def render_value(self, value, escape_payload=None):
+        if isinstance(value, dict):
+            return render_flat_dict(value, escape_payload)
+        if isinstance(value, list):
+            if escape_payload is None or \
+                    not any(has_large_payload(v) for v in value):
+                return json_dumps(value)
+            output = ["["]
+            append_json_items(output, value, escape_payload)
+            output.append("]")
+            return "".join(output)
         return json_dumps(value)
 
+    def render_pages(self, pages, escape_payload=None):
+        # This produces the same output as json_dumps() on the full list.
+        yield "["
+        separator = ""
+        for page in pages:
+            if page:
+                output = [separator]
+                append_json_items(output, page, escape_payload)
+                yield "".join(output)
+                separator = ", "
+        yield "]"
+
 
 class NewlinesRenderer(SyncStorageRenderer):
     """Pyramid renderer producing lists in application/newlines format."""
@@ -55,19 +286,32 @@ class NewlinesRenderer(SyncStorageRenderer):
         super(NewlinesRenderer, self).adjust_response(value, request, response)
         if response.content_type == response.default_content_type:
             response.content_type = "application/newlines"
-        response.headers["X-Weave-Records"] = str(len(value))
+        if not isinstance(value, StreamedItems):
+            response.headers["X-Weave-Records"] = str(len(value))
 
-    def render_value(self, value):
-        data = []
+    @profile_timer("serialize", "newlines")
+    def render_value(self, value, escape_payload=None):
+        # The JSON for each item is pure ASCII, with any newlines escaped,
+        # so there's no need to check it for embedded newline characters.
+        output = []
         for line in value:
-            line = json_dumps(line)
-            line = line.replace('\n', '\\u000a')
-            data.append(line)
-            data.append('\n')
-        return ''.join(data)
+            append_json_item(output, line, escape_payload)
+            output.append("\n")
+        return "".join(output)
+
+    def render_pages(self, pages, escape_payload=None):
+        for page in pages:
+            yield self.render_value(page, escape_payload)
 
 
 def includeme(config):
+    settings = config.registry.settings
+    cache_size = int(settings.get("storage.payload_cache_size",
+                                  MAX_PAYLOAD_CACHE_SIZE))
+    if cache_size > 0:
+        config.registry.payload_cache = EscapedPayloadCache(cache_size)
+    else:
+        config.registry.payload_cache = None
     here = "syncstorage.views.renderers:"
     config.add_renderer("sync-json", here + "JsonRenderer")
     config.add_renderer("sync-newlines", here + "NewlinesRenderer")
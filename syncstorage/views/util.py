@@ -65,7 +65,53 @@ def get_resource_timestamp(request):
     itself, a specific collection in the storage, or a specific item
     in a collection, depending on what resouce is targeted by the request.
     If the target resource does not exist, it returns zero.
+
+    The result is memoized on the request, so it can be looked up by each
+    stage of request processing without going back to the storage every
+    time.  Code that might change the timestamp should reset the memo by
+    calling set_resource_timestamp(request, None).
+    """
+    ts = getattr(request, "resource_timestamp", None)
+    if ts is None:
+        ts = _get_resource_timestamp(request)
+        request.resource_timestamp = ts
+    return ts
+
+
+def set_resource_timestamp(request, ts):
+    """Set the memoized last-modified timestamp for a request's resource.
+
+    This can be used to record a timestamp that was found as a side-effect
+    of some other operation, or to discard the memoized value by passing
+    None so that it will be looked up again when next needed.  Passing None
+    also discards any item memoized by get_resource_item().
     """
+    request.resource_timestamp = ts
+    if ts is None:
+        request.resource_item = None
+
+
+def get_resource_item(request):
+    """Get the BSO targeted by an item request.
+
+    The BSO is memoized on the request along with its timestamp, so that
+    checking preconditions on a GET and then returning the item needs only
+    a single read from the storage.  It raises ItemNotFoundError if the
+    item does not exist.
+    """
+    bso = getattr(request, "resource_item", None)
+    if bso is None:
+        storage = request.validated["storage"]
+        userid = request.validated["userid"]
+        collection = request.validated["collection"]
+        item = request.validated["item"]
+        bso = storage.get_item(userid, collection, item)
+        request.resource_item = bso
+        request.resource_timestamp = bso["modified"]
+    return bso
+
+
+def _get_resource_timestamp(request):
     storage = request.validated["storage"]
     userid = request.validated["userid"]
     collection = request.validated.get("collection")
@@ -83,12 +129,34 @@ def get_resource_timestamp(request):
             return 0
 
     # Otherwise, return timestamp of specific item.
+    # If the request is going to read the item anyway, it's cheaper to
+    # read it all at once than to look up its timestamp separately.
     try:
+        if request.method in ("GET", "HEAD"):
+            return get_resource_item(request)["modified"]
         return storage.get_item_timestamp(userid, collection, item)
     except NotFoundError:
         return 0
 
 
+class StreamedItems(object):
+    """A list of items that is produced lazily, one page at a time.
+
+    Views can return an instance of this class rather than a list, to have
+    the renderer write out each page of items as soon as it is available.
+    It wraps an iterator yielding lists of items, and is itself an iterator
+    over the individual items.
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def __iter__(self):
+        for page in self.pages:
+            for item in page:
+                yield item
+
+
 DEFAULT_LIMITS = {}
 DEFAULT_LIMITS["max_record_payload_bytes"] = MAX_PAYLOAD_SIZE
 DEFAULT_LIMITS["max_post_records"] = 100